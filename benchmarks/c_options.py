@@ -0,0 +1,54 @@
+# Compares run times of C compiled F programs built with different CompilationOptions.
+#
+#   python -m benchmarks.c_options [-n RUNS] [program.f ...]
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from statistics import mean
+from subprocess import run, DEVNULL
+from tempfile import TemporaryDirectory
+
+from f.c_compiler import f_compile
+from general_c_compiler import CompilationOptions
+
+configurations = {
+    '-O0': (CompilationOptions(), False),
+    '-O2': (CompilationOptions('2'), False),
+    '-O3 -march=native': (CompilationOptions('3', 'native'), False),
+    '-O3 -march=native -flto': (CompilationOptions('3', 'native', lto=True), False),
+    '-O3 -march=native pgo': (CompilationOptions('3', 'native'), True),
+}
+
+
+def benchmark(program: Path, runs: int):
+    source = program.read_text()
+    results = {}
+    with TemporaryDirectory() as directory:
+        argv = (str(Path(directory, 'output.txt')),)  # for workloads writing files, like `benchmarks.suite`
+        for name, (options, pgo) in configurations.items():
+            executable = f_compile(source, Path(directory, program.stem), options, [argv] if pgo else None)
+            times = []
+            for _ in range(runs):
+                start = time.perf_counter()
+                run([str(executable), *argv], stdout=DEVNULL, check=True)
+                times.append(time.perf_counter() - start)
+            results[name] = min(times), mean(times)
+    return results
+
+
+def main():
+    arg_parser = ArgumentParser('c_options')
+    arg_parser.add_argument('-n', '--runs', type=int, default=5)
+    arg_parser.add_argument('programs', nargs='*', type=Path,
+                            default=sorted(Path(__file__).with_name('workloads').glob('*.f')))
+    n = arg_parser.parse_args()
+    for program in n.programs:
+        results = benchmark(program, n.runs)
+        baseline = results['-O0'][0]
+        print(program.name)
+        for name, (best, average) in results.items():
+            print(f"  {name:<28} min {best:8.3f}s  mean {average:8.3f}s  speedup {baseline / best:5.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+foreach [|line| print line] (stdinLines ());
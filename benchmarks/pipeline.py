@@ -0,0 +1,43 @@
+# Line throughput of F used as a filter in a shell pipeline (benchmarks/filters/cat.f), per backend and buffer size.
+#
+#   python -m benchmarks.pipeline [-n RUNS] [--lines LINES] [--modes a i] [--buffer-sizes 0 65536]
+import sys
+import time
+from argparse import ArgumentParser
+from pathlib import Path
+from subprocess import run, DEVNULL
+from tempfile import TemporaryDirectory
+
+root = Path(__file__).parent.parent
+cat = Path(__file__).with_name('filters') / 'cat.f'
+
+
+def benchmark(mode: str, buffer_size: int, input_file: Path, runs: int) -> float:
+    best = float('inf')
+    for _ in range(runs):
+        with input_file.open() as stdin:
+            start = time.perf_counter()
+            run([sys.executable, str(root / 'f.py'), '-m', mode, '--buffer-size', str(buffer_size), str(cat)],
+                stdin=stdin, stdout=DEVNULL, cwd=str(root), check=True)
+            best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    arg_parser = ArgumentParser('pipeline')
+    arg_parser.add_argument('-n', '--runs', type=int, default=3)
+    arg_parser.add_argument('--lines', type=int, default=200_000)
+    arg_parser.add_argument('--modes', nargs='+', default=['a', 'i'])
+    arg_parser.add_argument('--buffer-sizes', nargs='+', type=int, default=[0, 1 << 16])
+    n = arg_parser.parse_args()
+    with TemporaryDirectory() as directory:
+        input_file = Path(directory, 'input.txt')
+        input_file.write_text(''.join(f"line {i} of the benchmark input\n" for i in range(n.lines)))
+        for mode in n.modes:
+            for buffer_size in n.buffer_sizes:
+                seconds = benchmark(mode, buffer_size, input_file, n.runs)
+                print(f"-m {mode} --buffer-size {buffer_size:<8} {seconds:8.3f}s  {n.lines / seconds:12,.0f} lines/s")
+
+
+if __name__ == '__main__':
+    main()
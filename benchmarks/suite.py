@@ -0,0 +1,201 @@
+# Runs the workloads in benchmarks/workloads on every backend, checks that their outputs agree and records wall time,
+# peak RSS and parse/compile time as JSON. `compare` flags regressions between two result files.
+#
+#   python -m benchmarks.suite run [-n RUNS] [-o results.json] [--backends interpreter ast_compiler c] [program.f ...]
+#   python -m benchmarks.suite compare OLD.json NEW.json [--threshold 0.1]
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import traceback
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from pathlib import Path
+from tempfile import TemporaryDirectory, TemporaryFile
+from typing import Dict, List, Optional, Sequence, Tuple
+
+root = Path(__file__).parent.parent
+workloads = Path(__file__).with_name('workloads')
+
+backends = ('interpreter', 'ast_compiler', 'c')
+metrics = ('wall', 'compile', 'peak_rss_kb')
+# Differences below these are noise, even if the ratio is large
+noise_floor = {'wall': 0.01, 'compile': 0.01, 'peak_rss_kb': 1024}
+
+
+def normalize(output: str) -> str:
+    # The backends print numbers differently (Decimal, float repr), so they are compared with 12 significant digits
+    lines = []
+    for line in output.splitlines():
+        tokens = []
+        for token in line.split():
+            try:
+                token = f"{float(token):.12g}"
+            except ValueError:
+                pass
+            tokens.append(token)
+        lines.append(' '.join(tokens))
+    return '\n'.join(lines)
+
+
+def measure(command: Sequence[str]) -> Tuple[str, float, Optional[int]]:
+    # Returns stdout, wall time and peak RSS in KiB of a single run
+    with TemporaryFile() as stderr:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, cwd=str(root))
+        output = process.stdout.read()
+        process.stdout.close()
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(process.pid, 0)
+            wall = time.perf_counter() - start
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+            # bytes on macOS, KiB everywhere else
+            rss = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+        else:
+            process.wait()
+            wall = time.perf_counter() - start
+            rss = None
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise RuntimeError(f"{' '.join(command)} failed:\n{stderr.read().decode(errors='replace')}")
+    return output.decode(errors='replace'), wall, rss
+
+
+def prepare(backend: str, source: str, directory: Path) -> Tuple[List[str], float]:
+    # Returns the command that runs the program and the time needed to parse/compile it
+    if backend == 'c':
+        from f.c_compiler import f_compile
+        start = time.perf_counter()
+        executable = f_compile(source, directory / 'program', cache=False)
+        return [str(executable)], time.perf_counter() - start
+    elif backend == 'ast_compiler':
+        from f.ast_compiler import f_compile
+        mode = 'a'
+    else:
+        from f.interpreter import f_compile
+        mode = 'i'
+    start = time.perf_counter()
+    f_compile(source)
+    compile_time = time.perf_counter() - start
+    return [sys.executable, str(root / 'f.py'), '-m', mode, '--', '{program}'], compile_time
+
+
+def run_workload(program: Path, selected: Sequence[str], runs: int) -> Dict[str, dict]:
+    source = program.read_text()
+    results = {}
+    reference = None
+    for backend in selected:
+        with TemporaryDirectory(prefix='f_benchmark_') as directory:
+            directory = Path(directory)
+            argv = [str(directory / 'output.txt')]  # for workloads writing files
+            try:
+                command, compile_time = prepare(backend, source, directory)
+                command = [str(program) if c == '{program}' else c for c in command] + argv
+                output, walls, peak = None, [], 0
+                for _ in range(runs):
+                    output, wall, rss = measure(command)
+                    walls.append(wall)
+                    peak = None if rss is None else max(peak or 0, rss)
+            except Exception as e:
+                traceback.print_exc()
+                results[backend] = {'error': f"{type(e).__name__}: {e}"}
+                continue
+        output = normalize(output)
+        if reference is None:
+            reference = backend, output
+        matches = output == reference[1]
+        if not matches:
+            print(f"  {program.stem}: output of {backend} differs from {reference[0]}", file=sys.stderr)
+        results[backend] = {'wall': min(walls), 'runs': walls, 'compile': compile_time, 'peak_rss_kb': peak,
+                            'output_matches': matches}
+        print(f"  {backend:<13} wall {min(walls):8.3f}s  compile {compile_time:7.3f}s  "
+              f"rss {peak if peak is not None else '?':>8} KiB{'' if matches else '  OUTPUT DIFFERS'}")
+    return results
+
+
+def metadata() -> dict:
+    meta = {'python': sys.version.split()[0], 'platform': platform.platform(),
+            'date': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+    try:
+        meta['commit'] = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=str(root), stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    try:
+        from general_c_compiler import get_compiler
+        meta['c_compiler'] = get_compiler().identity()
+    except Exception:
+        pass
+    return meta
+
+
+def run(programs: Sequence[Path], selected: Sequence[str], runs: int, out: Optional[Path]) -> dict:
+    results = {'meta': metadata(), 'workloads': {}}
+    for program in programs:
+        print(program.stem)
+        results['workloads'][program.stem] = run_workload(program, selected, runs)
+    if out is not None:
+        out.write_text(json.dumps(results, indent=2))
+    return results
+
+
+def compare(old: dict, new: dict, threshold: float) -> List[str]:
+    # Prints the changes of every metric, returns the regressions
+    regressions = []
+    for workload, backends_new in new['workloads'].items():
+        backends_old = old['workloads'].get(workload, {})
+        for backend, result in backends_new.items():
+            previous = backends_old.get(backend)
+            if previous is None or 'error' in previous or 'error' in result:
+                continue
+            changes = []
+            for metric in metrics:
+                a, b = previous.get(metric), result.get(metric)
+                if not a or b is None:
+                    continue
+                ratio = b / a
+                flag = ''
+                if ratio > 1 + threshold and b - a > noise_floor[metric]:
+                    flag = ' REGRESSION'
+                    regressions.append(f"{workload}/{backend} {metric}: {a:.4g} -> {b:.4g} ({ratio:.2f}x)")
+                elif ratio < 1 - threshold and a - b > noise_floor[metric]:
+                    flag = ' improved'
+                changes.append(f"{metric} {ratio:5.2f}x{flag}")
+            if not result.get('output_matches', True):
+                changes.append('OUTPUT DIFFERS')
+            print(f"{workload:<16} {backend:<13} " + '  '.join(changes))
+    return regressions
+
+
+def main():
+    arg_parser = ArgumentParser('suite')
+    commands = arg_parser.add_subparsers(dest='command')
+    commands.required = True
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('-n', '--runs', type=int, default=3)
+    run_parser.add_argument('-o', '--out', type=Path, help="JSON file for the results")
+    run_parser.add_argument('--backends', nargs='+', choices=backends, default=list(backends))
+    run_parser.add_argument('programs', nargs='*', type=Path, default=sorted(workloads.glob('*.f')))
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('old', type=Path)
+    compare_parser.add_argument('new', type=Path)
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help="relative slowdown that counts as regression (default: 0.1)")
+    n = arg_parser.parse_args()
+    if n.command == 'run':
+        programs, out = [p.resolve() for p in n.programs], n.out and n.out.resolve()
+        os.chdir(str(root))  # the backends load stdlib.f from the working directory
+        run(programs, n.backends, n.runs, out)
+    else:
+        regressions = compare(json.loads(n.old.read_text()), json.loads(n.new.read_text()), n.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s):")
+            for r in regressions:
+                print(f"  {r}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
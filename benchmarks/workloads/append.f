@@ -0,0 +1,7 @@
+items := reference {};
+i := reference 0;
+while [!i < 3000] [
+    items <- append !items (!i * 3);
+    i <- !i + 1
+];
+print (get !items 0) (get !items 1500) (get !items 2999);
@@ -0,0 +1,13 @@
+total := reference 0;
+n := reference 0;
+while [!n < 2000] [
+    product := reference 1;
+    i := reference 1;
+    while [!i < 21] [
+        product <- !product * !i;
+        i <- !i + 1
+    ];
+    total <- !total + !product;
+    n <- !n + 1
+];
+print (!total);
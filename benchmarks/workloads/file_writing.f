@@ -0,0 +1,8 @@
+withOpenFile [|f|
+    i := reference 0;
+    while [!i < 50000] [
+        writeLine f "a line written by the file writing benchmark";
+        i <- !i + 1
+    ]
+] (get {...} 0) "w";
+print "done";
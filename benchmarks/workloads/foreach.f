@@ -0,0 +1,13 @@
+items := reference {};
+i := reference 0;
+while [!i < 2000] [
+    items <- append !items !i;
+    i <- !i + 1
+];
+total := reference 0;
+round := reference 0;
+while [!round < 50] [
+    foreach [|x| total <- !total + x] !items;
+    round <- !round + 1
+];
+print (!total);
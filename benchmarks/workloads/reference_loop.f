@@ -0,0 +1,7 @@
+total := reference 0;
+i := reference 0;
+while [!i < 1000000] [
+    total <- !total + !i * 2 - 1;
+    i <- !i + 1
+];
+print (!total);
@@ -0,0 +1,5 @@
+i := reference 0;
+while [!i < 100000] [
+    print "line" !i "of the string output benchmark";
+    i <- !i + 1
+];
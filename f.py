@@ -1,36 +1,174 @@
+import shlex
+import sys
 from argparse import ArgumentParser
 from pathlib import Path
 
 arg_parser = ArgumentParser('f')
-arg_parser.add_argument('-m', '--mode', choices=('a', 'ast', 'i', 'interpreter', 'c', 'compiler'), default='a')
+arg_parser.add_argument('-m', '--mode', choices=('a', 'ast', 'i', 'interpreter', 'c', 'compiler', 's', 'shared'),
+                        default='a')
 
+arg_parser.add_argument('--buffer-size', type=int, metavar='BYTES',
+                        help="output buffer of the python backends (default: 64 KiB, line buffered on terminals). "
+                             "0 writes every print right away")
+arg_parser.add_argument('--tiered', nargs='?', type=int, const=1000, metavar='THRESHOLD',
+                        help="with -m a, compile functions called THRESHOLD (default 1000) times to C in the background")
+arg_parser.add_argument('--profile', action='store_true',
+                        help="with -m a, print the time spent in every F function after the program ran. With -m i, "
+                             "sample the F call stack and print collapsed stacks for flame graph tools")
+arg_parser.add_argument('--profile-out', metavar='FILE', help="write the --profile output to FILE instead of stderr")
+arg_parser.add_argument('--image', metavar='FILE',
+                        help="with -m i, start from an image written by --save-image instead of stdlib.f")
+arg_parser.add_argument('--save-image', metavar='FILE',
+                        help="with -m i, save the definitions of the program to the image FILE after it ran")
+arg_parser.add_argument('--inline-threshold', type=int, metavar='NODES',
+                        help="inline F functions (like if and else of stdlib.f) with bodies of at most NODES syntax "
+                             "tree nodes (default: 16), 0 turns inlining off")
+
+c_options = arg_parser.add_argument_group('compiler options', "used with -m c, -m s and --tiered")
+c_options.add_argument('-O', dest='optimization', choices=('0', '1', '2', '3', 's', 'fast'))
+c_options.add_argument('--march')
+c_options.add_argument('--lto', action='store_true')
+c_options.add_argument('-g', '--debug-info', action='store_true')
+c_options.add_argument('--cflag', action='append', default=[], help="extra flag passed to the C compiler")
+c_options.add_argument('--no-cache', dest='cache', action='store_false',
+                       help="don't use the cached runtime object, executables and imported modules")
+c_options.add_argument('-j', '--jobs', type=int, default=None,
+                       help="number of processes compiling programs in parallel (default: one per core)")
+c_options.add_argument('--pgo', action='store_true', help="profile guided build, see --pgo-train")
+c_options.add_argument('--stats', action='store_true',
+                       help="with -m c, build an instrumented executable that prints allocation and call counts "
+                            "to stderr when it exits or gets SIGUSR1")
+c_options.add_argument('--pgo-train', action='append', metavar='ARGS',
+                       help="argv for one training run of the instrumented executable (implies --pgo)")
+
+arg_parser.add_argument('--timings', action='store_const', const='text',
+                        help="print how long importing, loading stdlib.f, parsing, compiling and running took, with "
+                             "peak memory and tree sizes, to stderr when f.py exits")
+arg_parser.add_argument('--timings-json', dest='timings', action='store_const', const='json',
+                        help="like --timings, as JSON")
 arg_parser.add_argument('program', nargs='?')
 arg_parser.add_argument('argv', nargs='*')
 
 n = arg_parser.parse_args()
+if n.profile and not (n.mode.startswith(('a', 'i')) and n.program):
+    arg_parser.error("--profile needs a program and -m a or -m i")
+if (n.image or n.save_image) and not n.mode.startswith('i'):
+    arg_parser.error("--image and --save-image need -m i")
+if n.save_image and not n.program:
+    arg_parser.error("--save-image needs a program")
+
+if n.timings is not None:
+    import atexit
+    import time
+
+    start = time.perf_counter()
+    import lark
+
+    lark_seconds = time.perf_counter() - start
+    import f  # builds the parser
+
+    parser_seconds = time.perf_counter() - start - lark_seconds
+    from f.util import timings
+
+    timings.recorder = timings.Timings()
+    timings.recorder.start = start
+    timings.recorder.add('import lark', lark_seconds)
+    timings.recorder.add('import f, build the parser', parser_seconds)
+    atexit.register(timings.recorder.report, None, n.timings == 'json')
+
+from f.util.timings import phase
+
+if n.inline_threshold is not None:
+    from f.ir import optimizer
+
+    optimizer.inline_threshold = n.inline_threshold
+if not n.cache:
+    from f.ir import modules
+
+    modules.use_cache = False
+
+options = None
+if n.mode.startswith(('c', 's')) or n.tiered is not None:
+    from general_c_compiler import CompilationOptions
+
+    options = CompilationOptions(n.optimization, n.march, n.lto, n.debug_info, n.cflag)
 
 if n.mode.startswith('c'):
     if not n.program:
         raise ValueError("Can not launch REPL with compiler")
-    if n.argv:
-        raise ValueError("Can not take argv for compiler")
-    from f.c_compiler import f_compile
-
-    with open("stdlib.f") as f:
-        data = f.read() + "\n"
-    with open(n.program) as f:
-        data += f.read()
-    f_compile(data, Path(n.program).with_suffix('.exe'))
+    with phase('import c_compiler'):
+        from f.c_compiler import f_compile_files
+
+    training_runs = None
+    if n.pgo or n.pgo_train:
+        training_runs = [shlex.split(a) for a in n.pgo_train or ('',)]
+
+    failed = False
+    # With the compiler all positional arguments are programs
+    for program, result in f_compile_files([Path(p) for p in (n.program, *n.argv)], n.jobs, options, training_runs,
+                                           n.cache, n.stats):
+        if isinstance(result, Exception):
+            failed = True
+            print(f"{program}: {result}", file=sys.stderr)
+    if failed:
+        sys.exit(1)
 else:
-    if n.mode.startswith('i'):
-        from f.interpreter import f_eval
-    elif n.mode.startswith('a'):
-        from f.ast_compiler import f_eval
+    from functools import partial
+
+    backend_options = {}
+    with phase('import backend'):
+        if n.mode.startswith('i'):
+            from f.interpreter import f_eval
+
+            if n.image:
+                from f.interpreter import image
+
+                with phase('load image'):
+                    backend_options['image'] = image.load(n.image)
+            if n.save_image:
+                backend_options['save_image'] = n.save_image
+        elif n.mode.startswith('a'):
+            from f.ast_compiler import f_eval
+
+            if n.tiered is not None:
+                from f.ast_compiler.tiering import Tier
+
+                backend_options['tier'] = Tier(n.tiered, options, n.cache)
+        elif n.mode.startswith('s'):
+            from f.c_compiler.shared import f_eval
+
+            backend_options.update(options=options, cache=n.cache)
+    f_eval = partial(f_eval, **backend_options)
+
+    if n.buffer_size is not None:
+        from f.util.output import sink
+
+        sink.configure(n.buffer_size)
 
     if n.program:
         with open(n.program) as f:
             data = f.read()
-        f_eval(data, n.argv, debug=0)
+        if n.profile:
+            if n.mode.startswith('a'):
+                from f.ast_compiler.profiler import Profiler
+
+                with Profiler() as profiler:
+                    f_eval(data, n.argv, file_name=n.program, debug=0)
+                report = profiler.report
+            else:
+                from f.interpreter.profiler import SamplingProfiler
+
+                with SamplingProfiler() as profiler:
+                    f_eval(data, n.argv, file_name=n.program, debug=0)
+                report = profiler.write_collapsed
+            if n.profile_out:
+                with open(n.profile_out, 'w') as out:
+                    report(out)
+            else:
+                report()
+        else:
+            f_eval(data, n.argv, file_name=n.program, debug=0)
     else:
-        while True:
-            f_eval(input("> "), debug=0)
+        from f.repl import Session
+
+        Session.create(n.mode, n.argv, **backend_options).interact()
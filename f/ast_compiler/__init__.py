@@ -1,77 +1,120 @@
 import ast
 from collections import namedtuple
 from types import CodeType
-from typing import Tuple, List, overload, TextIO, Dict, Any, Union, Optional
+from typing import AbstractSet, Tuple, List, overload, TextIO, Dict, Any, Union, Optional, TYPE_CHECKING
 from warnings import warn
 
 import f
-from f.ast_compiler.builtins import f_globals
-from f.grammar import FLarkTransformer
+from f.ast_compiler.builtins import f_globals, VECTORIZABLE
+from f.ir import File, emit, optimized, modules, PRELUDE_FILE
+from f.util.output import sink
+from f.util.timings import phase, count_nodes
+from f.util.vectors import ARITHMETIC
+
+if TYPE_CHECKING:
+    from f.ast_compiler.tiering import Tier
 
 _varpar = namedtuple("_vararg", "content")
 
 
 class FASTTransformer(f.BaseFTransformer):
+    def _at(self, node: ast.AST) -> ast.AST:
+        # Gives the node the F source position, so tracebacks and profiles point to the F code
+        if self.position is not None:
+            node.lineno, node.col_offset = self.position[0], self.position[1] - 1
+        return node
+
     def make_statements(self, nodes: Tuple[Tuple[Tuple[ast.AST, ...], Optional[ast.AST]], ...]) -> List[ast.AST]:
-        return [n for st, e in nodes for n in ((*st, ast.Expr(e)) if e is not None else st)]
+        return [n for st, e in nodes for n in ((*st, ast.copy_location(ast.Expr(e), e)) if e is not None else st)]
 
     def string(self, content: str):
-        return (), ast.Str(content)
+        return (), self._at(ast.Str(content))
 
     def number(self, number: str):
-        return (), ast.Num(float(number))
+        return (), self._at(ast.Num(float(number)))
 
     def name(self, name: str):
-        return (), ast.Name(name, ast.Load())
+        return (), self._at(ast.Name(name, ast.Load()))
 
     def parameter(self, name: str):
-        return (), ast.arg(name, None)
+        return (), self._at(ast.arg(name, None))
 
     def variadic_parameter(self, name: str):
         assert name.startswith("...")
         if len(name) == 3:
-            return (), _varpar(ast.arg(name, None))
+            return (), _varpar(self._at(ast.arg(name, None)))
         else:
-            return (), _varpar(ast.arg(name[3:], None))
+            return (), _varpar(self._at(ast.arg(name[3:], None)))
 
     def call(self, func, args: Tuple):
-        return (*func[0], *(st for a in args for st in a[0])), ast.Call(func[1], [a[1] for a in args], [])
+        return (*func[0], *(st for a in args for st in a[0])), self._at(ast.Call(func[1], [a[1] for a in args], []))
 
     def code_block(self, parameters: Tuple, statements: Tuple, return_value):
         if parameters and isinstance(parameters[-1][1], _varpar):
             parameters = ast.arguments([p[1] for p in parameters[:-1]], parameters[-1][1].content, [], [], None, [])
         else:
             parameters = ast.arguments([p[1] for p in parameters], None, [], [], None, [])
-        statements = (*statements, ((*return_value[0], ast.Return(return_value[1])), None))
+        statements = (*statements, ((*return_value[0], ast.copy_location(ast.Return(return_value[1]),
+                                                                          return_value[1])), None))
         statements = self.make_statements(statements)
+        # Blocks that only compute numbers can be applied to whole vectors by `foreach`
+        decorators = [ast.Name(VECTORIZABLE, ast.Load())] if parameters.args and parameters.vararg is None \
+            and all(_arithmetic(s) for s in statements) else []
         self._counter += 1
-        return ((ast.FunctionDef(f"_{self._counter - 1}", parameters, statements, []),),
-                ast.Name(f"_{self._counter - 1}", ast.Load()))
+        return ((self._at(ast.FunctionDef(f"_{self._counter - 1}", parameters, statements, decorators)),),
+                self._at(ast.Name(f"_{self._counter - 1}", ast.Load())))
 
     def variadic_value(self, value):
-        return value[0], ast.Starred(value[1], ast.Load())
+        return value[0], self._at(ast.Starred(value[1], ast.Load()))
 
     def list(self, content: Tuple):
-        return tuple(st for c in content for st in c[0]), ast.List([c[1] for c in content], ast.Load())
+        return tuple(st for c in content for st in c[0]), self._at(ast.List([c[1] for c in content], ast.Load()))
 
     def file(self, statements: Tuple):
         return ast.fix_missing_locations(ast.Module(self.make_statements(statements)))
 
     def assignment(self, name: str, value):
-        return (*value[0], ast.Assign([ast.Name(name, ast.Store())], value[1]),), ast.Name(name, ast.Load())
+        statements, value = value
+        if statements and isinstance(statements[-1], ast.FunctionDef) and isinstance(value, ast.Name) \
+                and statements[-1].name == value.id:
+            # `name = [...]`: the function is called like the variable, which is what profiles and tracebacks show
+            statements[-1].name = value.id = name
+        return (*statements, self._at(ast.Assign([self._at(ast.Name(name, ast.Store()))], value)),), \
+            self._at(ast.Name(name, ast.Load()))
 
     _counter = 0
 
 
+def _arithmetic(node: ast.AST) -> bool:
+    # Numbers, names and calls of the arithmetic builtins, in statements that assign or return them
+    if isinstance(node, (ast.Expr, ast.Return)):
+        return _arithmetic(node.value)
+    elif isinstance(node, ast.Assign):
+        return _arithmetic(node.value)
+    elif isinstance(node, ast.Num):
+        return True
+    elif isinstance(node, ast.Name):
+        return node.id not in ARITHMETIC
+    elif isinstance(node, ast.Call):
+        return isinstance(node.func, ast.Name) and node.func.id in ARITHMETIC \
+            and all(_arithmetic(a) for a in node.args)
+    return False
+
+
 @overload
-def f_compile(text: str, file_name: str = "<unknown>", debug=0) -> CodeType: raise NotImplementedError
+def f_compile(text: str, file_name: str = "<unknown>", debug=0, tier: 'Tier' = None,
+              shadowed: AbstractSet[str] = frozenset()) -> CodeType:
+    raise NotImplementedError
 
 
 @overload
-def f_compile(file: TextIO, file_name: str = None, debug=0) -> CodeType: raise NotImplementedError
+def f_compile(file: TextIO, file_name: str = None, debug=0, tier: 'Tier' = None,
+              shadowed: AbstractSet[str] = frozenset()) -> CodeType:
+    raise NotImplementedError
 
 
-def f_compile(text, file_name=None, debug=0) -> CodeType:
+def f_compile(text, file_name=None, debug=0, tier=None, shadowed=frozenset()) -> CodeType:
+    # `shadowed` are globals defined before the code runs, see `f.ir.optimized`
     if file_name is None:
         try:
             file_name = text.name
@@ -81,29 +124,58 @@ def f_compile(text, file_name=None, debug=0) -> CodeType:
         text = text.read()
     except AttributeError:
         pass
-    tree = f.parse(text)
+    with phase('parse') as p:
+        tree = f.parse(text)
+        if p is not None:
+            p.counts['parse tree nodes'] = sum(1 for _ in tree.iter_subtrees())
     if debug > 0:
         from lark.tree import pydot__tree_to_png
         pydot__tree_to_png(tree, 'debug.png')
-    tree = FLarkTransformer(FASTTransformer()).transform(tree)
-    co = compile(tree, file_name, 'exec', dont_inherit=False)
+    with phase('transform') as p:
+        ir = optimized(tree, file_name, shadowed)
+        module = emit(ir, FASTTransformer())
+        if tier is not None:
+            # Hot functions get replaced by C compiled versions, see `f.ast_compiler.tiering`
+            from f.c_compiler import ASTTransformer
+            module = tier.instrument(module, emit(ir, ASTTransformer()))
+            f_globals[tier.name] = tier
+        if p is not None:
+            p.counts['python AST nodes'] = count_nodes(module, ast.AST)
+    with phase('compile'):
+        co = compile(module, file_name, 'exec', dont_inherit=False)
+    for path, module in modules.load_imports(ir).items():
+        f_compile_module(path, module)
     return co
 
 
+_modules: Dict[str, Tuple[File, CodeType]] = {}
+
+
+def f_compile_module(path: str, module: File = None) -> CodeType:
+    # Imported modules are compiled once per process, see `f.ir.modules`. `module` is the IR `load_imports` gave for
+    # the program that imports it, without it the module is run the way it was compiled last
+    if module is None:
+        module = _modules[path][0] if path in _modules else modules.load(path)
+    if path not in _modules or _modules[path][0] is not module:
+        _modules[path] = module, compile(emit(module, FASTTransformer()), path, 'exec', dont_inherit=False)
+    return _modules[path][1]
+
+
 @overload
-def f_eval(code: CodeType, argv: Tuple[str, ...] = None, f_locals: Dict[str, Any] = None, debug=0):
+def f_eval(code: CodeType, argv: Tuple[str, ...] = None, f_locals: Dict[str, Any] = None, debug=0,
+           tier: 'Tier' = None):
     raise NotImplementedError
 
 
 @overload
 def f_eval(code: Union[TextIO, str], argv: Tuple[str, ...] = None, f_locals: Dict[str, Any] = None,
-           file_name: str = None, debug=0):
+           file_name: str = None, debug=0, tier: 'Tier' = None):
     raise NotImplementedError
 
 
-def f_eval(code, argv=None, f_locals=None, file_name=None, debug=0):
+def f_eval(code, argv=None, f_locals=None, file_name=None, debug=0, tier=None):
     if not isinstance(code, CodeType):
-        code = f_compile(code, file_name, debug - 1)
+        code = f_compile(code, file_name, debug - 1, tier)
     elif file_name is not None:
         warn('`file_name` for already compiled code. `file_name` will be ignored.')
     if argv is None:
@@ -113,7 +185,12 @@ def f_eval(code, argv=None, f_locals=None, file_name=None, debug=0):
         uncompyle6.code_deparse(code)
         print()
     f_globals['...'] = argv
-    eval(code, f_globals, f_locals)
+    try:
+        with phase('execute'):
+            eval(code, f_globals, f_locals)
+    finally:
+        sink.flush()
 
 
-f_eval(open(r"stdlib.f"))
+with phase('load stdlib.f'):
+    f_eval(f_compile_module(PRELUDE_FILE), (PRELUDE_FILE,))
@@ -1,8 +1,14 @@
 import operator
+import sys
 from functools import reduce
 from typing import Callable
 
+from f.util.files import MappedFile, read_lines, write_lines
+from f.util.output import sink
+from f.util.vectors import Vector, ARITHMETIC
+
 f_globals = {"__builtins__": {}}
+VECTORIZABLE = '<arithmetic>'  # decorates code blocks that only do arithmetic, can't collide with an F name
 
 
 def f_function(arg):
@@ -66,9 +72,50 @@ def either(condition, a, b):
 
 @f_function
 def foreach(action, *args):
+    if args and all(isinstance(a, Vector) for a in args):
+        return _foreach_vectors(action, args)
     return [action(*v) for v in zip(*args)]
 
 
+def _foreach_vectors(action, args):
+    # A block that only does arithmetic is called once with the whole vectors. Otherwise the results become a
+    # vector again if they are all numbers
+    size = min(len(v) for v in args)
+    args = tuple(v if len(v) == size else v[:size] for v in args)
+    function = getattr(action, 'function', action)  # the python function of a `TieredFunction`
+    if _arithmetic(function):
+        result = function(*args)
+        return result if isinstance(result, Vector) else Vector.full(result, size)
+    results = [action(*v) for v in zip(*args)]
+    return Vector.of(results) if all(isinstance(r, float) for r in results) else results
+
+
+def _arithmetic(function) -> bool:
+    # The compiler marks the blocks built from nothing but numbers, names and calls of arithmetic builtins, see
+    # `FASTTransformer.code_block`. Whether the names mean what they did there is only known now
+    if not getattr(function, 'f_arithmetic', False):
+        return False
+    code = function.__code__
+    for cell in function.__closure__ or ():
+        try:
+            if not isinstance(cell.cell_contents, float):
+                return False
+        except ValueError:  # not assigned yet
+            return False
+    builtins = f_globals["__builtins__"]
+    for name in code.co_names:
+        value = function.__globals__.get(name, builtins.get(name))
+        if not (value is builtins[name] if name in ARITHMETIC else isinstance(value, float)):
+            return False
+    return True
+
+
+@f_function(VECTORIZABLE)
+def _vectorizable(function):
+    function.f_arithmetic = True
+    return function
+
+
 @f_function("=")
 def eq(first, second):
     return first == second
@@ -143,7 +190,7 @@ def add(*args):
 
 @f_function("print")
 def print_(*args):
-    print(*args)
+    sink.write(' '.join(map(str, args)) + '\n')
     return Null
 
 
@@ -159,11 +206,55 @@ def write_line(f, line):
     return Null
 
 
+@f_function("writeLines")
+def write_lines_(f, lines):
+    write_lines(f, lines)
+    return Null
+
+
+@f_function("readLines")
+def read_lines_(source):
+    # A stream that can be used once (e.g. with `foreach`), the lines are never all in memory
+    return read_lines(source)
+
+
+@f_function("stdinLines")
+def stdin_lines():
+    return read_lines(sys.stdin)
+
+
+@f_function("readFile")
+def read_file(file_name):
+    return MappedFile(file_name)
+
+
+@f_function("slice")
+def slice_(data, start, end):
+    if not (start % 1 == 0 and end % 1 == 0):
+        raise ValueError
+    if isinstance(data, MappedFile):
+        return data.slice(int(start), int(end))
+    return data[int(start):int(end)]
+
+
+@f_function("import")
+def import_(path):
+    # Modules run in the globals of the code importing them, so their definitions are visible to every file of the
+    # program. Imports are top level statements, the caller is the code of a file
+    namespace = sys._getframe(1).f_globals
+    imported = namespace.setdefault('<imported>', set())  # can't collide with an F name
+    if path not in imported:
+        imported.add(path)
+        from f.ast_compiler import f_compile_module
+        exec(f_compile_module(path), namespace)
+    return Null
+
+
 @f_function
 def get(data, index):
     if not index % 1 == 0:
         raise ValueError
-    return data.elements[int(index)]
+    return data[int(index)]
 
 
 @f_function
@@ -176,3 +267,28 @@ def insert(data, index, value):
     if not index % 1 == 0:
         raise ValueError
     return data[:int(index)] + [value] + data[int(index):]
+
+
+@f_function
+def vector(data):
+    return data if isinstance(data, Vector) else Vector.of(data)
+
+
+@f_function("sum")
+def sum_(data):
+    return data.total() if isinstance(data, Vector) else sum(data, 0.)
+
+
+@f_function("min")
+def min_(data):
+    return data.minimum() if isinstance(data, Vector) else min(data)
+
+
+@f_function("max")
+def max_(data):
+    return data.maximum() if isinstance(data, Vector) else max(data)
+
+
+@f_function
+def dot(first, second):
+    return vector(first).dot(vector(second))
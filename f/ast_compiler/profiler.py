@@ -0,0 +1,91 @@
+import cProfile
+import linecache
+import pstats
+import re
+import sys
+from dataclasses import dataclass
+from typing import Dict, List, TextIO, Tuple
+
+from f.ast_compiler.builtins import f_globals
+
+_anonymous = re.compile(r'_\d+')
+
+
+@dataclass
+class FunctionStats:
+    name: str  # the F variable the code block is assigned to, `[...]` for anonymous ones
+    file: str
+    line: int
+    calls: int
+    primitive_calls: int  # calls that weren't recursive
+    self_time: float
+    cumulative_time: float
+    builtin: bool = False
+
+    @property
+    def location(self) -> str:
+        return f"{self.file}:{self.line}" if not self.builtin else "builtin"
+
+
+class Profiler:
+    # cProfile, with the results filtered down to F code blocks and builtins. The code blocks are found by the
+    # file names and line numbers the ast_compiler gives them
+    #
+    #   with Profiler() as profiler:
+    #       f_eval(source, argv, file_name=path)
+    #   profiler.report()
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+
+    def __enter__(self) -> 'Profiler':
+        self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._profile.disable()
+
+    def stats(self) -> List[FunctionStats]:
+        builtins = _builtin_names()
+        result = []
+        for (file, line, name), (primitive, calls, self_time, cumulative, _) in pstats.Stats(
+                self._profile).stats.items():
+            if (file, line, name) in builtins:
+                result.append(FunctionStats(builtins[file, line, name], file, line, calls, primitive, self_time,
+                                            cumulative, builtin=True))
+            elif _is_f_source(file):
+                if _anonymous.fullmatch(name):
+                    name = '[...]'
+                result.append(FunctionStats(name, file, line, calls, primitive, self_time, cumulative))
+        return result
+
+    def report(self, out: TextIO = None, sort: str = 'self_time', limit: int = None):
+        out = out or sys.stderr
+        stats = sorted(self.stats(), key=lambda s: getattr(s, sort), reverse=True)[:limit]
+        name_width = max((len(s.name) for s in stats), default=0) + 2
+        location_width = max((len(s.location) for s in stats), default=0) + 2
+        print(f"{'calls':>12} {'self':>9} {'cumulative':>11}  {'function':<{name_width}}{'location':<{location_width}}"
+              f"source", file=out)
+        for s in stats:
+            calls = str(s.calls) if s.calls == s.primitive_calls else f"{s.calls}/{s.primitive_calls}"
+            source = '' if s.builtin else linecache.getline(s.file, s.line).strip()
+            if len(source) > 48:
+                source = source[:45] + '...'
+            print(f"{calls:>12} {s.self_time:8.3f}s {s.cumulative_time:10.3f}s  {s.name:<{name_width}}"
+                  f"{s.location:<{location_width}}{source}".rstrip(), file=out)
+
+
+def _is_f_source(file: str) -> bool:
+    # cProfile reports C functions as `~`, and Python generates code with names like `<string>`. What is left and
+    # doesn't come from a .py file was compiled from F
+    return file == '<unknown>' or not (file == '~' or file.endswith('.py') or file.startswith('<'))
+
+
+def _builtin_names() -> Dict[Tuple[str, int, str], str]:
+    # cProfile keys of the builtins implemented in Python, mapped to their F names
+    names = {}
+    for name, value in f_globals['__builtins__'].items():
+        code = getattr(value, '__code__', None)
+        if code is not None:
+            names.setdefault((code.co_filename, code.co_firstlineno, code.co_name), name)
+    return names
@@ -0,0 +1,172 @@
+import ast
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, Future
+from copy import deepcopy
+from dataclasses import replace
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Dict, Iterator, Optional, Tuple
+from warnings import warn
+
+from f.c_compiler import load_prelude, compile_c
+from f.c_compiler.fast import FAST, FAssignment, FCall, FCodeBlock, FList, FModule, FName, FValue, FVariadicValue, \
+    CompilerContext, _walk_ast
+from general_c_compiler import CompilationOptions
+from general_c_compiler.base import make_shared_library_path
+
+# Builtins that behave the same in C and in Python. I/O happens in C and would bypass sys.stdout,
+# `...` and Null don't exist in the C runtime. `while` and `foreach` return none in C and lists in Python
+_native_builtins = {
+    'either', 'do', 'any', 'and', 'all', 'or', 'reference', 'false', 'true', 'not',
+    ';', '+', '-', '*', '**', '=', '>', '>=', '<', '<=', '<-', '!',
+}
+_loops = {'until'}  # stdlib.f functions returning what `while` does
+
+
+class Tier:
+    # Counts the calls of top level F functions and replaces the hot ones with C compiled versions.
+    # The C build runs in the background, until it is done the Python function keeps being used.
+    # Functions that are small enough to be inlined (`--inline-threshold`) are replaced by their body where they
+    # are called, those calls aren't counted and the function is never promoted.
+
+    name = '<tier>'  # Global the instrumented code calls, can't collide with an F name
+
+    def __init__(self, threshold: int = 1000, options: CompilationOptions = None, cache: bool = True):
+        self.threshold = threshold
+        self.options = options or CompilationOptions()
+        if self.options.optimization is None:
+            self.options = replace(self.options, optimization='2')  # only hot code ends up here
+        self.cache = cache
+        self.candidates: Dict[str, FAssignment] = {}
+        self._executor = ThreadPoolExecutor(1, 'f_tier')
+        self.prelude = load_prelude()
+
+    def instrument(self, module: ast.Module, fast: FModule) -> ast.Module:
+        # Wraps every promotable function right after its definition
+        promotable = set()
+        for name, assignment in _promotable(fast, self.prelude):
+            self.candidates[name] = assignment
+            promotable.add(name)
+        body = []
+        for statement in module.body:
+            body.append(statement)
+            if isinstance(statement, ast.Assign) and statement.targets[0].id in promotable:
+                name = statement.targets[0].id
+                body.append(ast.Assign([ast.Name(name, ast.Store())],
+                                       ast.Call(ast.Name(self.name, ast.Load()),
+                                                [ast.Str(name), ast.Name(name, ast.Load())], [])))
+        module.body = body
+        return ast.fix_missing_locations(module)
+
+    def __call__(self, name: str, function):
+        return TieredFunction(self, name, function)
+
+    def promote(self, name: str) -> Future:
+        return self._executor.submit(self._build, self.candidates[name])
+
+    def _build(self, assignment: FAssignment) -> Path:
+        # The last statement makes the function the `module_result` of the library
+        module = FModule((deepcopy(assignment), FName(assignment.name)), deepcopy(self.prelude))
+        suffix = make_shared_library_path(Path('f')).suffix
+        with NamedTemporaryFile(prefix=f'f_tier_{assignment.name}_', suffix=suffix, delete=False) as f:
+            out = Path(f.name)  # removed again once it is loaded
+        return compile_c(module.generate_c(), out, replace(self.options, position_independent=True),
+                         cache=self.cache, shared=True)
+
+
+class TieredFunction:
+    def __init__(self, tier: Tier, name: str, function):
+        self.tier = tier
+        self.name = name
+        self.function = function
+        self.calls = 0
+        self.native = None
+        self._build: Optional[Future] = None
+
+    def __repr__(self):
+        state = 'native' if self.native is not None else f'{self.calls} calls'
+        return f"<{type(self).__name__} {self.name} ({state})>"
+
+    def __call__(self, *args):
+        if self.native is not None:
+            from f.c_compiler.shared import NotConvertible
+            try:
+                return self.native(*args)
+            except (NotConvertible, RuntimeError):
+                # Failing native calls are repeated in Python, so that the error is raised the usual way
+                return self.function(*args)
+        self.calls += 1
+        if self._build is None:
+            if self.calls >= self.tier.threshold:
+                self._build = self.tier.promote(self.name)
+        elif self._build.done():
+            self._load()
+        return self.function(*args)
+
+    def _load(self):
+        from f.c_compiler.shared import SharedProgram
+        try:
+            path = self._build.result()
+        except Exception as e:
+            warn(f"Could not compile {self.name} to C: {e}")
+            self._build = Future()  # never done, the function stays in Python
+            return
+        program = SharedProgram(path)
+        program()
+        self.native = program.result
+        path.unlink()  # the library stays mapped
+
+
+def _promotable(module: FModule, prelude: Tuple[FValue, ...]) -> Iterator[Tuple[str, FAssignment]]:
+    # Top level functions only using their own name, the stdlib and builtins that are the same in C
+    top_level = [a for s in module.statements for a in _top_level_assignments(s)]
+    assigned = Counter(a.name for a in top_level)
+    prelude_names = {a.name for s in prelude for a in _top_level_assignments(s)}
+    if any(assigned[n] for n in (*_native_builtins, *prelude_names)):
+        return  # Something got redefined, the C version would not see that
+    for s in top_level:
+        if not (isinstance(s.value, FCodeBlock) and assigned[s.name] == 1):
+            continue
+        test = FModule((deepcopy(s),), deepcopy(prelude))
+        try:
+            _walk_ast(CompilerContext(), test)
+        except ValueError:
+            continue
+        for n in _names(test.statements[0].value):
+            reference = n.scope.lookup(n.name)
+            if reference.is_builtin and n.name not in _native_builtins or n.name in _loops:
+                break
+        else:
+            yield s.name, deepcopy(s)
+
+
+def _top_level_assignments(node: FAST) -> Iterator[FAssignment]:
+    # Assignments outside of code blocks end up as globals in Python
+    if isinstance(node, FAssignment):
+        yield node
+        yield from _top_level_assignments(node.value)
+    elif isinstance(node, FList):
+        for v in node.values:
+            yield from _top_level_assignments(v)
+    elif isinstance(node, FCall):
+        for c in (node.func, *node.arguments):
+            yield from _top_level_assignments(c)
+    elif isinstance(node, FVariadicValue):
+        yield from _top_level_assignments(node.value)
+
+
+def _names(node: FAST) -> Iterator[FName]:
+    if isinstance(node, FName):
+        yield node
+    elif isinstance(node, FAssignment):
+        yield from _names(node.value)
+    elif isinstance(node, FCodeBlock):
+        yield from _names(node.value)
+    elif isinstance(node, FList):
+        for v in node.values:
+            yield from _names(v)
+    elif isinstance(node, FCall):
+        for c in (node.func, *node.arguments):
+            yield from _names(c)
+    elif isinstance(node, FVariadicValue):
+        yield from _names(node.value)
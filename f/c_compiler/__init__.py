@@ -1,34 +1,52 @@
+import hashlib
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import replace
 from pathlib import Path
-from typing import Tuple
+from tempfile import TemporaryDirectory
+from typing import Tuple, Sequence, Iterator, Union, Optional, Dict
 
 from f.c_compiler.fast import CompilerContext, _walk_ast, FVariadicValue
-from f.grammar import BaseFTransformer, FLarkTransformer, parse
-from general_c_compiler import get_compiler
+from f.grammar import BaseFTransformer, parse
+from f.ir import emit, optimized, optimizer, modules, File, PRELUDE_FILE
+from general_c_compiler import get_compiler, CompilationOptions, BuildCache
+from general_c_compiler.base import make_executable_path, make_shared_library_path
+from f.util.timings import phase
 from .fast import FName, FAST, FAssignment, FCall, FCodeBlock, FList, FModule, FNumber, FString, FValue
+from .c_compiler import CBuilder, _identifier
 
 
 class ASTTransformer(BaseFTransformer):
+    def __init__(self, file_name: str = "<unknown>"):
+        self.file_name = file_name
+
+    def _at(self, node: FAST) -> FAST:
+        if self.position is not None:
+            node.location = self.file_name, self.position[0]
+        return node
+
     def string(self, content: str):
-        return FString(content)
+        return self._at(FString(content))
 
     def number(self, number: str):
-        return FNumber(float(number))
+        return self._at(FNumber(float(number)))
 
     def name(self, name: str):
         if name.startswith('...'):
-            return FName(name[3:] if len(name) > 3 else '_dot_dot_dot')
-        return FName(name)
+            return self._at(FName(name[3:] if len(name) > 3 else '_dot_dot_dot'))
+        return self._at(FName(name))
 
     def call(self, func, args: Tuple):
-        return FCall(func, args)
+        return self._at(FCall(func, args))
 
     def code_block(self, parameters: Tuple, statements: Tuple, return_value):
         assert len(statements) == 0
         if any(isinstance(p, tuple) for p in parameters):
             i, = (i for i, v in enumerate(parameters) if isinstance(v, tuple))
-            return FCodeBlock(parameters[:i] + parameters[i + 1:], return_value, (i, parameters[i][1]))
+            return self._at(FCodeBlock(parameters[:i] + parameters[i + 1:], return_value, (i, parameters[i][1])))
         else:
-            return FCodeBlock(parameters, return_value)
+            return self._at(FCodeBlock(parameters, return_value))
 
     def parameter(self, name: str):
         return name
@@ -37,22 +55,229 @@ class ASTTransformer(BaseFTransformer):
         return 'variadic', (name[3:] if len(name) > 3 else '_dot_dot_dot')
 
     def variadic_value(self, value):
-        return FVariadicValue(value)
+        return self._at(FVariadicValue(value))
 
     def list(self, content: Tuple):
-        return FList(content)
+        return self._at(FList(content))
 
     def file(self, statements: Tuple):
         return FModule(statements)
 
     def assignment(self, name: str, value):
-        return FAssignment(name, value)
+        if isinstance(value, FCodeBlock) and value.name is None:
+            value.name = name
+        return self._at(FAssignment(name, value))
+
+
+_runtime = Path(__file__).with_name('f_runtime.c')
+_runtime_header = Path(__file__).with_name('f_runtime.h')
+# Everything that influences the generated C besides the F source
+_package = Path(__file__).parent.parent
+_code_generator = (Path(__file__), Path(__file__).with_name('fast.py'), Path(__file__).with_name('c_compiler.py'),
+                   Path(__file__).with_name('numeric.py'), *sorted(_package.joinpath('ir').glob('*.py')),
+                   _package / 'grammar' / '__init__.py', _package / 'grammar' / 'f.grammar')
+
+
+def f_compile(source: str, out_file: Path = None, options: CompilationOptions = None,
+              training_runs: Sequence[Sequence[str]] = None, cache: bool = True, shared: bool = False,
+              file_name: str = "<unknown>", stats: bool = False) -> Path:
+    # Compiles to an executable, or with `shared` to a shared library, that can be run with `f.c_compiler.shared`.
+    # Executables get a symbol map next to them (`<executable>.fmap`, see `write_symbol_map`). `stats` builds an
+    # instrumented program, that prints allocation and call counts when it exits (see `F_STATS` in f_runtime.h).
+    # Every imported module is compiled to an object of its own, which stays cached as long as the module and the
+    # modules it imports don't change
+    with open(PRELUDE_FILE) as f:
+        stdlib_source = f.read()
+    compiler = get_compiler()
+    build_cache = BuildCache(compiler)
+    options = options or CompilationOptions()
+    if stats:
+        options = replace(options, extra_flags=[*options.extra_flags, '-DF_STATS'])
+    if shared:
+        if training_runs is not None:
+            raise ValueError("Profile guided builds are only supported for executables")
+        options = replace(options, position_independent=True)
+    out_file = out_file or Path(__file__).with_name('main')
+    out_file = make_shared_library_path(out_file) if shared else make_executable_path(out_file)
+    use_cache = cache and training_runs is None and build_cache.cacheable(options)
+    symbols = None if shared else build_cache.directory / 'symbols'
+    if use_cache:
+        # Unchanged programs don't even have to be parsed again. The file name ends up in `#line` directives
+        source_key = build_cache.key(options, stdlib_source, source, file_name, str(optimizer.inline_threshold),
+                                     _runtime.read_bytes(), _runtime_header.read_bytes(),
+                                     *(p.read_bytes() for p in _code_generator))
+        # The modules the program imports are only known after parsing it, the last build recorded them
+        imported = build_cache.directory / 'imports' / source_key
+        build_key = _build_key(build_cache, options, source_key, imported.read_text().splitlines()) \
+            if imported.exists() else None
+        if build_key is not None and (symbols is None or (symbols / build_key).exists()):
+            with phase('look up cached build'):
+                out = build_cache.from_alias(build_key, out_file)
+                if out is not None and symbols is not None:
+                    shutil.copyfile(str(symbols / build_key), str(symbol_map_path(out)))
+            if out is not None:
+                return out
+
+    with phase('load stdlib.f'):
+        stdlib = modules.load(PRELUDE_FILE)
+    program = parse_ir(source, file_name)
+    graph = modules.load_imports(program)
+    with phase('generate C') as p:
+        exports = {}
+        builders = []
+        module_sources = []
+        for path, ir in graph.items():
+            name = module_name(path)
+            builder = _with_prelude(ir, path, stdlib, exports).build_c(name)
+            exports[path] = name, builder.functions[-1].exports
+            builders.append(builder)
+            module_sources.append((name, builder.to_c()))
+        builder = _with_prelude(program, file_name, stdlib, exports).build_c()
+        c_source = builder.to_c()
+        if p is not None:
+            p.counts['functions'] = sum(len(b.functions) for b in (*builders, builder))
+            p.counts['bytes of C'] = len(c_source) + sum(len(c) for _, c in module_sources)
+    if use_cache:
+        imported.parent.mkdir(parents=True, exist_ok=True)
+        temp = imported.with_name(f"{source_key}.{os.getpid()}.tmp")
+        temp.write_text(''.join(f"{path}\n" for path in graph))
+        os.replace(str(temp), str(imported))
+        build_key = _build_key(build_cache, options, source_key, graph)
+    with phase('C compiler'):
+        out = compile_c(c_source, out_file, options, training_runs, use_cache, shared,
+                        build_key if use_cache else None, module_sources)
+    if not shared:
+        write_symbol_map((*builders, builder), symbol_map_path(out))
+        if use_cache:
+            symbols.mkdir(parents=True, exist_ok=True)
+            temp = symbols / f"{build_key}.{os.getpid()}.tmp"
+            shutil.copyfile(str(symbol_map_path(out)), str(temp))
+            os.replace(str(temp), str(symbols / build_key))
+    return out
+
+
+def _build_key(build_cache: BuildCache, options: CompilationOptions, source_key: str,
+               imported: Sequence[str]) -> Optional[str]:
+    # `source_key` together with the current sources of the imported modules, None if one of them is gone
+    try:
+        return build_cache.key(options, source_key, *(part for path in imported
+                                                      for part in (path, Path(path).read_bytes())))
+    except OSError:
+        return None
+
+
+def _with_prelude(ir: File, file_name: str, stdlib: File,
+                  exports: Dict[str, Tuple[str, Dict[str, str]]]) -> FModule:
+    # The FAST of a file, with its own copy of stdlib.f (the walk annotates every node with its scope)
+    module = emit(ir, ASTTransformer(file_name))
+    module.prelude = emit(stdlib, ASTTransformer(PRELUDE_FILE)).statements
+    module.imports = {path: exports[path] for path in modules.imports(ir)}
+    return module
+
+
+def module_name(path: str) -> str:
+    # C name of the imported module at `path`, the prefix of everything it defines
+    digest = hashlib.sha1(path.encode()).hexdigest()[:8]
+    return f"f_module_{_identifier(Path(path).stem)}_{digest}"
+
 
+def parse_ir(source: str, file_name: str = "<unknown>") -> File:
+    with phase('parse') as p:
+        tree = parse(source)
+        if p is not None:
+            p.counts['parse tree nodes'] = sum(1 for _ in tree.iter_subtrees())
+    return optimized(tree, file_name)
 
-def f_compile(source: str, out_file: Path = None):
-    ast: FModule = FLarkTransformer(ASTTransformer()).transform(parse(source))
-    c_source = ast.generate_c()
-    with (Path(__file__).with_name('main.c')).open('w') as f:
-        f.write(c_source)
+
+def load_prelude() -> Tuple[FValue, ...]:
+    # The statements of stdlib.f, for `FModule.prelude`
+    return emit(modules.load(PRELUDE_FILE), ASTTransformer(PRELUDE_FILE)).statements
+
+
+def symbol_map_path(executable: Path) -> Path:
+    return executable.with_name(executable.name + '.fmap')
+
+
+def write_symbol_map(builders: Sequence[CBuilder], path: Path):
+    # Tab separated: generated C function, F variable (empty for anonymous code blocks), file and line. Together
+    # with the `#line` directives of the generated C, native profilers and debuggers can be mapped to the F source
+    with path.open('w') as f:
+        f.write("function\tname\tfile\tline\n")
+        for builder in builders:
+            for function, name, file, line in builder.function_table():
+                f.write(f"{function}\t{name or ''}\t{file}\t{line}\n")
+
+
+def compile_c(c_source: str, out_file: Path, options: CompilationOptions, training_runs: Sequence[Sequence[str]] = None,
+              cache: bool = True, shared: bool = False, alias: str = None,
+              module_sources: Sequence[Tuple[str, str]] = ()) -> Path:
+    # Compiles generated C source and links it against the runtime and the imported modules (name and C source
+    # each, see `module_name`). `out_file` already has to have the right suffix
     compiler = get_compiler()
-    compiler.compile_to_executable(Path(__file__).with_name('main.c'), out_file)
+    options = replace(options, include_dirs=[*options.include_dirs, _runtime.parent])
+    with TemporaryDirectory(prefix='f_build_') as build_dir:  # every build gets its own, so they can run concurrently
+        main = Path(build_dir, 'main.c')
+        with main.open('w') as f:
+            f.write(c_source)
+        sources = [_runtime]
+        for name, module_source in module_sources:
+            sources.append(Path(build_dir, f'{name}.c'))
+            with sources[-1].open('w') as f:
+                f.write(module_source)
+        if training_runs is not None:
+            # The runtime has to be instrumented as well, so it is compiled together with the program
+            return compiler.compile_with_profile(main, out_file, options, training_runs, sources)
+        build_cache = BuildCache(compiler)
+        if not (cache and build_cache.cacheable(options)):
+            link = compiler.compile_to_shared_library if shared else compiler.compile_to_executable
+            return link(main, out_file, options, sources)
+        # Objects of modules that didn't change are cached, the others are compiled in parallel
+        with ThreadPoolExecutor(min(len(sources), os.cpu_count() or 1)) as pool:
+            objects = list(pool.map(lambda source: build_cache.compile_to_object(source, options, (_runtime_header,)),
+                                    sources))
+        link = build_cache.compile_to_shared_library if shared else build_cache.compile_to_executable
+        return link(main, out_file, options, objects, alias=alias)
+
+
+def _compile_file(program: Path, options: CompilationOptions, training_runs: Sequence[Sequence[str]],
+                  cache: bool, stats: bool = False) -> Path:
+    with program.open() as f:
+        return f_compile(f.read(), program.with_suffix('.exe'), options, training_runs, cache,
+                         file_name=str(program), stats=stats)
+
+
+def _set_up_worker(threshold: int):
+    optimizer.inline_threshold = threshold
+    modules.jobs = 1  # the programs are compiled in parallel already
+
+
+def _compile_file_in_worker(program: Path, options: CompilationOptions, training_runs: Sequence[Sequence[str]],
+                            cache: bool, stats: bool) -> Path:
+    try:
+        return _compile_file(program, options, training_runs, cache, stats)
+    except Exception as e:
+        # Neither lark's nor our exceptions survive pickling, which would break the whole pool
+        raise RuntimeError(f"{type(e).__name__}: {e}") from None
+
+
+def f_compile_files(programs: Sequence[Path], jobs: int = None, options: CompilationOptions = None,
+                    training_runs: Sequence[Sequence[str]] = None, cache: bool = True,
+                    stats: bool = False) -> Iterator[Tuple[Path, Union[Path, Exception]]]:
+    # Compiles each program to an executable next to it, using up to `jobs` processes (default: one per core).
+    # Yields the program with the executable or the exception that occurred, in the order of `programs`
+    if jobs == 1 or len(programs) == 1:
+        for program in programs:
+            try:
+                yield program, _compile_file(program, options, training_runs, cache, stats)
+            except Exception as e:
+                yield program, e
+        return
+    # Workers that aren't forked start with the default inline threshold
+    with ProcessPoolExecutor(jobs, initializer=_set_up_worker, initargs=(optimizer.inline_threshold,)) as pool:
+        futures = [pool.submit(_compile_file_in_worker, program, options, training_runs, cache, stats)
+                   for program in programs]
+        for program, future in zip(programs, futures):
+            try:
+                yield program, future.result()
+            except Exception as e:
+                yield program, e
@@ -1,14 +1,30 @@
 from __future__ import annotations
 
+import re
 from dataclasses import dataclass, field
-from typing import List
+from typing import List, Dict, Optional, Tuple
 
 TEMPLATE = r"""
-#include "f_runtime.c"
+#include "f_runtime.h"
 
+%CONSTANTS%
 %FUNCTIONS%
+int f_run(int argc, char **argv) {
+    return run_guarded(f_main, argc, argv);
+}
+
+int main(int argc, char **argv) {
+    return f_main(argc, argv);
+}
 """
 
+# Imported modules are object files of their own, the program calls them, see `ModuleFunction`
+MODULE_TEMPLATE = r"""
+#include "f_runtime.h"
+
+%CONSTANTS%
+%FUNCTIONS%"""
+
 
 class Statement:
     def to_c(self, indent: int):
@@ -18,10 +34,11 @@ class Statement:
 @dataclass
 class SingleLine(Statement):
     line: str
+    location: Tuple[str, int] = None  # in the F source
 
     def to_c(self, indent: int):
         if '(' in self.line or '=' in self.line or 'return' in self.line:
-            return ' ' * indent + self.line + ';\n'
+            return _line_directive(self.location) + ' ' * indent + self.line + ';\n'
         else:
             return ''  # This line is neither a call, nor an assignment, nor a return
 
@@ -35,9 +52,10 @@ class CompoundStatement(Statement, Target):
     open: str
     statements: List[Statement]
     close: str
+    location: Tuple[str, int] = None
 
     def to_c(self, indent: int):
-        out = ' ' * indent + self.open + '{\n'
+        out = _line_directive(self.location) + ' ' * indent + self.open + '{\n'
         for s in self.statements:
             out += s.to_c(indent + 4)
         out += ' ' * indent + "}\n"
@@ -49,52 +67,126 @@ class Function(Target):
     name: str
     statements: List[Statement]
     scope: Scope
+    index: int = 0  # in `function_stats`
+    source_name: str = None  # of the F variable the code block is assigned to
+    location: Tuple[str, int] = None  # file name and line of the code block
     temp_var_counter = 0
 
     def to_c(self):
-        out = ""
-        if self.name == 'main':
-            out += 'int main(int argc, char** argv) {\n'
-            out += '    setup(argc, argv);\n'
-            # assert set(self.scope.defined).issuperset(self.scope.used), (self.scope.defined, self.scope.used)
-        else:
-            if self.scope.outer:
-                outer_vars = '\n    '.join(f"{t_object} {self.scope.lookup(n).name.rpartition('.')[2]};"
-                                           for n in self.scope.outer)
-                out += f"struct _outer_{self.name} {{\n{outer_vars}\n}};\n"
-                out += f"{t_object} {self.name}(struct _outer_{self.name}* outer, {t_object} args) {{\n"
-            else:
-                out += f"{t_object} {self.name}(void* UNUSED(outer), {t_object} args) {{\n"
-
-        if self.scope.defined:
-            self_vars = '\n     '.join(f"{t_object} {self.scope.lookup(n).name.rpartition('.')[2]};"
-                                       for n in self.scope.defined)
+        out = self._prologue()
+        if self.scope.locals:
+            self_vars = '\n     '.join(f"{t_object} {n.name.rpartition('.')[2]};"
+                                       for n in self.scope.locals)
             out = f"struct _self_{self.name} {{\n    {self_vars}\n}};\n" + out  # prepend
+            out += _line_directive(self.location)
             out += f'    struct _self_{self.name} self;\n'
         for s in self.statements:
             out += s.to_c(4)
+        out += self._epilogue()
         out += "}\n\n"
         return out
 
+    def _prologue(self) -> str:
+        if self.name == 'main':
+            out = 'int f_main(int argc, char** argv) {\n'
+            out += '    setup(argc, argv);\n'
+            out += '    setup_constants();\n'
+            # assert set(self.scope.defined).issuperset(self.scope.used), (self.scope.defined, self.scope.used)
+            return out
+        # Every line of the prologue gets the line of the code block, the C compiler would count on otherwise
+        line = _line_directive(self.location)
+        out = ""
+        if self.scope.outer:
+            outer_vars = '\n    '.join(f"{t_object} {self.scope.lookup(n).name.rpartition('.')[2]};"
+                                       for n in self.scope.outer)
+            out += f"struct _outer_{self.name} {{\n{outer_vars}\n}};\n"
+            out += line
+            out += f"{t_object} {self.name}(struct _outer_{self.name}* outer, {t_object} args) {{\n"
+        else:
+            out += line
+            out += f"{t_object} {self.name}(void* UNUSED(outer), {t_object} args) {{\n"
+        out += line
+        out += f"    F_COUNT_CALL(function_stats[{self.index}]);\n"
+        return out
+
+    def _epilogue(self) -> str:
+        if self.name == 'main':
+            return '    flush_output();\n    return 0;\n'
+        return ''
+
+
+@dataclass
+class ModuleFunction(Function):
+    # The top level of an imported module. It runs the first time it is called, then copies the definitions of the
+    # module to globals, where the files importing it read them (see `FCall._import`)
+    exports: Dict[str, str] = field(default_factory=dict)  # F name -> C global
+
+    def _prologue(self) -> str:
+        out = ''.join(f"{t_object} {name};\n" for name in self.exports.values())
+        out += f"void {self.name}(void) {{\n"
+        out += '    static bool done = false;\n'
+        out += '    if (done) return;\n'
+        out += '    done = true;\n'  # before it runs, so that a module imported twice on the way runs once
+        out += '    setup_constants();\n'
+        return out
+
+    def _epilogue(self) -> str:
+        return ''.join(f"    {name} = {self.scope.lookup(f_name)};\n" for f_name, name in self.exports.items())
+
+
+@dataclass
+class NativeFunction(Function):
+    # A function on doubles, see `numeric.py`. Called directly, so it needs a prototype
+    parameters: str = ''  # C parameter list
+
+    def prototype(self) -> str:
+        return f"static double {self.name}({self.parameters or 'void'})"
+
+    def to_c(self):
+        line = _line_directive(self.location)
+        out = line + self.prototype() + " {\n"
+        out += line + f"    F_COUNT_CALL(function_stats[{self.index}]);\n"
+        for s in self.statements:
+            out += s.to_c(4)
+        return out + "}\n\n"
+
 
 @dataclass
 class CBuilder:
     functions: List[Function] = field(default_factory=list)
     target_stack: List[Target] = field(default_factory=lambda: [Function('main', [], None)])
+    strings: Dict[str, str] = field(default_factory=dict)  # C literal -> name of the global holding the object
+    location: Tuple[str, int] = None  # F source of the C that gets pushed, set by the nodes generating it
+    module: str = None  # C name of the module, if this is one that gets imported. Prefixes all its functions
+    imports: Dict[str, Tuple[str, Dict[str, str]]] = field(default_factory=dict)  # path -> module, exports
     function_counter = 0
 
-    def start_function(self, scope: Scope):
-        name = f"f{self.function_counter:08X}"
+    def start_function(self, scope: Scope, source_name: str = None, location: Tuple[str, int] = None):
+        # The C name contains the F variable, or for anonymous code blocks the one of the enclosing function, so that
+        # native profilers and debuggers show something readable
+        label = source_name
+        if label is None:
+            label = next((f"{f.source_name}_block" for f in reversed(self.target_stack)
+                          if isinstance(f, Function) and f.source_name is not None), None)
+        name = f"f{self.function_counter:08X}" + (f"_{_identifier(label)}" if label is not None else "")
+        if self.module is not None:
+            name = f"{self.module}_{name}"
+        self.target_stack.append(Function(name, [], scope, self.function_counter, source_name, location))
         self.function_counter += 1
-        self.target_stack.append(Function(name, [], scope))
         return name
 
+    def start_native_function(self, name: str, parameters: str, source_name: str = None,
+                              location: Tuple[str, int] = None):
+        self.target_stack.append(NativeFunction(name, [], None, self.function_counter, source_name, location,
+                                                parameters))
+        self.function_counter += 1
+
     def end_function(self):
         assert isinstance(self.target_stack[-1], Function)
         self.functions.append(self.target_stack.pop())
 
     def start_compound(self, o: str, c: str):
-        self.target_stack.append(CompoundStatement(o, [], c))
+        self.target_stack.append(CompoundStatement(o, [], c, self.location))
 
     def end_compound(self):
         assert isinstance(self.target_stack[-1], CompoundStatement)
@@ -102,7 +194,13 @@ class CBuilder:
         self.target_stack[-1].statements.append(top)
 
     def push_simple(self, data: str):
-        self.target_stack[-1].statements.append(SingleLine(data))
+        self.target_stack[-1].statements.append(SingleLine(data, self.location))
+
+    def string_constant(self, literal: str) -> str:
+        # String literals are created (and interned) once at startup instead of every time they are evaluated
+        if literal not in self.strings:
+            self.strings[literal] = f"string_{len(self.strings):04X}"
+        return self.strings[literal]
 
     def temp_var(self):
         *_, f = (f for f in self.target_stack if isinstance(f, Function))
@@ -110,11 +208,52 @@ class CBuilder:
         f.temp_var_counter += 1
         return n
 
+    def function_table(self) -> List[Tuple[str, Optional[str], str, int]]:
+        # Generated function, F variable, file and line of every code block, in the order of `function_stats`
+        table = []
+        for f in sorted((f for f in self.functions if f.name != 'main' and not isinstance(f, ModuleFunction)),
+                        key=lambda f: f.index):
+            file, line = f.location or ("<unknown>", 0)
+            table.append((f.name, f.source_name, file, line))
+        return table
+
     def to_c(self) -> str:
-        out = ""
+        out = ''.join(f"{f.prototype()};\n" for f in self.functions if isinstance(f, NativeFunction))
+        if out:
+            out += "\n"
         for f in self.functions:
             out += f.to_c()
-        return TEMPLATE.replace('%FUNCTIONS%', out)
+        constants = ''.join(f"void {module}(void);\n" + ''.join(f"extern {t_object} {name};\n"
+                                                                  for name in exports.values())
+                            for module, exports in self.imports.values())
+        constants += ''.join(f"static {t_object} {name};\n" for name in self.strings.values())
+        table = self.function_table()
+        if table:
+            constants += "#ifdef F_STATS\nstatic struct f_function_stats function_stats[] = {\n"
+            constants += ''.join(f"    {{{_c_string(function)}, {_c_string(name) if name else 'NULL'}, "
+                                 f"{_c_string(file)}, {line}, 0}},\n" for function, name, file, line in table)
+            constants += "};\n#endif\n"
+        constants += "\nstatic void setup_constants(void) {\n"
+        if table:
+            constants += f"#ifdef F_STATS\n    stats_functions({len(table)}, function_stats);\n#endif\n"
+        constants += ''.join(f"    {name} = string_static({literal}, sizeof({literal}) - 1);\n"
+                             for literal, name in self.strings.items())
+        constants += "}\n"
+        template = TEMPLATE if self.module is None else MODULE_TEMPLATE
+        return template.replace('%CONSTANTS%', constants).replace('%FUNCTIONS%', out)
+
+
+def _c_string(text: str) -> str:
+    return '"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _line_directive(location: Optional[Tuple[str, int]]) -> str:
+    return f"#line {location[1]} {_c_string(location[0])}\n" if location is not None else ""
+
+
+def _identifier(name: str) -> str:
+    # F names can contain operator characters
+    return re.sub(r'[^A-Za-z0-9_]', lambda m: f"_{ord(m.group()):02X}", name)
 
 
 t_object = 'f_object'
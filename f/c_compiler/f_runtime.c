@@ -1,57 +1,21 @@
-#include <malloc.h>
-#include <limits.h>
-#include <stdlib.h>
-#include <stdio.h>
-#include <stdarg.h>
-#include <stdbool.h>
-#include <string.h>
-#include <math.h>
-
-#ifdef __GNUC__
-#  define UNUSED(x) UNUSED_ ## x __attribute__((__unused__))
-#else
-#  define UNUSED(x) UNUSED_ ## x
-#endif
-
-typedef struct object *f_object;
-
-typedef f_object (*function_type)(void *self, f_object args);
-
-enum OBJECT_TYPE {
-    NONE, STRING, NUMBER, LIST, CALLABLE, _VARIADIC, REFERENCE, FILE_OBJECT
-};
-
-struct object {
-    enum OBJECT_TYPE type;
-    union {
-        char *string;
-        double number;
-        f_object *reference;
-        struct {
-            size_t count;
-            f_object *elements;
-        } list;
-        struct {
-            void *self;
-            function_type func;
-        } callable;
-        struct {
-            FILE *file_ptr;
-            char *name;
-        } file;
-    };
-};
-
+#include "f_runtime.h"
 
 f_object false_object;
 f_object true_object;
 f_object none_object;
+f_object module_result;
+
+static jmp_buf *error_handler = NULL;
 
 void errorf(const char *message, ...) {
     va_list args;
     va_start(args, message);
+    flush_output();  // keep the order of the program output and the message
     vprintf(message, args);
     va_end(args);
+    if (error_handler != NULL) {
+        longjmp(*error_handler, 1);
+    }
     exit(1);
 }
 
@@ -61,6 +25,11 @@ void _check_type(f_object arg, enum OBJECT_TYPE type) {
     }
 }
 
+double unbox_number(f_object arg) {
+    _check_type(arg, NUMBER);
+    return arg->number;
+}
+
 void _check_length(f_object arg, size_t length) {
     if (arg->list.count != length) {
         errorf("Wrong length (expected %i, got %i)", length, arg->list.count);
@@ -80,29 +49,223 @@ void _check_length_min(f_object arg, size_t min_length) {
 }
 
 void *copied(void *data, size_t size) {
+    F_STAT(f_stats.environments++);
+    F_STAT(f_stats.environment_bytes += size);
     void *out = malloc(size);
     memcpy(out, data, size);
     return out;
 }
 
 f_object create(enum OBJECT_TYPE type) {
+    F_STAT(f_stats.objects[type]++);
     f_object out = malloc(sizeof(*out));
     out->type = type;
     return out;
 }
 
 f_object create_from(struct object data) {
+    F_STAT(f_stats.objects[data.type]++);
     f_object out = malloc(sizeof(*out));
     *out = data;
     return out;
 }
 
-f_object string(char *string) {
+//region Statistics
+
+#ifdef F_STATS
+#include <signal.h>
+
+struct f_stats f_stats;
+
+static struct f_function_stats **function_stats = NULL;  // of the program and every module it imports
+static size_t function_count = 0;
+
+static const char *type_names[] = {"none", "string", "number", "list", "callable", "variadic", "reference", "file"};
+
+void stats_functions(size_t count, struct f_function_stats *functions) {
+    for (size_t i = 0; i < function_count; i++) {
+        if (function_stats[i] == functions) return;  // already registered by an earlier run
+    }
+    function_stats = realloc(function_stats, sizeof(*function_stats) * (function_count + count));
+    for (size_t i = 0; i < count; i++) function_stats[function_count + i] = &functions[i];
+    function_count += count;
+}
+
+static int by_calls(const void *a, const void *b) {
+    unsigned long long x = (*(struct f_function_stats **) a)->calls, y = (*(struct f_function_stats **) b)->calls;
+    return (x < y) - (x > y);
+}
+
+void stats_dump(void) {
+    fprintf(stderr, "\n--- F runtime statistics ---\nobjects allocated:\n");
+    unsigned long long objects = 0;
+    for (size_t i = 0; i <= FILE_OBJECT; i++) {
+        objects += f_stats.objects[i];
+        if (f_stats.objects[i]) fprintf(stderr, "  %-10s %14llu\n", type_names[i], f_stats.objects[i]);
+    }
+    fprintf(stderr, "  %-10s %14llu (%llu bytes)\n", "total", objects, objects * sizeof(struct object));
+    fprintf(stderr, "list elements allocated %14llu (%llu bytes)\n", f_stats.list_elements,
+            f_stats.list_elements * sizeof(f_object));
+    fprintf(stderr, "closure environments    %14llu (%llu bytes)\n", f_stats.environments, f_stats.environment_bytes);
+    fprintf(stderr, "string bytes            %14llu\n", f_stats.string_bytes);
+    fprintf(stderr, "calls                   %14llu\n", f_stats.calls);
+    if (function_count == 0) return;
+    struct f_function_stats **sorted = malloc(sizeof(*sorted) * function_count);
+    memcpy(sorted, function_stats, sizeof(*sorted) * function_count);
+    qsort(sorted, function_count, sizeof(*sorted), by_calls);
+    fprintf(stderr, "calls of F functions:\n");
+    for (size_t i = 0; i < function_count && sorted[i]->calls; i++) {
+        fprintf(stderr, "  %14llu  %-10s %-16s %s:%i\n", sorted[i]->calls, sorted[i]->function,
+                sorted[i]->name ? sorted[i]->name : "[...]", sorted[i]->file, sorted[i]->line);
+    }
+    free(sorted);
+}
+
+static void stats_signal(int UNUSED(signum)) {
+    stats_dump();  // not async signal safe, but this is a debugging aid
+}
+
+static void setup_stats(void) {
+    static bool registered = false;
+    if (registered) return;
+    registered = true;
+    atexit(stats_dump);
+#ifdef SIGUSR1
+    signal(SIGUSR1, stats_signal);
+#endif
+}
+#endif
+
+//endregion
+
+//region Strings
+
+static struct f_string **intern_table = NULL;
+static size_t intern_capacity = 0;  // Always a power of two
+static size_t intern_count = 0;
+
+static size_t hash_bytes(const char *data, size_t length) {
+    size_t hash = 14695981039346656037ULL;  // FNV-1a
+    for (size_t i = 0; i < length; i++) {
+        hash = (hash ^ (unsigned char) data[i]) * 1099511628211ULL;
+    }
+    return hash == 0 ? 1 : hash;
+}
+
+static void flatten(struct f_string *s) {
+    if (s->data != NULL) return;
+    char *data = malloc(s->length + 1);
+    data[s->length] = '\x00';
+    // Filled from the back. Ropes built by appending are deep on the left, that side is a loop instead of recursion
+    char *end = data + s->length;
+    struct f_string *current = s;
+    while (current->data == NULL) {
+        struct f_string *right = current->right;
+        flatten(right);
+        end -= right->length;
+        memcpy(end, right->data, right->length);
+        current = current->left;
+    }
+    memcpy(data, current->data, current->length);
+    s->data = data;
+    s->left = s->right = NULL;
+}
+
+size_t string_hash(struct f_string *s) {
+    if (s->hash == 0) {
+        flatten(s);
+        s->hash = hash_bytes(s->data, s->length);
+    }
+    return s->hash;
+}
+
+static bool same_content(struct f_string *a, struct f_string *b) {
+    if (a == b) return true;
+    if ((a->interned && b->interned) || a->length != b->length || string_hash(a) != string_hash(b)) return false;
+    return memcmp(a->data, b->data, a->length) == 0;
+}
+
+static void intern_insert(struct f_string *s) {
+    size_t i = s->hash & (intern_capacity - 1);
+    while (intern_table[i] != NULL) {
+        i = (i + 1) & (intern_capacity - 1);
+    }
+    intern_table[i] = s;
+}
+
+// Returns the interned string with the content of `s`, which becomes that string if there is none yet
+static struct f_string *intern(struct f_string *s) {
+    if (intern_count * 2 >= intern_capacity) {
+        struct f_string **old = intern_table;
+        size_t old_capacity = intern_capacity;
+        intern_capacity = old_capacity == 0 ? 256 : old_capacity * 2;
+        intern_table = calloc(intern_capacity, sizeof(*intern_table));
+        for (size_t i = 0; i < old_capacity; i++) {
+            if (old[i] != NULL) intern_insert(old[i]);
+        }
+        free(old);
+    }
+    size_t i = string_hash(s) & (intern_capacity - 1);
+    while (intern_table[i] != NULL) {
+        if (same_content(intern_table[i], s)) return intern_table[i];
+        i = (i + 1) & (intern_capacity - 1);
+    }
+    s->interned = true;
+    intern_table[i] = s;
+    intern_count++;
+    return s;
+}
+
+static f_object string_object(struct f_string *s) {
     f_object out = create(STRING);
-    out->string = string;
+    out->string = s->length <= F_INTERN_MAX ? intern(s) : s;
     return out;
 }
 
+static struct f_string *new_string(char *data, size_t length) {
+    F_STAT(f_stats.string_bytes += length);
+    struct f_string *s = malloc(sizeof(*s));
+    *s = (struct f_string) {.length=length, .data=data};
+    return s;
+}
+
+f_object string(char *data) {
+    return string_object(new_string(data, strlen(data)));
+}
+
+f_object string_n(const char *data, size_t length) {
+    char *copy = malloc(length + 1);
+    memcpy(copy, data, length);
+    copy[length] = '\x00';
+    return string_object(new_string(copy, length));
+}
+
+f_object string_static(const char *data, size_t length) {
+    f_object out = create(STRING);
+    out->string = intern(new_string((char *) data, length));
+    return out;
+}
+
+f_object string_concat(f_object a, f_object b) {
+    _check_type(a, STRING);
+    _check_type(b, STRING);
+    if (a->string->length == 0) return b;
+    if (b->string->length == 0) return a;
+    struct f_string *s = new_string(NULL, a->string->length + b->string->length);
+    s->left = a->string;
+    s->right = b->string;
+    if (s->length <= F_INTERN_MAX) flatten(s);  // so that it can be interned
+    return string_object(s);
+}
+
+const char *string_data(f_object s) {
+    _check_type(s, STRING);
+    flatten(s->string);
+    return s->string->data;
+}
+
+//endregion
+
 f_object number(double value) {
     f_object out = create(NUMBER);
     out->number = value;
@@ -119,6 +282,7 @@ f_object callable(void *self, function_type func) {
 f_object list(size_t size) {
     f_object out = create(LIST);
     out->list.count = size;
+    F_STAT(f_stats.list_elements += size);
     out->list.elements = calloc(size, sizeof(*out->list.elements));
     return out;
 }
@@ -136,40 +300,95 @@ f_object variadic(f_object arg) {
     return create_from((struct object) {_VARIADIC, .list=arg->list});
 }
 
-f_object list_v(size_t count, ...) {
-    va_list args;
-    va_start(args, count);
+// Counts the elements `count` arguments expand to, variadic values count with their length
+static size_t expanded_count(size_t count, va_list args) {
     size_t size = 0;
-    f_object *array = calloc(count, sizeof(*array));
     for (size_t i = 0; i < count; i++) {
-        array[i] = va_arg(args, f_object);
-        if (array[i]->type == _VARIADIC) {
-            size += array[i]->list.count;
-        } else {
-            size += 1;
-        }
+        f_object arg = va_arg(args, f_object);
+        size += arg->type == _VARIADIC ? arg->list.count : 1;
     }
-    va_end(args);
-    f_object out = create_from((struct object) {.type = LIST, .list.count=size,
-            .list.elements=malloc(sizeof(*out->list.elements) * size)});
+    return size;
+}
+
+static void fill_expanded(f_object *elements, size_t count, va_list args) {
     size_t current = 0;
     for (size_t i = 0; i < count; i++) {
-        if (array[i]->type == _VARIADIC) {
-            memcpy(out->list.elements + current, array[i]->list.elements,
-                   sizeof(*out->list.elements) * array[i]->list.count);
-            current += array[i]->list.count;
+        f_object arg = va_arg(args, f_object);
+        if (arg->type == _VARIADIC) {
+            memcpy(elements + current, arg->list.elements, sizeof(*elements) * arg->list.count);
+            current += arg->list.count;
         } else {
-            out->list.elements[i] = array[i];
-            current += 1;
+            elements[current++] = arg;
         }
     }
+}
+
+f_object list_v(size_t count, ...) {
+    va_list args, counting;
+    va_start(args, count);
+    va_copy(counting, args);
+    size_t size = expanded_count(count, counting);
+    va_end(counting);
+    F_STAT(f_stats.list_elements += size);
+    f_object out = create_from((struct object) {.type = LIST, .list.count=size,
+            .list.elements=malloc(sizeof(*out->list.elements) * size)});
+    fill_expanded(out->list.elements, count, args);
+    va_end(args);
+    return out;
+}
+
+//region Argument arena
+
+// Argument lists only live as long as the call they are made for: callees copy what they keep (e.g. `sublist`
+// for variadic parameters). So they are allocated like a stack and released when the call returns.
+#define F_ARENA_SIZE (1 << 23)
+#define F_ARENA_ALIGN 16
+
+static char *arena = NULL;
+static char *arena_top = NULL;
+static char *arena_end = NULL;
+
+static void *arena_alloc(size_t size) {
+    size = (size + F_ARENA_ALIGN - 1) & ~(size_t) (F_ARENA_ALIGN - 1);
+    if (arena_top == NULL || (size_t) (arena_end - arena_top) < size) {
+        return malloc(size);  // Full (very deep recursion), these are leaked like other heap objects
+    }
+    void *out = arena_top;
+    arena_top += size;
+    return out;
+}
+
+static f_object arguments_v(size_t count, va_list args) {
+    va_list counting;
+    va_copy(counting, args);
+    size_t size = expanded_count(count, counting);
+    va_end(counting);
+    f_object out = arena_alloc(sizeof(*out));
+    out->type = LIST;
+    out->list.count = size;
+    out->list.elements = arena_alloc(sizeof(*out->list.elements) * size);
+    fill_expanded(out->list.elements, count, args);
     return out;
 }
 
+f_object call_v(f_object func, size_t count, ...) {
+    char *mark = arena_top;
+    va_list args;
+    va_start(args, count);
+    f_object arguments = arguments_v(count, args);
+    va_end(args);
+    f_object result = call(func, arguments);
+    arena_top = mark;
+    return result;
+}
+
+//endregion
+
 f_object sublist(f_object l, size_t start, size_t end) {
     if (start > end || end > l->list.count)
-        abort();
+        errorf("Invalid sublist %i:%i of list with length %i", start, end, l->list.count);
     size_t count = end - start;
+    F_STAT(f_stats.list_elements += count);
     f_object out = create_from((struct object) {
             .type = LIST, .list.count=count,
             .list.elements=calloc(count, sizeof(*out->list.elements))});
@@ -178,58 +397,344 @@ f_object sublist(f_object l, size_t start, size_t end) {
 }
 
 f_object call(f_object func, f_object args) {
+    F_STAT(f_stats.calls++);
     _check_type(func, CALLABLE);
     return func->callable.func(func->callable.self, args);
 }
 
-void echo_object(f_object arg) {
+//region Output
+
+struct f_stream f_stdout;
+
+struct f_stream *stream_open(FILE *file) {
+    struct f_stream *out = malloc(sizeof(*out));
+    out->file = file;
+    out->used = 0;
+    return out;
+}
+
+bool stream_flush(struct f_stream *s) {
+    bool ok = s->used == 0 || fwrite(s->buffer, 1, s->used, s->file) == s->used;
+    s->used = 0;
+    return fflush(s->file) == 0 && ok;
+}
+
+bool stream_write(struct f_stream *s, const char *data, size_t length) {
+    if (length > F_STREAM_BUFFER - s->used) {
+        if (!stream_flush(s)) return false;
+        if (length >= F_STREAM_BUFFER) {
+            return fwrite(data, 1, length, s->file) == length;
+        }
+    }
+    memcpy(s->buffer + s->used, data, length);
+    s->used += length;
+    return true;
+}
+
+void flush_output(void) {
+    if (f_stdout.file != NULL) stream_flush(&f_stdout);
+}
+
+//region Grisu2
+
+// Shortest digits that read back as the same double (Florian Loitsch, "Printing Floating-Point Numbers Quickly and
+// Accurately with Integers", structured like the RapidJSON implementation). Correct for every double, shortest for
+// nearly all of them.
+
+struct diy_fp {
+    uint64_t f;
+    int e;
+};
+
+static const uint64_t cached_powers_f[] = {
+    0xfa8fd5a0081c0288, 0xbaaee17fa23ebf76, 0x8b16fb203055ac76, 0xcf42894a5dce35ea,
+    0x9a6bb0aa55653b2d, 0xe61acf033d1a45df, 0xab70fe17c79ac6ca, 0xff77b1fcbebcdc4f,
+    0xbe5691ef416bd60c, 0x8dd01fad907ffc3c, 0xd3515c2831559a83, 0x9d71ac8fada6c9b5,
+    0xea9c227723ee8bcb, 0xaecc49914078536d, 0x823c12795db6ce57, 0xc21094364dfb5637,
+    0x9096ea6f3848984f, 0xd77485cb25823ac7, 0xa086cfcd97bf97f4, 0xef340a98172aace5,
+    0xb23867fb2a35b28e, 0x84c8d4dfd2c63f3b, 0xc5dd44271ad3cdba, 0x936b9fcebb25c996,
+    0xdbac6c247d62a584, 0xa3ab66580d5fdaf6, 0xf3e2f893dec3f126, 0xb5b5ada8aaff80b8,
+    0x87625f056c7c4a8b, 0xc9bcff6034c13053, 0x964e858c91ba2655, 0xdff9772470297ebd,
+    0xa6dfbd9fb8e5b88f, 0xf8a95fcf88747d94, 0xb94470938fa89bcf, 0x8a08f0f8bf0f156b,
+    0xcdb02555653131b6, 0x993fe2c6d07b7fac, 0xe45c10c42a2b3b06, 0xaa242499697392d3,
+    0xfd87b5f28300ca0e, 0xbce5086492111aeb, 0x8cbccc096f5088cc, 0xd1b71758e219652c,
+    0x9c40000000000000, 0xe8d4a51000000000, 0xad78ebc5ac620000, 0x813f3978f8940984,
+    0xc097ce7bc90715b3, 0x8f7e32ce7bea5c70, 0xd5d238a4abe98068, 0x9f4f2726179a2245,
+    0xed63a231d4c4fb27, 0xb0de65388cc8ada8, 0x83c7088e1aab65db, 0xc45d1df942711d9a,
+    0x924d692ca61be758, 0xda01ee641a708dea, 0xa26da3999aef774a, 0xf209787bb47d6b85,
+    0xb454e4a179dd1877, 0x865b86925b9bc5c2, 0xc83553c5c8965d3d, 0x952ab45cfa97a0b3,
+    0xde469fbd99a05fe3, 0xa59bc234db398c25, 0xf6c69a72a3989f5c, 0xb7dcbf5354e9bece,
+    0x88fcf317f22241e2, 0xcc20ce9bd35c78a5, 0x98165af37b2153df, 0xe2a0b5dc971f303a,
+    0xa8d9d1535ce3b396, 0xfb9b7cd9a4a7443c, 0xbb764c4ca7a44410, 0x8bab8eefb6409c1a,
+    0xd01fef10a657842c, 0x9b10a4e5e9913129, 0xe7109bfba19c0c9d, 0xac2820d9623bf429,
+    0x80444b5e7aa7cf85, 0xbf21e44003acdd2d, 0x8e679c2f5e44ff8f, 0xd433179d9c8cb841,
+    0x9e19db92b4e31ba9, 0xeb96bf6ebadf77d9, 0xaf87023b9bf0ee6b,
+};
+
+static const int16_t cached_powers_e[] = {
+    -1220, -1193, -1166, -1140, -1113, -1087, -1060, -1034, -1007, -980, -954, -927,
+    -901, -874, -847, -821, -794, -768, -741, -715, -688, -661, -635, -608,
+    -582, -555, -529, -502, -475, -449, -422, -396, -369, -343, -316, -289,
+    -263, -236, -210, -183, -157, -130, -103, -77, -50, -24, 3, 30,
+    56, 83, 109, 136, 162, 189, 216, 242, 269, 295, 322, 348,
+    375, 402, 428, 455, 481, 508, 534, 561, 588, 614, 641, 667,
+    694, 720, 747, 774, 800, 827, 853, 880, 907, 933, 960, 986,
+    1013, 1039, 1066,
+};
+
+static const uint64_t powers_of_10[] = {
+    1ULL, 10ULL, 100ULL, 1000ULL, 10000ULL, 100000ULL, 1000000ULL, 10000000ULL, 100000000ULL, 1000000000ULL,
+    10000000000ULL, 100000000000ULL, 1000000000000ULL, 10000000000000ULL, 100000000000000ULL,
+    1000000000000000ULL, 10000000000000000ULL, 100000000000000000ULL, 1000000000000000000ULL,
+    10000000000000000000ULL
+};
+
+static struct diy_fp diy_multiply(struct diy_fp x, struct diy_fp y) {
+    const uint64_t mask = 0xFFFFFFFF;
+    uint64_t a = x.f >> 32, b = x.f & mask, c = y.f >> 32, d = y.f & mask;
+    uint64_t ac = a * c, bc = b * c, ad = a * d, bd = b * d;
+    uint64_t tmp = (bd >> 32) + (ad & mask) + (bc & mask) + (1ULL << 31);  // rounded
+    return (struct diy_fp) {ac + (ad >> 32) + (bc >> 32) + (tmp >> 32), x.e + y.e + 64};
+}
+
+static struct diy_fp diy_normalize(struct diy_fp x) {
+    while (!(x.f & (1ULL << 63))) {
+        x.f <<= 1;
+        x.e--;
+    }
+    return x;
+}
+
+static void grisu_round(char *buffer, int length, uint64_t delta, uint64_t rest, uint64_t ten_kappa,
+                        uint64_t wp_w) {
+    while (rest < wp_w && delta - rest >= ten_kappa &&
+           (rest + ten_kappa < wp_w || wp_w - rest > rest + ten_kappa - wp_w)) {
+        buffer[length - 1]--;
+        rest += ten_kappa;
+    }
+}
+
+static int count_digits(uint32_t n) {
+    int count = 1;
+    while (n >= 10) {
+        n /= 10;
+        count++;
+    }
+    return count;
+}
+
+static void digit_gen(struct diy_fp w, struct diy_fp mp, uint64_t delta, char *buffer, int *length, int *k) {
+    struct diy_fp one = {1ULL << -mp.e, mp.e};
+    uint64_t wp_w = mp.f - w.f;
+    uint32_t p1 = (uint32_t) (mp.f >> -one.e);
+    uint64_t p2 = mp.f & (one.f - 1);
+    int kappa = count_digits(p1);
+    *length = 0;
+    while (kappa > 0) {
+        uint32_t divisor = (uint32_t) powers_of_10[kappa - 1];
+        uint32_t d = p1 / divisor;
+        p1 %= divisor;
+        if (d || *length) buffer[(*length)++] = (char) ('0' + d);
+        kappa--;
+        uint64_t rest = ((uint64_t) p1 << -one.e) + p2;
+        if (rest <= delta) {
+            *k += kappa;
+            grisu_round(buffer, *length, delta, rest, powers_of_10[kappa] << -one.e, wp_w);
+            return;
+        }
+    }
+    for (;;) {
+        p2 *= 10;
+        delta *= 10;
+        char d = (char) (p2 >> -one.e);
+        if (d || *length) buffer[(*length)++] = (char) ('0' + d);
+        p2 &= one.f - 1;
+        kappa--;
+        if (p2 < delta) {
+            *k += kappa;
+            grisu_round(buffer, *length, delta, p2, one.f, -kappa < 20 ? wp_w * powers_of_10[-kappa] : 0);
+            return;
+        }
+    }
+}
+
+// `value` has to be positive and finite. The result is `buffer[:length] * 10 ** k`
+static void grisu2(double value, char *buffer, int *length, int *k) {
+    uint64_t bits;
+    memcpy(&bits, &value, sizeof(bits));
+    const uint64_t hidden_bit = 1ULL << 52;
+    int biased_exponent = (int) ((bits >> 52) & 0x7FF);
+    struct diy_fp v = {bits & (hidden_bit - 1), 0};
+    if (biased_exponent != 0) {
+        v.f += hidden_bit;
+        v.e = biased_exponent - 1075;
+    } else {
+        v.e = -1074;
+    }
+    // Boundaries halfway to the neighbouring doubles
+    struct diy_fp plus = {(v.f << 1) + 1, v.e - 1};
+    while (!(plus.f & (hidden_bit << 1))) {
+        plus.f <<= 1;
+        plus.e--;
+    }
+    plus.f <<= 10;
+    plus.e -= 10;
+    struct diy_fp minus = v.f == hidden_bit ? (struct diy_fp) {(v.f << 2) - 1, v.e - 2}
+                                            : (struct diy_fp) {(v.f << 1) - 1, v.e - 1};
+    minus.f <<= minus.e - plus.e;
+    minus.e = plus.e;
+
+    double dk = (-61 - plus.e) * 0.30102999566398114 + 347;
+    int cached_k = (int) dk;
+    if (dk - cached_k > 0.0) cached_k++;
+    unsigned index = (unsigned) ((cached_k >> 3) + 1);
+    *k = -(-348 + (int) (index << 3));
+    struct diy_fp c_mk = {cached_powers_f[index], cached_powers_e[index]};
+
+    struct diy_fp w = diy_multiply(diy_normalize(v), c_mk);
+    struct diy_fp wp = diy_multiply(plus, c_mk);
+    struct diy_fp wm = diy_multiply(minus, c_mk);
+    wm.f++;
+    wp.f--;
+    digit_gen(w, wp, wp.f - wm.f, buffer, length, k);
+}
+
+//endregion
+
+// Writes the shortest representation that reads back as the same double, formatted like python's `repr`.
+// Returns the length
+size_t format_number(double value, char *out) {
+    size_t length = 0;
+    if (isnan(value)) {
+        memcpy(out, "nan", 4);
+        return 3;
+    }
+    if (signbit(value)) {
+        out[length++] = '-';
+        value = -value;
+    }
+    if (isinf(value)) {
+        memcpy(out + length, "inf", 4);
+        return length + 3;
+    }
+    if (value == (double) (long long) value && value < 1e16) {
+        // Integers are the common case and don't need the digit search
+        char digits[24];
+        size_t count = 0;
+        unsigned long long magnitude = (unsigned long long) value;
+        do {
+            digits[count++] = (char) ('0' + magnitude % 10);
+            magnitude /= 10;
+        } while (magnitude != 0);
+        while (count > 0) out[length++] = digits[--count];
+        memcpy(out + length, ".0", 3);
+        return length + 2;
+    }
+    char digits[20];
+    int count, k;
+    grisu2(value, digits, &count, &k);
+    int point = count + k;  // position of the decimal point relative to the digits
+    if (point > 0 && point <= 16) {
+        if (k >= 0) {
+            memcpy(out + length, digits, count);
+            length += count;
+            memset(out + length, '0', k);
+            length += k;
+            memcpy(out + length, ".0", 2);
+            length += 2;
+        } else {
+            memcpy(out + length, digits, point);
+            length += point;
+            out[length++] = '.';
+            memcpy(out + length, digits + point, count - point);
+            length += count - point;
+        }
+    } else if (point > -4 && point <= 0) {
+        memcpy(out + length, "0.", 2);
+        length += 2;
+        memset(out + length, '0', -point);
+        length += -point;
+        memcpy(out + length, digits, count);
+        length += count;
+    } else {
+        out[length++] = digits[0];
+        if (count > 1) {
+            out[length++] = '.';
+            memcpy(out + length, digits + 1, count - 1);
+            length += count - 1;
+        }
+        length += sprintf(out + length, "e%c%02d", point - 1 < 0 ? '-' : '+', abs(point - 1));
+    }
+    out[length] = '\x00';
+    return length;
+}
+
+static void write_text(struct f_stream *s, const char *text) {
+    stream_write(s, text, strlen(text));
+}
+
+void write_object(struct f_stream *s, f_object arg) {
+    char buffer[64];
     switch (arg->type) {
         case NONE:
-            printf("None");
+            write_text(s, "None");
             break;
         case STRING:
-            printf("%s", arg->string);
+            stream_write(s, string_data(arg), arg->string->length);
             break;
         case NUMBER:
-            printf("%f", arg->number);
+            stream_write(s, buffer, format_number(arg->number, buffer));
             break;
         case LIST:
-            printf("[");
-            if (arg->list.count > 1) {
-                echo_object(arg->list.elements[0]);
+            write_text(s, "[");
+            if (arg->list.count > 0) {
+                write_object(s, arg->list.elements[0]);
                 for (size_t i = 1; i < arg->list.count; i++) {
-                    printf(" ");
-                    echo_object(arg->list.elements[i]);
+                    write_text(s, " ");
+                    write_object(s, arg->list.elements[i]);
                 }
             }
-            printf("]");
+            write_text(s, "]");
             break;
         case CALLABLE:
-            printf("<function at %p (with %p)>", arg->callable.func, arg->callable.self);
+            snprintf(buffer, sizeof(buffer), "<function at %p (with %p)>", (void *) arg->callable.func,
+                     arg->callable.self);
+            write_text(s, buffer);
             break;
         case _VARIADIC:
             errorf("Invalid type for echo_object '_VARIADIC'");
+            break;
         case REFERENCE:
-            printf("<Reference: ");
-            echo_object(*arg->reference);
-            printf(">");
+            write_text(s, "<Reference: ");
+            write_object(s, *arg->reference);
+            write_text(s, ">");
+            break;
         case FILE_OBJECT:
-            printf("<File '%s'>", arg->file.name);
+            write_text(s, "<File '");
+            write_text(s, arg->file.name);
+            write_text(s, "'>");
+            break;
     }
 }
 
+void echo_object(f_object arg) {
+    write_object(&f_stdout, arg);
+}
+
+//endregion
+
 bool truthy(f_object arg) {
     switch (arg->type) {
         case NONE:
             return false;
         case STRING:
-            return arg->string[0] != '\x00';
+            return arg->string->length != 0;
         case NUMBER:
             return arg->number != 0;
         case LIST:
             return arg->list.count != 0;
         case CALLABLE:
-            return truthy(arg->callable.func(arg->callable.self, list_v(0)));
+            return truthy(call_v(arg, 0));
         case _VARIADIC:
             errorf("Invalid type for truthy 'Variadic'");
         case REFERENCE:
@@ -245,8 +750,13 @@ int cmp(f_object a, f_object b) {
         case NONE:
             errorf("Can't order NONE");
             break;
-        case STRING:
-            return strcmp(a->string, b->string);
+        case STRING: {
+            if (a->string == b->string) return 0;
+            size_t a_length = a->string->length, b_length = b->string->length;
+            int c = memcmp(string_data(a), string_data(b), a_length < b_length ? a_length : b_length);
+            if (c != 0) return c > 0 ? 1 : -1;
+            return a_length == b_length ? 0 : (a_length > b_length ? 1 : -1);
+        }
         case NUMBER:
             return a->number == b->number ? 0 : (a->number > b->number ? 1 : -1);
         case LIST:
@@ -282,14 +792,14 @@ bool equal(f_object a, f_object b) {
         case NONE:
             return true;
         case STRING:
-            return strcmp(a->string, b->string) == 0;
+            return same_content(a->string, b->string);
         case NUMBER:
             return a->number == b->number;
         case LIST:
             if (a->list.count != b->list.count)
                 return false;
             for (size_t j = 0; j < a->list.count; j++) {
-                if (!equal(a->list.elements[j], a->list.elements[j])) {
+                if (!equal(a->list.elements[j], b->list.elements[j])) {
                     return false;
                 }
             }
@@ -301,7 +811,7 @@ bool equal(f_object a, f_object b) {
         case REFERENCE:
             return a->reference == b->reference;
         case FILE_OBJECT:
-            return a->file.file_ptr == b->file.file_ptr;
+            return a == b || (a->file.stream != NULL && a->file.stream == b->file.stream);
     }
 }
 
@@ -312,6 +822,13 @@ f_object _call_semicolon(void *UNUSED(self), f_object args) {
 }
 
 f_object _call_add(void *UNUSED(self), f_object args) {
+    if (args->list.count > 0 && args->list.elements[0]->type == STRING) {
+        f_object result = args->list.elements[0];
+        for (size_t i = 1; i < args->list.count; ++i) {
+            result = string_concat(result, args->list.elements[i]);
+        }
+        return result;
+    }
     double sum = 0;
     for (size_t i = 0; i < args->list.count; ++i) {
         _check_type(args->list.elements[i], NUMBER);
@@ -441,25 +958,7 @@ f_object _call_load(void *UNUSED(self), f_object args) {
     return *args->list.elements[0]->reference;
 }
 
-struct {
-    f_object semicolon;
-
-    f_object add;
-    f_object sub;
-    f_object mul;
-    f_object div;
-    f_object pow;
-
-    f_object eq;
-    f_object ne;
-    f_object gt;
-    f_object ge;
-    f_object le;
-    f_object lt;
-
-    f_object store;
-    f_object load;
-} operators;
+struct f_operators operators;
 
 //endregion
 
@@ -467,11 +966,10 @@ struct {
 
 f_object _call_print(void *UNUSED(self), f_object args) {
     for (size_t i = 0; i < args->list.count; i++) {
-        echo_object(args->list.elements[i]);
-        printf(" ");
+        write_object(&f_stdout, args->list.elements[i]);
+        stream_write(&f_stdout, " ", 1);
     }
-    printf("\n");
-    fflush(stdout);
+    stream_write(&f_stdout, "\n", 1);
     return none_object;
 }
 
@@ -546,8 +1044,8 @@ f_object _call_while(void *UNUSED(self), f_object args) {
     _check_length(args, 2);
     f_object condition = args->list.elements[0];
     f_object body = args->list.elements[1];
-    while (truthy(call(condition, list(0)))) {
-        call(body, list(0));
+    while (truthy(call_v(condition, 0))) {
+        call_v(body, 0);
     }
     return none_object;
 }
@@ -565,14 +1063,20 @@ f_object _call_withOpenFile(void *UNUSED(self), f_object args) {
     _check_type(file_mode, STRING);
 
     f_object file = create(FILE_OBJECT);
-    file->file.file_ptr = fopen(file_name->string, file_mode->string);
-    if (file->file.file_ptr == NULL) {
-        errorf("Can't open file '%s' with mode '%s'. errno: %i\n", file_name->string, file_mode->string, errno);
+    FILE *file_ptr = fopen(string_data(file_name), string_data(file_mode));
+    if (file_ptr == NULL) {
+        errorf("Can't open file '%s' with mode '%s'. errno: %i\n", string_data(file_name), string_data(file_mode),
+               errno);
     }
-    file->file.name = file_name->string;
-    f_object out = call(code_block, list_v(1, file));
-    if (fclose(file->file.file_ptr) == EOF) {
-        errorf("Can't close file '%s' with mode '%s'. errno: %i\n", file_name->string, file_mode->string, errno);
+    file->file.stream = stream_open(file_ptr);
+    file->file.name = (char *) string_data(file_name);
+    f_object out = call_v(code_block, 1, file);
+    bool flushed = stream_flush(file->file.stream);
+    free(file->file.stream);
+    file->file.stream = NULL;  // the file object can outlive the call, writing to it is an error now
+    if (fclose(file_ptr) == EOF || !flushed) {
+        errorf("Can't close file '%s' with mode '%s'. errno: %i\n", string_data(file_name), string_data(file_mode),
+               errno);
     }
     return out;
 }
@@ -586,30 +1090,55 @@ f_object _call_writeLine(void *UNUSED(self), f_object args) {
     f_object line = args->list.elements[1];
     _check_type(line, STRING);
 
-    if (fprintf(file->file.file_ptr, "%s\n", line->string) < 0) {
+    struct f_stream *stream = file->file.stream;
+    if (stream == NULL) {
+        errorf("Can't write to the closed file '%s'\n", file->file.name);
+    }
+    if (!stream_write(stream, string_data(line), line->string->length) || !stream_write(stream, "\n", 1)) {
         errorf("Couldn't write to file '%s'", file->file.name);
     }
     return none_object;
 }
 
-struct {
-    f_object print;
-    f_object either;
-    f_object do_;
-    f_object any;
-    f_object and;
-    f_object all;
-    f_object or;
-    f_object reference;
-    f_object _dot_dot_dot;
-    f_object false_;
-    f_object true_;
-    f_object not;
-    f_object foreach;
-    f_object while_;
-    f_object withOpenFile;
-    f_object writeLine;
-} builtins;
+static size_t index_argument(f_object index, size_t count) {
+    _check_type(index, NUMBER);
+    if (index->number != floor(index->number) || index->number < 0 || index->number >= count) {
+        errorf("Invalid index %f for list with length %i", index->number, count);
+    }
+    return (size_t) index->number;
+}
+
+f_object _call_get(void *UNUSED(self), f_object args) {
+    _check_length(args, 2);
+    f_object data = args->list.elements[0];
+    _check_type(data, LIST);
+    return data->list.elements[index_argument(args->list.elements[1], data->list.count)];
+}
+
+f_object _call_append(void *UNUSED(self), f_object args) {
+    _check_length(args, 2);
+    f_object data = args->list.elements[0];
+    _check_type(data, LIST);
+    f_object out = list(data->list.count + 1);
+    memcpy(out->list.elements, data->list.elements, sizeof(*out->list.elements) * data->list.count);
+    out->list.elements[data->list.count] = args->list.elements[1];
+    return out;
+}
+
+f_object _call_insert(void *UNUSED(self), f_object args) {
+    _check_length(args, 3);
+    f_object data = args->list.elements[0];
+    _check_type(data, LIST);
+    size_t index = index_argument(args->list.elements[1], data->list.count + 1);
+    f_object out = list(data->list.count + 1);
+    memcpy(out->list.elements, data->list.elements, sizeof(*out->list.elements) * index);
+    out->list.elements[index] = args->list.elements[2];
+    memcpy(out->list.elements + index + 1, data->list.elements + index,
+           sizeof(*out->list.elements) * (data->list.count - index));
+    return out;
+}
+
+struct f_builtins builtins;
 
 //endregion
 
@@ -649,9 +1178,20 @@ void setup_builtins() {
     builtins.while_ = callable(NULL, _call_while);
     builtins.withOpenFile = callable(NULL, _call_withOpenFile);
     builtins.writeLine = callable(NULL, _call_writeLine);
+    builtins.get = callable(NULL, _call_get);
+    builtins.append = callable(NULL, _call_append);
+    builtins.insert = callable(NULL, _call_insert);
 }
 
 void setup(int argc, char **argv) {
+#ifdef F_STATS
+    setup_stats();
+#endif
+    f_stdout.file = stdout;
+    if (arena == NULL) {
+        arena_top = arena = malloc(F_ARENA_SIZE);
+        arena_end = arena + F_ARENA_SIZE;
+    }
     none_object = create_from((struct object) {.type=NONE});
     false_object = create_from((struct object) {.type=NUMBER, .number=0});
     true_object = create_from((struct object) {.type=NUMBER, .number=1});
@@ -661,6 +1201,78 @@ void setup(int argc, char **argv) {
 
     builtins._dot_dot_dot = list((size_t) (argc - 1));
     for (size_t i = 1; i < argc; i++) {
-        builtins._dot_dot_dot->list.elements[i - 1] = create_from((struct object) {.type=STRING, .string=argv[i]});
+        builtins._dot_dot_dot->list.elements[i - 1] = string_static(argv[i], strlen(argv[i]));
+    }
+}
+int run_guarded(int (*program)(int argc, char **argv), int argc, char **argv) {
+    jmp_buf handler;
+    int result;
+    error_handler = &handler;
+    if (setjmp(handler) == 0) {
+        result = program(argc, argv);
+    } else {
+        result = 1;
+        arena_top = arena;  // the failed calls never released their arguments
+    }
+    error_handler = NULL;
+    flush_output();
+    return result;
+}
+
+//region FFI
+
+int ffi_type(f_object o) {
+    return o->type;
+}
+
+double ffi_number(f_object o) {
+    _check_type(o, NUMBER);
+    return o->number;
+}
+
+const char *ffi_string(f_object o) {
+    return string_data(o);
+}
+
+size_t ffi_count(f_object o) {
+    _check_type(o, LIST);
+    return o->list.count;
+}
+
+f_object ffi_element(f_object o, size_t i) {
+    _check_type(o, LIST);
+    return o->list.elements[i];
+}
+
+void ffi_set_element(f_object o, size_t i, f_object value) {
+    _check_type(o, LIST);
+    o->list.elements[i] = value;
+}
+
+f_object ffi_new_string(const char *data) {
+    // The caller owns `data`, so it has to be copied
+    return string_n(data, strlen(data));
+}
+
+f_object ffi_new_list(size_t size) {
+    return list(size);
+}
+
+f_object ffi_call(f_object func, f_object args) {
+    jmp_buf handler;
+    jmp_buf *previous = error_handler;
+    char *mark = arena_top;
+    f_object result;
+    error_handler = &handler;
+    if (setjmp(handler) == 0) {
+        result = call(func, args);
+    } else {
+        result = NULL;
+        arena_top = mark;
     }
-}
\ No newline at end of file
+    error_handler = previous;
+    flush_output();
+    return result;
+}
+
+//endregion
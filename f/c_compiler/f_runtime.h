@@ -0,0 +1,259 @@
+#ifndef F_RUNTIME_H
+#define F_RUNTIME_H
+
+#include <malloc.h>
+#include <limits.h>
+#include <stdlib.h>
+#include <stdio.h>
+#include <stdarg.h>
+#include <stdbool.h>
+#include <stdint.h>
+#include <string.h>
+#include <math.h>
+#include <setjmp.h>
+#include <errno.h>
+
+#ifdef __GNUC__
+#  define UNUSED(x) UNUSED_ ## x __attribute__((__unused__))
+#else
+#  define UNUSED(x) UNUSED_ ## x
+#endif
+
+typedef struct object *f_object;
+
+typedef f_object (*function_type)(void *self, f_object args);
+
+enum OBJECT_TYPE {
+    NONE, STRING, NUMBER, LIST, CALLABLE, _VARIADIC, REFERENCE, FILE_OBJECT
+};
+
+// Strings know their length and cache their hash. Results of concatenation start as ropes (`left` + `right`,
+// `data` is NULL) and are flattened the first time their content is needed, so repeated appending stays linear.
+struct f_string {
+    size_t length;
+    size_t hash;  // 0 until it got computed
+    bool interned;  // Interned strings are equal exactly if they are the same
+    char *data;  // NUL terminated
+    struct f_string *left;
+    struct f_string *right;
+};
+
+// Strings up to this length are interned when they are created
+#define F_INTERN_MAX 32
+
+#define F_STREAM_BUFFER (1 << 16)
+
+// Output is collected here and written in large blocks. Flushed when the program ends or the file is closed
+struct f_stream {
+    FILE *file;
+    size_t used;
+    char buffer[F_STREAM_BUFFER];
+};
+
+extern struct f_stream f_stdout;
+
+struct object {
+    enum OBJECT_TYPE type;
+    union {
+        struct f_string *string;
+        double number;
+        f_object *reference;
+        struct {
+            size_t count;
+            f_object *elements;
+        } list;
+        struct {
+            void *self;
+            function_type func;
+        } callable;
+        struct {
+            struct f_stream *stream;
+            char *name;
+        } file;
+    };
+};
+
+extern f_object false_object;
+extern f_object true_object;
+extern f_object none_object;
+extern f_object module_result;  // Value of the last statement of the module
+
+struct f_operators {
+    f_object semicolon;
+
+    f_object add;
+    f_object sub;
+    f_object mul;
+    f_object div;
+    f_object pow;
+
+    f_object eq;
+    f_object ne;
+    f_object gt;
+    f_object ge;
+    f_object le;
+    f_object lt;
+
+    f_object store;
+    f_object load;
+};
+
+extern struct f_operators operators;
+
+struct f_builtins {
+    f_object print;
+    f_object either;
+    f_object do_;
+    f_object any;
+    f_object and;
+    f_object all;
+    f_object or;
+    f_object reference;
+    f_object _dot_dot_dot;
+    f_object false_;
+    f_object true_;
+    f_object not;
+    f_object foreach;
+    f_object while_;
+    f_object withOpenFile;
+    f_object writeLine;
+    f_object get;
+    f_object append;
+    f_object insert;
+};
+
+extern struct f_builtins builtins;
+
+#ifdef F_STATS
+// Instrumented builds (`--stats`) count allocations and calls and print a summary to stderr when the program
+// exits or receives SIGUSR1.
+struct f_stats {
+    unsigned long long objects[FILE_OBJECT + 1];  // by OBJECT_TYPE, from `create` and `create_from`
+    unsigned long long list_elements;  // slots allocated for list contents
+    unsigned long long environments;  // captured variables of closures that escape
+    unsigned long long environment_bytes;
+    unsigned long long string_bytes;
+    unsigned long long calls;  // through `call` and `call_v`, builtins included
+};
+
+extern struct f_stats f_stats;
+
+// Calls of one generated function, the table is part of the generated C
+struct f_function_stats {
+    const char *function;
+    const char *name;  // of the F variable the code block is assigned to, NULL for anonymous ones
+    const char *file;
+    int line;
+    unsigned long long calls;
+};
+
+void stats_functions(size_t count, struct f_function_stats *functions);
+
+void stats_dump(void);
+
+#  define F_STAT(statement) (statement)
+#  define F_COUNT_CALL(function) ((function).calls++)
+#else
+#  define F_STAT(statement) ((void) 0)
+#  define F_COUNT_CALL(function) ((void) 0)
+#endif
+
+void errorf(const char *message, ...);
+
+void _check_type(f_object arg, enum OBJECT_TYPE type);
+
+void _check_length(f_object arg, size_t length);
+
+void _check_length_range(f_object arg, size_t min_length, size_t max_length);
+
+void _check_length_min(f_object arg, size_t min_length);
+
+// The number of `arg`, which has to be one. For the boxed versions of natively compiled functions
+double unbox_number(f_object arg);
+
+void *copied(void *data, size_t size);
+
+f_object create(enum OBJECT_TYPE type);
+
+f_object create_from(struct object data);
+
+// Takes ownership of the NUL terminated `data`, it is not copied
+f_object string(char *data);
+
+// Copies `length` bytes from `data`
+f_object string_n(const char *data, size_t length);
+
+// For data that lives as long as the program (literals, argv), always interned
+f_object string_static(const char *data, size_t length);
+
+f_object string_concat(f_object a, f_object b);
+
+const char *string_data(f_object s);
+
+size_t string_hash(struct f_string *s);
+
+f_object number(double value);
+
+f_object callable(void *self, function_type func);
+
+f_object list(size_t size);
+
+f_object reference(f_object value);
+
+f_object variadic(f_object arg);
+
+f_object list_v(size_t count, ...);
+
+f_object sublist(f_object l, size_t start, size_t end);
+
+f_object call(f_object func, f_object args);
+
+// Calls `func` with the `count` arguments after it. The argument list only lives until the call returns
+f_object call_v(f_object func, size_t count, ...);
+
+struct f_stream *stream_open(FILE *file);
+
+bool stream_write(struct f_stream *s, const char *data, size_t length);
+
+bool stream_flush(struct f_stream *s);
+
+void flush_output(void);
+
+size_t format_number(double value, char *out);
+
+void write_object(struct f_stream *s, f_object arg);
+
+void echo_object(f_object arg);
+
+bool truthy(f_object arg);
+
+int cmp(f_object a, f_object b);
+
+bool equal(f_object a, f_object b);
+
+void setup(int argc, char **argv);
+
+// Runs `program`, but returns 1 instead of exiting the process if it fails
+int run_guarded(int (*program)(int argc, char **argv), int argc, char **argv);
+
+// Access for foreign function interfaces (ctypes), that can't use the struct layout
+int ffi_type(f_object o);
+
+double ffi_number(f_object o);
+
+const char *ffi_string(f_object o);
+
+size_t ffi_count(f_object o);
+
+f_object ffi_element(f_object o, size_t i);
+
+void ffi_set_element(f_object o, size_t i, f_object value);
+
+f_object ffi_new_string(const char *data);
+
+f_object ffi_new_list(size_t size);
+
+// Calls `func`, but returns NULL instead of exiting the process if it fails
+f_object ffi_call(f_object func, f_object args);
+
+#endif
@@ -1,11 +1,14 @@
 from __future__ import annotations
 
 from dataclasses import dataclass, field
-from typing import Tuple, Iterator, Set, Dict
+from functools import wraps
+from typing import Tuple, Iterator, Set, Dict, List, Optional
 
 
 class FAST:
     scope: Scope = None  # the scope they are in
+    location: Tuple[str, int] = None  # file name and line in the F source
+    value_type: str = None  # `NUMBER` if the value is known to be a number, see `numeric.py`
 
     def _pretty(self, indent) -> Iterator[str]:
         raise NotImplementedError
@@ -17,6 +20,21 @@ class FAST:
         raise NotImplementedError
 
 
+def _located(to_c):
+    # The C generated by `to_c` is attributed to the F line of the node, see `CBuilder.location`
+    @wraps(to_c)
+    def located_to_c(self, context):
+        outer = context.location
+        if self.location is not None:
+            context.location = self.location
+        try:
+            return to_c(self, context)
+        finally:
+            context.location = outer
+
+    return located_to_c
+
+
 class FValue(FAST):
     def _pretty(self, indent) -> Iterator[str]:
         raise NotImplementedError
@@ -33,7 +51,7 @@ class FString(FValue):
         yield f"{type(self).__name__}: {self.data!r}"
 
     def to_c(self, context):
-        return f"string(\"{self.data}\")"
+        return context.string_constant(f'"{self.data}"')
 
 
 @dataclass
@@ -62,6 +80,7 @@ class FNumber(FValue):
 class FCall(FValue):
     func: FValue
     arguments: Tuple[FValue, ...]
+    callee = None  # the FCodeBlock, if a natively compiled function gets called, set by `infer_types`
 
     def _pretty(self, indent: str):
         yield f"{type(self).__name__}:"
@@ -70,7 +89,15 @@ class FCall(FValue):
         for i, arg in enumerate(self.arguments):
             yield from (indent * 2 + line for line in arg._pretty(indent))
 
+    @_located
     def to_c(self, context):
+        if self.value_type == NUMBER:
+            boxed = numeric.box(self, context)
+            if boxed is not None:
+                return boxed
+        branch = _branch(self)
+        if branch is not None:
+            return self._if_else(context, *branch)
         f = self.func.to_c(context)
         if isinstance(f, NamedReference):
             if f.is_builtin:
@@ -82,22 +109,136 @@ class FCall(FValue):
                     temp_name = context.temp_var()
                     context.push_simple(f'{t_object} {temp_name}')
                     context.start_compound(f'if(truthy({self.arguments[0].to_c(context)}))', '')
-                    context.push_simple(f'{temp_name} = call({self.arguments[1].to_c(context)}, list(0))')
+                    context.push_simple(f'{temp_name} = call_v({self.arguments[1].to_c(context)}, 0)')
                     context.end_compound()
                     context.start_compound('else', '')
-                    context.push_simple(f'{temp_name} = call({self.arguments[2].to_c(context)}, list(0))')
+                    context.push_simple(f'{temp_name} = call_v({self.arguments[2].to_c(context)}, 0)')
                     context.end_compound()
                     return temp_name
                 elif f.raw == 'do':
                     if len(self.arguments) > 0 and not isinstance(self.arguments[0], FVariadicValue):
                         temp_var = context.temp_var()
-                        context.push_simple(f"{t_object} {temp_var} = call({self.arguments[0].to_c(context)}, "
-                                            f"{FList(self.arguments[1:]).to_c(context)})")
+                        context.push_simple(f"{t_object} {temp_var} = "
+                                            f"{_call_v(self.arguments[0].to_c(context), self.arguments[1:], context)}")
                         return temp_var
+                elif f.raw == 'while':
+                    if len(self.arguments) == 2 and all(_is_inlinable(a, 0) for a in self.arguments):
+                        return self._loop(context, *self.arguments, negate=False, body_first=False)
+                elif f.raw == 'foreach':
+                    if len(self.arguments) > 1 and _is_inlinable(self.arguments[0], len(self.arguments) - 1) \
+                            and not any(isinstance(a, FVariadicValue) for a in self.arguments[1:]):
+                        return self._foreach(context, self.arguments[0], self.arguments[1:])
+                elif f.raw == 'import':
+                    imported = _imported(self, context.imports)
+                    if imported is not None:
+                        return self._import(context, *imported)
+            elif f.is_prelude:
+                if f.raw == 'until':
+                    if len(self.arguments) == 2 and all(_is_inlinable(a, 0) for a in self.arguments):
+                        return self._loop(context, *self.arguments, negate=True, body_first=False)
+                elif f.raw == 'repeat':
+                    if len(self.arguments) == 3 and _is_inlinable(self.arguments[0], 0) \
+                            and _is_inlinable(self.arguments[2], 0):
+                        action, conditional, condition = self.arguments
+                        if _resolves_to(conditional, 'while', builtin=True):
+                            return self._loop(context, condition, action, negate=False, body_first=True)
+                        elif _resolves_to(conditional, 'until', builtin=False):
+                            return self._loop(context, condition, action, negate=True, body_first=True)
         temp_var = context.temp_var()
-        context.push_simple(f"{t_object} {temp_var} = call({f}, {FList(self.arguments).to_c(context)})")
+        context.push_simple(f"{t_object} {temp_var} = {_call_v(f, self.arguments, context)}")
         return temp_var
 
+    @staticmethod
+    def _inline(context, block: FCodeBlock, arguments: Tuple[str, ...] = ()):
+        block.inner_scope.make_inline()
+        for n, a in zip(block.parameters, arguments):
+            context.push_simple(f"{block.inner_scope.lookup(n)} = {a}")
+        return block.value.to_c(context)
+
+    def _import(self, context, module: str, exports: Dict[str, str]):
+        # Runs the module (once), then copies its definitions to the variables the walk defined for them
+        context.push_simple(f"{module}()")
+        for name, variable in exports.items():
+            context.push_simple(f"{self.scope.lookup(name)} = {variable}")
+        return "none_object"
+
+    def _if_else(self, context, condition: FValue, action: FCodeBlock, otherwise: FCodeBlock):
+        condition = condition.to_c(context)
+        temp_name = context.temp_var()
+        context.push_simple(f'{t_object} {temp_name} = NULL')  # a line without `=` would be dropped
+        context.start_compound(f'if(truthy({condition}))', '')
+        context.push_simple(f'{temp_name} = {self._inline(context, action)}')
+        context.end_compound()
+        context.start_compound('else', '')
+        context.push_simple(f'{temp_name} = {self._inline(context, otherwise)}')
+        context.end_compound()
+        return temp_name
+
+    def _loop(self, context, condition: FCodeBlock, body: FCodeBlock, negate: bool, body_first: bool):
+        context.start_compound('while (1)', '')
+        if body_first:
+            context.push_simple(str(self._inline(context, body)))
+        condition = self._inline(context, condition)
+        context.push_simple(f"if ({'' if negate else '!'}truthy({condition})) break")
+        if not body_first:
+            context.push_simple(str(self._inline(context, body)))
+        context.end_compound()
+        return "none_object"
+
+    def _foreach(self, context, block: FCodeBlock, lists: Tuple[FValue, ...]):
+        names = []
+        for l in lists:
+            temp_var = context.temp_var()
+            context.push_simple(f"{t_object} {temp_var} = {l.to_c(context)}")
+            context.push_simple(f"_check_type({temp_var}, LIST)")
+            names.append(temp_var)
+        for n in names[1:]:
+            context.push_simple(f'if ({n}->list.count != {names[0]}->list.count) '
+                                f'errorf("List of uneven length in foreach")')
+        index = context.temp_var()
+        context.start_compound(f'for (size_t {index} = 0; {index} < {names[0]}->list.count; {index}++)', '')
+        context.push_simple(str(self._inline(context, block, tuple(f"{n}->list.elements[{index}]" for n in names))))
+        context.end_compound()
+        return "none_object"
+
+
+def _call_v(func, arguments: Tuple[FValue, ...], context) -> str:
+    # The argument list is allocated in the runtime's argument arena, see `call_v`
+    return f"call_v({', '.join(str(v) for v in (func, len(arguments), *(a.to_c(context) for a in arguments)))})"
+
+
+def _is_inlinable(value: FValue, parameter_count: int) -> bool:
+    return (isinstance(value, FCodeBlock) and value.variadic_parameter is None
+            and len(value.parameters) == parameter_count)
+
+
+def _branch(call: FCall) -> Optional[Tuple[FValue, FCodeBlock, FCodeBlock]]:
+    # `(either condition [a] [b]) ()`, which is what `if` and `else` of stdlib.f become when they are inlined
+    either = call.func
+    if call.arguments or not isinstance(either, FCall) or not _resolves_to(either.func, 'either', builtin=True) \
+            or len(either.arguments) != 3:
+        return None
+    condition, action, otherwise = either.arguments
+    if isinstance(condition, (FCodeBlock, FVariadicValue)) or not (_is_inlinable(action, 0)
+                                                                    and _is_inlinable(otherwise, 0)):
+        return None
+    return condition, action, otherwise
+
+
+def _imported(call: FCall, imports: Dict[str, Tuple[str, Dict[str, str]]]) -> Optional[Tuple[str, Dict[str, str]]]:
+    # C name and exports of the module, if the call is an import `f.ir.modules` resolved
+    if isinstance(call.func, FName) and call.func.name == 'import' and len(call.arguments) == 1 \
+            and isinstance(call.arguments[0], FString):
+        return imports.get(call.arguments[0].data)
+    return None
+
+
+def _resolves_to(value: FValue, name: str, builtin: bool) -> bool:
+    if not isinstance(value, FName) or value.name != name:
+        return False
+    n = value.scope.lookup(name)
+    return n.is_builtin if builtin else n.is_prelude
+
 
 @dataclass
 class FVariadicValue(FValue):
@@ -114,6 +255,10 @@ class FCodeBlock(FValue):
     variadic_parameter: Tuple[int, str] = None
     scope: Scope = None
     inner_scope: Scope = None
+    function_name: str = None  # Name of the generated C function, set by to_c
+    escapes: bool = True  # Might outlive the C function creating it, see `_mark_escapes`
+    name: str = None  # of the variable it is assigned to
+    native_name: str = None  # of the C function on doubles, see `numeric.py`
 
     def _pretty(self, indent: str):
         yield f"{type(self).__name__}:"
@@ -127,29 +272,47 @@ class FCodeBlock(FValue):
             yield f"{indent * 2}Used: {self.inner_scope.used!r}"
             yield f"{indent * 2}Defined: {self.inner_scope.defined!r}"
 
+    @_located
     def to_c(self, context):
-        name = context.start_function(self.inner_scope)
-        if self.variadic_parameter is not None:
+        if self.native_name is not None:
+            numeric.emit_function(self, context)
+        name = self.function_name = context.start_function(self.inner_scope, self.name, self.location)
+        if self.native_name is not None:
+            if self.parameters:
+                context.push_simple(f"_check_length(args, {len(self.parameters)})")
+            context.push_simple(numeric.unboxed_call(self))
+        elif self.variadic_parameter is not None:
+            context.push_simple(f"_check_length_min(args, {len(self.parameters)})")
             for i, n in enumerate(self.parameters[:self.variadic_parameter[0]]):
                 context.push_simple(f"self.{n} = args->list.elements[{i}]")
             pre = self.variadic_parameter[0]
             post = len(self.parameters) - pre
             context.push_simple(f"self.{self.variadic_parameter[1]} = sublist(args, {pre}, args->list.count - {post})")
             for i, n in enumerate(self.parameters[self.variadic_parameter[0]:][::-1]):
-                context.push_simple(f"self.{n} = args->list.elements[args.list.count - {i + 1}]")
+                context.push_simple(f"self.{n} = args->list.elements[args->list.count - {i + 1}]")
         else:
+            if self.parameters:
+                context.push_simple(f"_check_length(args, {len(self.parameters)})")
             for i, n in enumerate(self.parameters):
                 context.push_simple(f"self.{n} = args->list.elements[{i}]")
-        context.push_simple(f"return {self.value.to_c(context)}")
+        if self.native_name is None:
+            context.push_simple(f"return {self.value.to_c(context)}")
         context.end_function()
         if self.inner_scope.outer:
             outer_vars = ', '.join(f'.{self.scope.lookup(n).name} = {self.scope.lookup(n)}'
                                    for n in self.inner_scope.outer)
             temp = context.temp_var()
             context.push_simple(f"struct _outer_{name} {temp} = {{{outer_vars}}};")
-            return f"callable(copied(&{temp}, sizeof({temp})), ({t_function}) {name})"
+            environment = f"copied(&{temp}, sizeof({temp}))" if self.escapes else f"&{temp}"
         else:
-            return f"callable(NULL, ({t_function}) {name})"
+            environment = "NULL"
+        if self.escapes:
+            return f"callable({environment}, ({t_function}) {name})"
+        # Only used during the call it is passed to, so the environment and the object can stay on the stack
+        temp = context.temp_var()
+        context.push_simple(f"struct object {temp} = "
+                            f"{{.type=CALLABLE, .callable={{{environment}, ({t_function}) {name}}}}}")
+        return f"(&{temp})"
 
 
 @dataclass
@@ -161,6 +324,7 @@ class FList(FValue):
         for i, v in enumerate(self.values):
             yield from (indent + line for line in v._pretty(indent))
 
+    @_located
     def to_c(self, context):
         if not self.values:
             return "list(0)"
@@ -170,6 +334,9 @@ class FList(FValue):
 @dataclass
 class FModule(FAST):
     statements: Tuple[FValue, ...]
+    prelude: Tuple[FValue, ...] = ()  # stdlib statements, their definitions can be inlined
+    # Path -> C name and exports (F name -> C global) of the modules it imports, see `ModuleFunction`
+    imports: Dict[str, Tuple[str, Dict[str, str]]] = field(default_factory=dict)
 
     def _pretty(self, indent: str):
         yield f"{type(self).__name__}:"
@@ -179,15 +346,29 @@ class FModule(FAST):
     def to_c(self, context):
         raise TypeError
 
-    def generate_c(self):
-        context = CompilerContext()
+    def generate_c(self) -> str:
+        return self.build_c().to_c()
+
+    def build_c(self, module: str = None) -> CBuilder:
+        # `module` is the C name for a module that gets imported, it is compiled to an object of its own
+        context = CompilerContext(imports=self.imports)
         _walk_ast(context, self)
-        cc = CBuilder()
-        cc.target_stack[0].scope = self.scope
-        for s in self.statements:
-            cc.push_simple(s.to_c(cc))
+        _mark_escapes(self)
+        numeric.infer_types(self)
+        cc = CBuilder(module=module, imports=self.imports)
+        if module is None:
+            cc.target_stack[0].scope = self.scope
+        else:
+            # stdlib.f is part of every module, only the definitions of the module itself are exported
+            exports = {name: f"{module}__{_identifier(name)}"
+                       for name in self.scope.defined if name not in self.scope.prelude}
+            cc.target_stack[0] = ModuleFunction(module, [], self.scope, exports=exports)
+        *statements, last = (*self.prelude, *self.statements)
+        for s in statements:
+            cc.push_simple(str(s.to_c(cc)))
+        cc.push_simple(f"module_result = {last.to_c(cc)}" if module is None else str(last.to_c(cc)))
         cc.end_function()
-        return cc.to_c()
+        return cc
 
 
 @dataclass
@@ -201,9 +382,14 @@ class FAssignment(FValue):
         yield f"{indent}Value:"
         yield from (indent * 2 + line for line in self.value._pretty(indent))
 
+    @_located
     def to_c(self, context: CBuilder):
         v = self.scope.lookup(self.name)
         context.push_simple(f"{v} = {self.value.to_c(context)}")
+        if isinstance(self.value, FCodeBlock) and self.name in self.value.inner_scope.outer:
+            # The closure captured the variable before it got assigned, so it has to be patched for recursion
+            name = self.value.inner_scope.lookup(self.name).name
+            context.push_simple(f"((struct _outer_{self.value.function_name}*) {v}->callable.self)->{name} = {v}")
         return v
 
 
@@ -234,11 +420,13 @@ class NamedReference:
     raw: str
     is_builtin: bool  # Could not be resolved, is never defined
     is_local: bool  # Was defined on the same level
+    mangle: str = ''  # Suffix for variables of inlined code blocks
+    is_prelude: bool = False  # Is a stdlib definition, that can't be redefined
 
     @property
     def name(self):
         assert self.raw not in _operators
-        return self.raw + "_" if self.raw in _keywords else self.raw
+        return (self.raw + "_" if self.raw in _keywords else self.raw) + self.mangle
 
     def __str__(self):
         assert not self.raw.startswith('...')
@@ -261,26 +449,51 @@ class Scope:
     used: Set[str] = field(default_factory=set)
     defined: Dict[str, int] = field(default_factory=dict)
     parent: Scope = None
+    prelude: Set[str] = field(default_factory=set)
+    inline: bool = False  # The code block is emitted directly into the function of the parent scope
+    mangle: str = ''
+    inlined: List[Scope] = field(default_factory=list)
 
     def lookup(self, name: str) -> NamedReference:
         # assert name in self.used, (name, self.used)
         if name in self.defined:
-            return NamedReference(name, False, True)
+            return NamedReference(name, False, True, self.mangle, name in self.prelude)
         elif self.parent is None:
             return NamedReference(name, True, False)
         else:
             n = self.parent.lookup(name)
-            n.is_local = False
+            if not self.inline:
+                n.is_local = False
             return n
 
+    def make_inline(self):
+        assert self.parent is not None
+        if not self.inline:
+            self.inline = True
+            function_scope = self.function_scope
+            self.mangle = f"__{len(function_scope.inlined)}"
+            function_scope.inlined.append(self)
+
+    @property
+    def function_scope(self) -> Scope:
+        scope = self
+        while scope.inline:
+            scope = scope.parent
+        return scope
+
     @property
-    def outer(self):
-        return {n for n in self.used if self.lookup(n).is_outer}
+    def outer(self) -> List[str]:
+        return sorted(n for n in self.used if self.lookup(n).is_outer)  # sorted, so that the output is reproducible
+
+    @property
+    def locals(self) -> List[NamedReference]:
+        return [s.lookup(n) for s in (self, *self.inlined) for n in s.defined]
 
 
 @dataclass
 class CompilerContext:
     current_scope: Scope = field(default_factory=Scope)
+    imports: Dict[str, Tuple[str, Dict[str, str]]] = field(default_factory=dict)  # see `FModule.imports`
 
     def add_scope(self) -> Scope:
         self.current_scope = Scope(parent=self.current_scope)
@@ -323,10 +536,19 @@ def _walk_ast(cc: CompilerContext, ast: FAST):
     elif isinstance(ast, FCall):
         for c in (ast.func, *ast.arguments):
             _walk_ast(cc, c)
+        imported = _imported(ast, cc.imports)
+        if imported is not None:
+            # Modules imported twice on the way (`a` and `b` both import `c`) export the same names
+            for name in imported[1]:
+                if name not in cc.current_scope.defined:
+                    cc.variable_defined(name)
     elif isinstance(ast, (FString, FNumber)):
         pass
     elif isinstance(ast, FModule):
         assert cc.current_scope.parent is None
+        for s in ast.prelude:
+            _walk_ast(cc, s)
+        cc.current_scope.prelude.update(cc.current_scope.defined)
         for s in ast.statements:
             _walk_ast(cc, s)
     elif isinstance(ast, FVariadicValue):
@@ -335,4 +557,53 @@ def _walk_ast(cc: CompilerContext, ast: FAST):
         raise ValueError(ast)
 
 
-from f.c_compiler.c_compiler import CBuilder, t_object, t_function
+# Arguments the callee only calls while it runs and never stores or returns. Code blocks passed there don't escape
+_borrowing_builtins = {'do': {0}, 'while': {0, 1}, 'foreach': {0}}
+# `else` and `if` call one of their arguments with the ones after it, which may store or return those
+_borrowing_prelude = {'until': {0, 1}, 'if': {0, 1, 2}, 'else': {0}}
+
+
+def _borrowed(call: FCall) -> Set[int]:
+    if not isinstance(call.func, FName):
+        return set()
+    if any(isinstance(a, FVariadicValue) for a in call.arguments):
+        return set()  # positions are unknown
+    n = call.func.scope.lookup(call.func.name)
+    if n.is_builtin:
+        positions = _borrowing_builtins.get(n.raw, set())
+    elif n.is_prelude and n.raw in _borrowing_prelude:
+        positions = _borrowing_prelude[n.raw]
+    elif n.is_prelude and n.raw == 'repeat' and len(call.arguments) > 1 \
+            and (_resolves_to(call.arguments[1], 'while', True) or _resolves_to(call.arguments[1], 'until', False)):
+        positions = {0, *range(2, len(call.arguments))}  # action and condition are passed on to the loop
+    else:
+        positions = set()
+    return {i for i in positions if i < len(call.arguments)}
+
+
+def _mark_escapes(ast: FAST):
+    # Needs the complete scopes, so it runs after `_walk_ast`
+    if isinstance(ast, FCall):
+        if isinstance(ast.func, FCodeBlock):
+            ast.func.escapes = False  # called right away
+        for i in _borrowed(ast):
+            if isinstance(ast.arguments[i], FCodeBlock):
+                ast.arguments[i].escapes = False
+        branch = _branch(ast)
+        if branch is not None:
+            branch[1].escapes = branch[2].escapes = False  # only one of them is called, right away
+        for c in (ast.func, *ast.arguments):
+            _mark_escapes(c)
+    elif isinstance(ast, (FAssignment, FCodeBlock, FVariadicValue)):
+        _mark_escapes(ast.value)
+    elif isinstance(ast, FList):
+        for v in ast.values:
+            _mark_escapes(v)
+    elif isinstance(ast, FModule):
+        for s in (*ast.prelude, *ast.statements):
+            _mark_escapes(s)
+
+
+from f.c_compiler.c_compiler import CBuilder, ModuleFunction, t_object, t_function, _identifier
+from f.c_compiler import numeric
+from f.c_compiler.numeric import NUMBER
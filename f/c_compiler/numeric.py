@@ -0,0 +1,380 @@
+from __future__ import annotations
+
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from f.c_compiler.fast import (FAST, FAssignment, FCall, FCodeBlock, FList, FModule, FName, FNumber, FValue,
+                               FVariadicValue, Scope, _is_inlinable, _resolves_to, _branch)
+
+# Type inference for the C backend. Every value in the generated C is a boxed `f_object`, unless it is proven to be
+# a number:
+#
+#  * Known functions, code blocks assigned to a variable that is only ever called directly (with as many
+#    arguments as they have parameters), get the types of their parameters from their call sites and the type of
+#    their result from their body.
+#  * If both are numbers and the body only consists of arithmetic, comparisons, `not`, `either`, `if`/`else`
+#    chains, `;`, assignments and calls of such functions, the function is compiled a second time to a C function
+#    on `double`s (`n00000000_fib`). Its calls don't allocate anything. The boxed function unpacks its arguments
+#    and calls it, for the calls that can't be resolved at compile time.
+#  * In boxed code, such expressions are computed on `double`s and boxed once. Variables proven to hold numbers
+#    are read without type checks.
+#
+# Booleans are numbers in F (`true` is 1), so `NUMBER` covers both. `value_type` of a FAST node is `NUMBER` or
+# `ANY`, `None` while nothing is known.
+
+NUMBER = 'number'
+ANY = 'any'
+
+Key = Tuple[int, str]  # id of the defining scope and name of a variable
+
+_minimum_arguments = {'+': 1, '-': 1, '*': 1, '/': 1}
+_exact_arguments = {'**': 2, '>': 2, '>=': 2, '<': 2, '<=': 2, '=': 2, '!=': 2, 'not': 1, 'either': 3}
+# Same results as `cmp` in f_runtime.c, NaN included
+_comparisons = {'>': '{} > {}', '>=': '{} >= {}', '<': '!({} >= {})', '<=': '!({} > {})', '=': '{} == {}',
+                '!=': '{} != {}'}
+
+
+def infer_types(module: FModule):
+    # Needs the scopes, so it runs after `_walk_ast`
+    inference = _Inference(module)
+    inference.run()
+    inference.select_native()
+
+
+class _Inference:
+    def __init__(self, module: FModule):
+        self.module = module
+        self.variables: Dict[Key, Optional[str]] = {}
+        self.results: Dict[Key, Optional[str]] = {}
+        self.known: Dict[Key, FCodeBlock] = _known_functions(module)
+        self.known_keys = {id(block): key for key, block in self.known.items()}
+        self.changed = False
+        # Parameters of all other code blocks can get anything
+        for node in _nodes(module):
+            if isinstance(node, FCodeBlock) and id(node) not in self.known_keys:
+                for p in node.parameters:
+                    self.variables[id(node.inner_scope), p] = ANY
+                if node.variadic_parameter is not None:
+                    self.variables[id(node.inner_scope), node.variadic_parameter[1]] = ANY
+
+    def run(self):
+        # The types only ever go up from None to NUMBER to ANY, so this ends after a few rounds
+        self.changed = True
+        while self.changed:
+            self.changed = False
+            for s in (*self.module.prelude, *self.module.statements):
+                self._type(s)
+
+    def select_native(self):
+        candidates = {key: block for key, block in self.known.items()
+                      if self.results.get(key) == NUMBER
+                      and all(self.variables.get((id(block.inner_scope), p)) == NUMBER for p in block.parameters)}
+        for call in (n for n in _nodes(self.module) if isinstance(n, FCall) and isinstance(n.func, FName)):
+            call.callee = candidates.get(_key(call.func.scope, call.func.name))
+        # Functions calling functions that can't be compiled natively can't be either
+        rejected = True
+        while rejected:
+            rejected = [key for key, block in candidates.items() if not _expressible(block.value, block, lazy=True)]
+            for key in rejected:
+                block = candidates.pop(key)
+                for call in (n for n in _nodes(self.module) if isinstance(n, FCall) and n.callee is block):
+                    call.callee = None
+        for i, block in enumerate(candidates.values()):
+            block.native_name = f"n{i:08X}_{_identifier(block.name)}"
+
+    def _update(self, table: Dict[Key, Optional[str]], key: Key, value_type: Optional[str]):
+        new = _join(table.get(key), value_type)
+        if new != table.get(key):
+            table[key] = new
+            self.changed = True
+
+    def _type(self, node: FAST) -> Optional[str]:
+        node.value_type = result = self._infer(node)
+        return result
+
+    def _infer(self, node: FAST) -> Optional[str]:
+        if isinstance(node, FNumber):
+            return NUMBER
+        elif isinstance(node, FName):
+            key = _key(node.scope, node.name)
+            if key is None:
+                return NUMBER if node.name in ('true', 'false') else ANY
+            return self.variables.get(key)
+        elif isinstance(node, FAssignment):
+            value_type = self._type(node.value)
+            self._update(self.variables, _key(node.scope, node.name), value_type)
+            return value_type
+        elif isinstance(node, FCodeBlock):
+            value_type = self._type(node.value)
+            if id(node) in self.known_keys:
+                self._update(self.results, self.known_keys[id(node)], value_type)
+            return ANY
+        elif isinstance(node, FCall):
+            argument_types = [self._type(a) for a in (node.func, *node.arguments)][1:]
+            chain = _if_chain(node)
+            if chain is not None:
+                branches, otherwise = chain
+                return _join_all(*(action.value.value_type for _, action in branches), otherwise.value.value_type)
+            operator = _operator(node)
+            if operator == 'either':
+                return _join_all(*argument_types[1:])
+            elif operator == ';':
+                return argument_types[-1]
+            elif operator == '+':
+                return _join_all(NUMBER, *argument_types)  # or strings
+            elif operator is not None:
+                return NUMBER  # the other operators fail for anything else
+            if isinstance(node.func, FName):
+                key = _key(node.func.scope, node.func.name)
+                block = self.known.get(key)
+                if block is not None:
+                    for p, value_type in zip(block.parameters, argument_types):
+                        self._update(self.variables, (id(block.inner_scope), p), value_type)
+                    return self.results.get(key)
+            return ANY
+        for c in _children(node):
+            self._type(c)
+        return ANY
+
+
+def _join(a: Optional[str], b: Optional[str]) -> Optional[str]:
+    if a is None:
+        return b
+    if b is None or a == b:
+        return a
+    return ANY
+
+
+def _join_all(*types: Optional[str]) -> Optional[str]:
+    result = None
+    for t in types:
+        result = _join(result, t)
+    return result
+
+
+def _children(node: FAST) -> Tuple[FAST, ...]:
+    if isinstance(node, FCall):
+        return (node.func, *node.arguments)
+    elif isinstance(node, (FAssignment, FCodeBlock, FVariadicValue)):
+        return node.value,
+    elif isinstance(node, FList):
+        return node.values
+    elif isinstance(node, FModule):
+        return (*node.prelude, *node.statements)
+    return ()
+
+
+def _nodes(node: FAST) -> Iterator[FAST]:
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        yield node
+        pending.extend(reversed(_children(node)))
+
+
+def _defining_scope(scope: Scope, name: str) -> Optional[Scope]:
+    while scope is not None:
+        if name in scope.defined:
+            return scope
+        scope = scope.parent
+    return None
+
+
+def _key(scope: Scope, name: str) -> Optional[Key]:
+    definition = _defining_scope(scope, name)
+    return None if definition is None else (id(definition), name)
+
+
+def _known_functions(module: FModule) -> Dict[Key, FCodeBlock]:
+    # Code blocks assigned to variables that are used for nothing but direct calls with the right number of
+    # arguments. Their parameters can only get the values of these calls
+    functions = {}
+    for node in _nodes(module):
+        if isinstance(node, FAssignment) and isinstance(node.value, FCodeBlock) \
+                and node.value.variadic_parameter is None:
+            functions[_key(node.scope, node.name)] = node.value
+    callees = {id(n.func): n for n in _nodes(module) if isinstance(n, FCall) and isinstance(n.func, FName)}
+    for node in _nodes(module):
+        if isinstance(node, FName):
+            key = _key(node.scope, node.name)
+            block = functions.get(key)
+            if block is None:
+                continue
+            call = callees.get(id(node))
+            if call is None or len(call.arguments) != len(block.parameters) \
+                    or any(isinstance(a, FVariadicValue) for a in call.arguments):
+                del functions[key]
+    return functions
+
+
+def _operator(call: FCall) -> Optional[str]:
+    # Builtins `_emit` can compute on doubles, if the number of arguments is right
+    if not isinstance(call.func, FName) or not call.func.scope.lookup(call.func.name).is_builtin:
+        return None
+    name, count = call.func.name, len(call.arguments)
+    if any(isinstance(a, FVariadicValue) for a in call.arguments):
+        return None
+    if (name in _minimum_arguments and count >= _minimum_arguments[name]) or _exact_arguments.get(name) == count \
+            or (name == ';' and count > 0):
+        return name
+    return None
+
+
+def _if_chain(call: FCall) -> Optional[Tuple[List[Tuple[FValue, FCodeBlock]], FCodeBlock]]:
+    # `if [a] [b] else if [c] [d] else [e]` of stdlib.f, with code blocks without parameters or definitions. Inlined
+    # it is `(either a [b] [...]) ()`, a chain with one branch and a condition that is a value instead of a block
+    branch = _branch(call)
+    if branch is not None:
+        condition, action, otherwise = branch
+        if action.inner_scope.defined or otherwise.inner_scope.defined:
+            return None
+        return [(condition, action)], otherwise
+    if not _resolves_to(call.func, 'if', builtin=False):
+        return None
+    arguments = call.arguments
+    branches = []
+    while True:
+        if len(arguments) < 4 or not all(_is_inlinable(a, 0) for a in arguments[:2]) \
+                or not _resolves_to(arguments[2], 'else', builtin=False):
+            return None
+        branches.append((arguments[0], arguments[1]))
+        rest = arguments[3:]
+        if len(rest) == 1 and _is_inlinable(rest[0], 0):
+            blocks = (*(b for branch in branches for b in branch), rest[0])
+            if any(b.inner_scope.defined for b in blocks):
+                return None
+            return branches, rest[0]
+        if not rest or not _resolves_to(rest[0], 'if', builtin=False):
+            return None
+        arguments = rest[1:]
+
+
+def _expressible(node: FValue, native: Optional[FCodeBlock], lazy: bool) -> bool:
+    # Whether `_emit` can compute `node` on doubles. `native` is the function compiled natively, None in boxed code.
+    # In boxed code numbers that need statements to be computed are unboxed, unless the expression is `lazy`
+    if node.value_type != NUMBER:
+        return False
+    if isinstance(node, FNumber):
+        return True
+    elif isinstance(node, FName):
+        definition = _defining_scope(node.scope, node.name)
+        if definition is None:
+            return node.name in ('true', 'false')
+        return native is None or definition is native.inner_scope
+    elif isinstance(node, FAssignment):
+        return native is not None and node.scope is native.inner_scope and _expressible(node.value, native, lazy)
+    elif isinstance(node, FCall):
+        chain = _if_chain(node)
+        if chain is not None:
+            branches, otherwise = chain
+            return all(_expressible(_part(b), native, True) for b in (*(b for br in branches for b in br), otherwise))
+        operator = _operator(node)
+        if operator == ';' and native is None:
+            return False
+        if operator is None and node.callee is None:
+            return False
+        return all(_expressible(a, native, lazy) or (native is None and not lazy and a.value_type == NUMBER)
+                   for a in node.arguments)
+    return False
+
+
+def _emit(node: FValue, context: CBuilder, native: Optional[FCodeBlock]) -> str:
+    # C expression of type double, `_expressible` has to be true
+    if isinstance(node, FNumber):
+        return repr(node.data)
+    elif isinstance(node, FName):
+        if _defining_scope(node.scope, node.name) is None:
+            return '1.0' if node.name == 'true' else '0.0'
+        elif native is not None:
+            return _variable(node.name)
+        return f"{node.scope.lookup(node.name)}->number"
+    elif isinstance(node, FAssignment):
+        return f"({_variable(node.name)} = {_emit(node.value, context, native)})"
+    chain = _if_chain(node)
+    if chain is not None:
+        branches, otherwise = chain
+        out = _block(otherwise, context, native)
+        for condition, action in reversed(branches):
+            condition = _block(condition, context, native) if isinstance(condition, FCodeBlock) \
+                else _emit(condition, context, native)
+            out = (f"({condition} != 0 ? {_block(action, context, native)} "
+                   f": {out})")
+        return out
+    arguments = [_operand(a, context, native) for a in node.arguments]
+    if node.callee is not None:
+        return f"{node.callee.native_name}({', '.join(arguments)})"
+    operator = _operator(node)
+    if operator == '+':
+        return f"(0.0 + {' + '.join(arguments)})"  # like the runtime, so -0.0 + -0.0 is 0.0
+    elif operator in ('-', '*', '/'):
+        return f"({f' {operator} '.join(arguments)})"
+    elif operator == '**':
+        return f"pow({arguments[0]}, {arguments[1]})"
+    elif operator in _comparisons:
+        return f"((double) ({_comparisons[operator].format(*arguments)}))"
+    elif operator == 'not':
+        return f"((double) ({arguments[0]} == 0))"
+    elif operator == ';':
+        return f"({', '.join(arguments)})"
+    elif operator == 'either':
+        # All three are evaluated, like the arguments of every call
+        temps = [context.temp_var() for _ in arguments]
+        for t in temps:
+            context.push_simple(f"double {t} = 0")
+        assigned = ', '.join(f"{t} = {a}" for t, a in zip(temps, arguments))
+        return f"({assigned}, {temps[0]} != 0 ? {temps[1]} : {temps[2]})"
+    raise AssertionError(node)
+
+
+def _operand(node: FValue, context: CBuilder, native: Optional[FCodeBlock]) -> str:
+    if native is None and not _expressible(node, None, lazy=True):
+        return f"{node.to_c(context)}->number"  # boxed code that is known to result in a number
+    return _emit(node, context, native)
+
+
+def _block(block: FCodeBlock, context: CBuilder, native: Optional[FCodeBlock]) -> str:
+    if native is None:
+        block.inner_scope.make_inline()  # its names are looked up in the enclosing C function
+    return _emit(block.value, context, native)
+
+
+def _part(node: FValue) -> FValue:
+    # Of an if chain: the value of a code block, or a condition that is a value already
+    return node.value if isinstance(node, FCodeBlock) else node
+
+
+def _variable(name: str) -> str:
+    return f"v_{_identifier(name)}"
+
+
+def box(call: FCall, context: CBuilder) -> Optional[str]:
+    # For calls in boxed code: computes a numeric expression on doubles and boxes the result
+    if not _expressible(call, None, lazy=False) or (_operator(call) is None and call.callee is None
+                                                    and _if_chain(call) is None):
+        return None
+    expression = _emit(call, context, None)
+    temp = context.temp_var()
+    if _operator(call) in (*_comparisons, 'not'):
+        context.push_simple(f"{t_object} {temp} = {expression} ? true_object : false_object")
+    else:
+        context.push_simple(f"{t_object} {temp} = number({expression})")
+    return temp
+
+
+def emit_function(block: FCodeBlock, context: CBuilder):
+    # The native version of a function `infer_types` gave a `native_name`
+    parameters = ', '.join(f"double {_variable(p)}" for p in block.parameters)
+    context.start_native_function(block.native_name, parameters, block.name, block.location)
+    for name in block.inner_scope.defined:
+        if name not in block.parameters:
+            context.push_simple(f"double {_variable(name)} = 0")
+    context.push_simple(f"return {_emit(block.value, context, block)}")
+    context.end_function()
+
+
+def unboxed_call(block: FCodeBlock) -> str:
+    # Body of the boxed function of a natively compiled one
+    arguments = ', '.join(f"unbox_number(args->list.elements[{i}])" for i in range(len(block.parameters)))
+    return f"return number({block.native_name}({arguments}))"
+
+
+from f.c_compiler.c_compiler import CBuilder, t_object, _identifier
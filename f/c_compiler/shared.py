@@ -0,0 +1,174 @@
+import ctypes
+import io
+import os
+import sys
+from enum import IntEnum
+from pathlib import Path
+from tempfile import TemporaryDirectory, TemporaryFile
+from typing import Sequence, Dict, Tuple
+
+from f.c_compiler import f_compile
+from f.util.timings import phase
+from general_c_compiler import CompilationOptions
+
+
+class SharedProgram:
+    # A C compiled F program, loaded as shared library into this process. Can be called any number of times.
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._library = ctypes.CDLL(str(path))
+        self._run = self._library.f_run
+        self._run.argtypes = (ctypes.c_int, ctypes.POINTER(ctypes.c_char_p))
+        self._run.restype = ctypes.c_int
+        for name, restype, argtypes in _ffi_functions:
+            function = getattr(self._library, name)
+            function.restype = restype
+            function.argtypes = argtypes
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.path}>"
+
+    def __call__(self, argv: Sequence[str] = (), program_name: str = 'f') -> int:
+        args = [a.encode() for a in (program_name, *argv)]
+        c_argv = (ctypes.c_char_p * len(args))(*args)
+        sys.stdout.flush()
+        try:
+            passthrough = sys.stdout.fileno() == 1
+        except (AttributeError, io.UnsupportedOperation):
+            passthrough = False
+        if passthrough:
+            return self._run(len(args), c_argv)
+        # sys.stdout got replaced (e.g. captured), so catch what C writes to fd 1 and forward it
+        with TemporaryFile() as capture:
+            saved = os.dup(1)
+            os.dup2(capture.fileno(), 1)
+            try:
+                result = self._run(len(args), c_argv)
+            finally:
+                os.dup2(saved, 1)
+                os.close(saved)
+            capture.seek(0)
+            sys.stdout.write(capture.read().decode(errors='replace'))
+        return result
+
+    @property
+    def result(self):
+        # Value of the last statement of the last run
+        return self.from_native(ctypes.c_void_p.in_dll(self._library, 'module_result').value)
+
+    def _global(self, name: str) -> int:
+        return ctypes.c_void_p.in_dll(self._library, name).value
+
+    def to_native(self, value) -> int:
+        lib = self._library
+        if value is None:
+            return self._global('none_object')
+        elif value is True:
+            return self._global('true_object')
+        elif value is False:
+            return self._global('false_object')
+        elif isinstance(value, (int, float)):
+            return lib.number(float(value))
+        elif isinstance(value, str):
+            return lib.ffi_new_string(value.encode())
+        elif isinstance(value, (list, tuple)):
+            out = lib.ffi_new_list(len(value))
+            for i, v in enumerate(value):
+                lib.ffi_set_element(out, i, self.to_native(v))
+            return out
+        elif isinstance(value, NativeFunction) and value.program is self:
+            return value.function
+        raise NotConvertible(value)
+
+    def from_native(self, value: int):
+        lib = self._library
+        if value == self._global('true_object'):
+            return True
+        elif value == self._global('false_object'):
+            return False
+        t = _ObjectType(lib.ffi_type(value))
+        if t is _ObjectType.NONE:
+            return None
+        elif t is _ObjectType.NUMBER:
+            return lib.ffi_number(value)
+        elif t is _ObjectType.STRING:
+            return lib.ffi_string(value).decode(errors='replace')
+        elif t is _ObjectType.LIST:
+            return [self.from_native(lib.ffi_element(value, i)) for i in range(lib.ffi_count(value))]
+        elif t is _ObjectType.CALLABLE:
+            return NativeFunction(self, value)
+        raise NotConvertible(t)
+
+    def call(self, function: int, args: Sequence):
+        result = self._library.ffi_call(function, self.to_native(args))
+        if result is None:
+            raise RuntimeError(f"Native function failed (in {self.path})")
+        return self.from_native(result)
+
+
+class NativeFunction:
+    # An F function living in a SharedProgram. Arguments and results are converted on every call
+
+    def __init__(self, program: SharedProgram, function: int):
+        self.program = program
+        self.function = function
+
+    def __repr__(self):
+        return f"<{type(self).__name__} at {self.function:#x} in {self.program.path}>"
+
+    def __call__(self, *args):
+        return self.program.call(self.function, args)
+
+
+class NotConvertible(TypeError):
+    pass
+
+
+class _ObjectType(IntEnum):
+    # Has to match `enum OBJECT_TYPE` in f_runtime.h
+    NONE = 0
+    STRING = 1
+    NUMBER = 2
+    LIST = 3
+    CALLABLE = 4
+    _VARIADIC = 5
+    REFERENCE = 6
+    FILE_OBJECT = 7
+
+
+_ffi_functions = (
+    ('number', ctypes.c_void_p, (ctypes.c_double,)),
+    ('ffi_type', ctypes.c_int, (ctypes.c_void_p,)),
+    ('ffi_number', ctypes.c_double, (ctypes.c_void_p,)),
+    ('ffi_string', ctypes.c_char_p, (ctypes.c_void_p,)),
+    ('ffi_count', ctypes.c_size_t, (ctypes.c_void_p,)),
+    ('ffi_element', ctypes.c_void_p, (ctypes.c_void_p, ctypes.c_size_t)),
+    ('ffi_set_element', None, (ctypes.c_void_p, ctypes.c_size_t, ctypes.c_void_p)),
+    ('ffi_new_string', ctypes.c_void_p, (ctypes.c_char_p,)),
+    ('ffi_new_list', ctypes.c_void_p, (ctypes.c_size_t,)),
+    ('ffi_call', ctypes.c_void_p, (ctypes.c_void_p, ctypes.c_void_p)),
+)
+
+_loaded: Dict[Tuple[str, str], SharedProgram] = {}
+
+
+def f_load(source: str, options: CompilationOptions = None, cache: bool = True,
+           file_name: str = "<unknown>") -> SharedProgram:
+    # `file_name` is where imports are looked up relative to
+    key = (source, repr(options), file_name)
+    if key not in _loaded:
+        with TemporaryDirectory(prefix='f_shared_') as directory:
+            # The library stays mapped after the file is deleted
+            _loaded[key] = SharedProgram(f_compile(source, Path(directory, 'program'), options, cache=cache,
+                                                   shared=True, file_name=file_name))
+    return _loaded[key]
+
+
+def f_eval(code: str, argv: Sequence[str] = (), options: CompilationOptions = None, cache: bool = True,
+           debug=0, file_name: str = "<unknown>") -> int:
+    program = f_load(code, options, cache, file_name)
+    if debug:
+        print(program)
+    with phase('execute'):
+        return program(argv)
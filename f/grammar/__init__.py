@@ -1,6 +1,6 @@
 from collections import namedtuple
 from pathlib import Path
-from typing import Tuple
+from typing import Optional, Tuple
 
 import lark
 from lark import Transformer as LarkTransformer
@@ -11,11 +11,16 @@ from f import util
 
 class EOI:
     def process(self, stream):
-        yield from stream
-        yield Token('_EOI', '')
+        last = Token('', '', 0, 1, 1, 1, 1)
+        for last in stream:
+            yield last
+        # Placed right after the last token, for the positions of the trees that end with it
+        yield Token('_EOI', '', last.pos_in_stream + len(last), last.end_line, last.end_column, last.end_line,
+                    last.end_column)
 
 
-f_parser = lark.Lark(open(Path(__file__).with_name("f.grammar")).read(), postlex=EOI(), start="file", lexer="standard")
+f_parser = lark.Lark(open(Path(__file__).with_name("f.grammar")).read(), postlex=EOI(), start="file", lexer="standard",
+                     propagate_positions=True)
 
 
 def parse(text: str) -> lark.Tree:
@@ -23,6 +28,9 @@ def parse(text: str) -> lark.Tree:
 
 
 class BaseFTransformer:
+    # (line, column) in the F source of the node that is being transformed, both starting at 1
+    position: Optional[Tuple[int, int]] = None
+
     def string(self, content: str):
         raise NotImplementedError
 
@@ -152,6 +160,12 @@ class FLarkTransformer(BaseFLarkTransformer):
     def __init__(self, transformer: BaseFTransformer):
         self.transformer = transformer
 
+    def _call_userfunc(self, tree, new_children=None):
+        line = getattr(tree.meta, 'line', None)
+        if line is not None:
+            self.transformer.position = line, tree.meta.column
+        return super()._call_userfunc(tree, new_children)
+
     def ev_string(self, data: str):
         return self.transformer.string(util.unescape_string(data[1:-1]))
 
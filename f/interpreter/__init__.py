@@ -1,13 +1,17 @@
 from __future__ import annotations
 
 from decimal import Decimal
-from typing import Tuple, Callable, Union, Iterable, Dict, Optional
+from typing import AbstractSet, Tuple, Callable, Union, Iterable, Dict, Optional, FrozenSet
 
 import f
-from f.grammar import FLarkTransformer
+from f.ir import File, emit, optimized, modules
+from f.util.output import sink
+from f.util.timings import phase, count_nodes
 
 
 class Frame:
+    imported: FrozenSet[str] = frozenset()  # modules that ran in the frame, see `import_`
+
     def __init__(self, parent: Optional[Frame]):
         self.parent = parent
         self.variables: Dict[str, Value] = {}
@@ -237,10 +241,12 @@ class Name(Value):
 
 class CodeBlock(Value):
     def __init__(self, parameters: Iterable[str, ...], statements: Iterable[Statement, ...],
-                 parent_frame: Frame = None):
+                 parent_frame: Frame = None, name: str = None, location: Tuple[str, int] = None):
         self.parameters = tuple(parameters)
         self.statements = tuple(statements)
         self.parent_frame = parent_frame
+        self.name = name  # of the variable the code block got assigned to
+        self.location = location  # file name and line
 
     def __repr__(self):
         return "(" + ", ".join(self.parameters) + "){" + ";".join(repr(s) for s in self.statements) + "}"
@@ -275,7 +281,7 @@ class CodeBlock(Value):
         for st in self.statements:
             ret = st.execute()
             if implicit_print:
-                print(ret)
+                sink.write(f"{ret}\n")
         if scoped:
             Interpreter.remove_frame()
         return ret
@@ -284,7 +290,7 @@ class CodeBlock(Value):
         if self.parent_frame is not None:
             return self
         else:
-            return self.__class__(self.parameters, self.statements, Interpreter.frames[-1])
+            return self.__class__(self.parameters, self.statements, Interpreter.frames[-1], self.name, self.location)
 
 
 class BuiltinFunction(Value):
@@ -321,6 +327,9 @@ def f_constant(name: str, value: Value):
 
 
 class FInterpreterTransformer(f.BaseFTransformer):
+    def __init__(self, file_name: str = "<unknown>"):
+        self.file_name = file_name
+
     def string(self, content: str):
         return String(content)
 
@@ -334,7 +343,8 @@ class FInterpreterTransformer(f.BaseFTransformer):
         return Call(func, args)
 
     def code_block(self, parameters: Tuple, statements: Tuple, return_value):
-        return CodeBlock(parameters, (*statements, return_value), None)
+        location = (self.file_name, self.position[0]) if self.position is not None else None
+        return CodeBlock(parameters, (*statements, return_value), None, location=location)
 
     def parameter(self, name: str):
         return name
@@ -349,27 +359,71 @@ class FInterpreterTransformer(f.BaseFTransformer):
         return List(content)
 
     def file(self, statements: Tuple):
-        return CodeBlock(('...',), statements)
+        return CodeBlock(('...',), statements, name="<module>", location=(self.file_name, 1))
 
     def assignment(self, name: str, value):
+        if isinstance(value, CodeBlock) and value.name is None:
+            value.name = name
         return Assignment(name, value)
 
 
-def f_compile(data: str, debug=0) -> CodeBlock:
-    tree = f.parse(data)
+def f_compile(data: str, debug=0, file_name: str = "<unknown>", shadowed: AbstractSet[str] = frozenset()) -> CodeBlock:
+    # `shadowed` are variables defined before the code runs, see `f.ir.optimized`
+    with phase('parse') as p:
+        tree = f.parse(data)
+        if p is not None:
+            p.counts['parse tree nodes'] = sum(1 for _ in tree.iter_subtrees())
     if debug > 0:
         from lark.tree import pydot__tree_to_png
         pydot__tree_to_png(tree, 'debug.png')
-    return FLarkTransformer(FInterpreterTransformer()).transform(tree)
-
-
-def f_eval(data: str, argv: Tuple[str, ...] = (), debug=0):
-    code = f_compile(data, debug - 1)
+    with phase('transform') as p:
+        ir = optimized(tree, file_name, shadowed)
+        code = emit(ir, FInterpreterTransformer(file_name))
+        if p is not None:
+            p.counts['interpreter nodes'] = count_nodes(code, Statement)
+    for path, module in modules.load_imports(ir).items():
+        f_compile_module(path, module)
+    return code
+
+
+_modules: Dict[str, Tuple[File, CodeBlock]] = {}
+
+
+def f_compile_module(path: str, module: File = None) -> CodeBlock:
+    # Imported modules are compiled once per process, see `f.ir.modules`. `module` is the IR `load_imports` gave for
+    # the program that imports it, without it the module is run the way it was compiled last
+    if module is None:
+        module = _modules[path][0] if path in _modules else modules.load(path)
+    if path not in _modules or _modules[path][0] is not module:
+        _modules[path] = module, emit(module, FInterpreterTransformer(path))
+    return _modules[path][1]
+
+
+def f_eval(data: str, argv: Tuple[str, ...] = (), debug=0, file_name: str = "<unknown>", image: Frame = None,
+           save_image: str = None):
+    # `image` is a frame loaded with `f.interpreter.image.load`, the program runs below it instead of below stdlib.f.
+    # `save_image` writes the frame of the program to an image once it ran
+    code = f_compile(data, debug - 1, file_name)
     if debug:
         print(code)
-    code.call(tuple(String(s) for s in argv))
+    frame = Frame(image if image is not None else Interpreter.frames[-1])
+    frame.set('...', List(String(s) for s in argv))
+    depth = len(Interpreter.frames)
+    Interpreter.add_frame(frame)
+    try:
+        with phase('execute'):
+            code.call((), scoped=False)
+    finally:
+        del Interpreter.frames[depth:]
+        sink.flush()
+    if save_image is not None:
+        from f.interpreter import image
+
+        with phase('save image'):
+            image.save(save_image, frame)
 
 
 from . import builtins
+from .hooks import on_call, on_return, on_alloc, remove_hook
 
 builtins.finish_init()
@@ -1,9 +1,17 @@
 import operator
+import sys
 from dataclasses import dataclass
+from decimal import Decimal
 from functools import reduce
-from typing import Tuple, IO
+from typing import Tuple, IO, Iterator
 
-from f.interpreter import f_function, Value, CodeBlock, Number, List, Null, f_constant, Interpreter, f_compile, String
+from f.interpreter import f_function, Value, CodeBlock, Number, List, Null, f_constant, Interpreter, String, \
+    f_compile_module, Name, Call, Assignment
+from f.util.files import MappedFile, read_lines, write_lines
+from f.util.output import sink
+from f.ir import PRELUDE_FILE
+from f.util.timings import phase
+from f.util import vectors
 
 
 class Reference(Value):
@@ -48,6 +56,43 @@ f_constant('false', Boolean._false_value)
 f_constant('Null', Null)
 
 
+class Vector(vectors.Vector, Value):
+    # Numbers as doubles in one array, see `f.util.vectors`. The elements become `Number`s when they are taken out
+
+    def __repr__(self):
+        return repr(List(self.elements))
+
+    @property
+    def elements(self) -> Tuple[Number, ...]:
+        return tuple(_number(x) for x in self)
+
+    def _operand(self, other):
+        if isinstance(other, Number):
+            return float(other.number)
+        return super()._operand(other)
+
+    def call(self, args: Tuple[Value, ...]):
+        raise TypeError
+
+    def get(self) -> Value:
+        return self
+
+
+def _number(x: float) -> Number:
+    # The shortest decimal that is the same double, so 0.1 stays 0.1
+    return Number(Decimal(int(x)) if x.is_integer() else Decimal(repr(x)))
+
+
+def _comparison(result) -> Value:
+    # Comparisons with a vector compare every element
+    return result if isinstance(result, Vector) else Boolean(result)
+
+
+def _elementwise(op, args: Tuple[Value, ...]) -> Value:
+    # Arithmetic with at least one vector
+    return reduce(op, (a if isinstance(a, Vector) else float(a.number) for a in args))
+
+
 @f_function(";")
 def _semicolon(*values):
     return values[-1]
@@ -84,32 +129,85 @@ def either(condition: CodeBlock, a: Value, b: Value) -> Value:
 
 @f_function
 def foreach(action: CodeBlock, *args: List) -> List:
+    if args and all(isinstance(a, Vector) for a in args):
+        return _foreach_vectors(action, args)
     return List(action.call(v) for v in zip(*(l.elements for l in args)))
 
 
+def _foreach_vectors(action: CodeBlock, args: Tuple[Vector, ...]) -> Value:
+    # A block that only does arithmetic is called once with the whole vectors. Otherwise the results become a
+    # vector again if they are all numbers
+    size = min(len(v) for v in args)
+    args = tuple(v if len(v) == size else v[:size] for v in args)
+    if _arithmetic(action):
+        result = action.call(args)
+        return result if isinstance(result, Vector) else Vector.full(float(result.number), size)
+    results = [action.call(v) for v in zip(*(v.elements for v in args))]
+    if all(isinstance(r, Number) for r in results):
+        return Vector.of(float(r.number) for r in results)
+    return List(results)
+
+
+def _arithmetic(action: Value) -> bool:
+    # Whether the block computes a number from its arguments with nothing but numbers, names of numbers and calls of
+    # the arithmetic builtins
+    if not isinstance(action, CodeBlock) or not action.parameters \
+            or any(p.startswith("...") for p in action.parameters):
+        return False
+    frame = action.parent_frame or Interpreter.frames[-1]
+    local = set(action.parameters)
+
+    def resolve(name: str) -> Value:
+        try:
+            return frame.get(name)
+        except NameError:
+            return Null
+
+    def numeric(node: Value) -> bool:
+        if isinstance(node, Number):
+            return True
+        elif isinstance(node, Name):
+            return node.data in local or isinstance(resolve(node.data), Number)
+        elif isinstance(node, Call):
+            return isinstance(node.fun, Name) and node.fun.data in vectors.ARITHMETIC \
+                and node.fun.data not in local \
+                and resolve(node.fun.data) is Interpreter.frames[0].variables[node.fun.data] \
+                and all(numeric(a) for a in node.args)
+        return False
+
+    for statement in action.statements:
+        if isinstance(statement, Assignment):
+            if not numeric(statement.value):
+                return False
+            local.add(statement.name)
+        elif not numeric(statement):
+            return False
+    return bool(action.statements)
+
+
 @f_function("=")
 def eq(first: Value, second: Value) -> Value:
-    return Boolean(first == second)
+    return _comparison(first == second)
 
 
 @f_function(">=")
 def ge(first: Value, second: Value) -> Value:
-    return Boolean(first >= second)
+    return _comparison(first >= second)
 
 
 @f_function(">")
 def gt(first: Value, second: Value) -> Value:
-    return Boolean(first > second)
+    return _comparison(first > second)
 
 
 @f_function("<")
 def lt(first: Value, second: Value) -> Value:
-    return Boolean(first < second)
+    return _comparison(first < second)
 
 
 @f_function("<=")
 def le(first: Value, second: Value) -> Value:
-    return Boolean(first <= second)
+    return _comparison(first <= second)
 
 
 @f_function("not")
@@ -144,27 +242,39 @@ def do(fun: Value, *args: Value) -> Value:
 
 @f_function("*")
 def mul(*args: Number) -> Value:
-    return Number(reduce(operator.mul, (arg.number for arg in args)))
+    try:
+        return Number(reduce(operator.mul, (arg.number for arg in args)))
+    except AttributeError:
+        return _elementwise(operator.mul, args)
 
 
 @f_function("**")
 def mul(*args: Number) -> Value:
-    return Number(reduce(operator.pow, (arg.number for arg in args)))
+    try:
+        return Number(reduce(operator.pow, (arg.number for arg in args)))
+    except AttributeError:
+        return _elementwise(operator.pow, args)
 
 
 @f_function("-")
 def sub(*args: Number) -> Value:
-    return Number(reduce(operator.sub, (arg.number for arg in args)))
+    try:
+        return Number(reduce(operator.sub, (arg.number for arg in args)))
+    except AttributeError:
+        return _elementwise(operator.sub, args)
 
 
 @f_function("+")
 def add(*args: Number) -> Value:
-    return Number(reduce(operator.add, (arg.number for arg in args)))
+    try:
+        return Number(reduce(operator.add, (arg.number for arg in args)))
+    except AttributeError:
+        return _elementwise(operator.add, args)
 
 
 @f_function("print")
 def print_(*args: Value) -> Value:
-    print(*args)
+    sink.write(' '.join(map(str, args)) + '\n')
     return Null
 
 
@@ -191,25 +301,141 @@ def write_line(f: IOReference, line: String) -> Value:
     return Null
 
 
+@f_function("writeLines")
+def write_lines_(f: IOReference, lines: List) -> Value:
+    write_lines(f.file, (line.data for line in lines.elements))
+    return Null
+
+
+class Lines(Value):
+    # Lines read lazily by `readLines`. Can be used once where lists are iterated (`foreach`, `writeLines`)
+
+    def __init__(self, lines: Iterator[str]):
+        self.lines = lines
+
+    def __repr__(self):
+        return "<Lines>"
+
+    @property
+    def elements(self) -> Iterator[String]:
+        return (String(line) for line in self.lines)
+
+    def call(self, args: Tuple[Value, ...]):
+        raise TypeError
+
+    def get(self) -> Value:
+        return self
+
+
+@dataclass
+class MappedFileValue(Value):
+    file: MappedFile
+
+    def __repr__(self):
+        return repr(self.file)
+
+    def call(self, args: Tuple[Value, ...]):
+        raise TypeError
+
+    def get(self) -> Value:
+        return self
+
+
+@f_function("readLines")
+def read_lines_(source: Value) -> Value:
+    return Lines(read_lines(source.file))
+
+
+@f_function("stdinLines")
+def stdin_lines() -> Value:
+    return Lines(read_lines(sys.stdin))
+
+
+@f_function("readFile")
+def read_file(file_name: String) -> Value:
+    return MappedFileValue(MappedFile(file_name.data))
+
+
+@f_function("slice")
+def slice_(data: Value, start: Number, end: Number) -> Value:
+    if not (start.number % 1 == 0 and end.number % 1 == 0):
+        raise ValueError
+    start, end = int(start.number), int(end.number)
+    if isinstance(data, MappedFileValue):
+        return String(data.file.slice(start, end))
+    elif isinstance(data, String):
+        return String(data.data[start:end])
+    elif isinstance(data, Vector):
+        return data[start:end]
+    return List(data.elements[start:end])
+
+
 @f_function
 def get(data: List, index: Number) -> Value:
     if not index.number % 1 == 0:
         raise ValueError
+    if isinstance(data, Vector):
+        return _number(data[int(index.number)])
     return data.elements[int(index.number)]
 
 
 @f_function
 def append(data: List, new: Value) -> List:
-    return List(data.elements + [new])
+    return List((*data.elements, new))
 
 
 @f_function
 def insert(data: List, index: Number, value: Value) -> List:
     if not index.number % 1 == 0:
         raise ValueError
-    return List(data.elements[:int(index.number)] + [value] + data.elements[int(index.number):])
+    return List((*data.elements[:int(index.number)], value, *data.elements[int(index.number):]))
+
+
+@f_function("import")
+def import_(path: String) -> Value:
+    # Imports are top level statements, so the frame is the one of the program. Modules run in it as well, which
+    # makes their definitions visible to every file
+    frame = Interpreter.frames[-1]
+    outer = frame
+    while outer is not None:
+        if path.data in outer.imported:
+            return Null  # e.g. by the program an image was saved from
+        outer = outer.parent
+    frame.imported |= {path.data}
+    f_compile_module(path.data).call((), scoped=False)
+    return Null
+
+
+@f_function
+def vector(data: List) -> Vector:
+    return data if isinstance(data, Vector) else Vector.of(float(n.number) for n in data.elements)
+
+
+@f_function("sum")
+def sum_(data: List) -> Number:
+    if isinstance(data, Vector):
+        return _number(data.total())
+    return Number(sum((n.number for n in data.elements), Decimal(0)))
+
+
+@f_function("min")
+def min_(data: List) -> Number:
+    return _number(data.minimum()) if isinstance(data, Vector) else min(data.elements)
+
+
+@f_function("max")
+def max_(data: List) -> Number:
+    return _number(data.maximum()) if isinstance(data, Vector) else max(data.elements)
+
+
+@f_function
+def dot(first: List, second: List) -> Number:
+    return _number(vector.func(first).dot(vector.func(second)))
 
 
 def finish_init():
     Interpreter.add_frame()
-    f_compile(open("stdlib.f").read()).call((), scoped=False)
+    with phase('load stdlib.f'):
+        code = f_compile_module(PRELUDE_FILE)
+        with phase('execute'):
+            code.call((), scoped=False)
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from f.interpreter import Value, CodeBlock, BuiltinFunction, Assignment, Call, Name, VariadicValue
+
+# Callbacks into the interpreter, for debuggers and profilers:
+#
+#   on_call(hook)    hook(function, arguments) before a CodeBlock or BuiltinFunction runs
+#   on_return(hook)  hook(function, result) after it returned. result is None if it raised
+#   on_alloc(hook)   hook(value) for every newly created value
+#
+# Without hooks the interpreter runs its plain methods. Installing the first hook of a kind swaps instrumented
+# methods into the classes, removing the last one swaps the originals back, so unused hooks cost nothing.
+
+CallHook = Callable[[Value, Tuple[Value, ...]], None]
+ReturnHook = Callable[[Value, Optional[Value]], None]
+AllocHook = Callable[[Value], None]
+
+_hooks: Dict[str, List[Callable]] = {'call': [], 'return': [], 'alloc': []}
+_originals: Dict[Tuple[type, str], Callable] = {}
+
+# Nodes of the program, they are created by the compiler and not by running it
+_syntax = (Assignment, Call, Name, VariadicValue)
+
+
+def on_call(hook: CallHook) -> CallHook:
+    return _add('call', hook)
+
+
+def on_return(hook: ReturnHook) -> ReturnHook:
+    return _add('return', hook)
+
+
+def on_alloc(hook: AllocHook) -> AllocHook:
+    return _add('alloc', hook)
+
+
+def remove_hook(hook: Callable):
+    for kind, hooks in _hooks.items():
+        if hook in hooks:
+            hooks.remove(hook)
+    if not (_hooks['call'] or _hooks['return']):
+        _restore(_call_targets())
+    if not _hooks['alloc']:
+        _restore(_alloc_targets())
+
+
+def _add(kind: str, hook: Callable) -> Callable:
+    _hooks[kind].append(hook)
+    if kind == 'alloc':
+        _instrument(_alloc_targets(), _traced_init)
+    else:
+        _instrument(_call_targets(), _traced_call)
+    return hook
+
+
+def _call_targets() -> Iterator[Tuple[type, str]]:
+    yield CodeBlock, 'call'
+    yield BuiltinFunction, 'call'
+
+
+def _alloc_targets() -> Iterator[Tuple[type, str]]:
+    # Classes defined later on (the values of the builtins) are found as well, as long as they exist when the
+    # first hook gets installed
+    pending = [Value]
+    while pending:
+        cls = pending.pop()
+        pending.extend(cls.__subclasses__())
+        if '__init__' in cls.__dict__ and not issubclass(cls, _syntax):
+            yield cls, '__init__'
+
+
+def _instrument(targets: Iterator[Tuple[type, str]], wrap: Callable[[Callable], Callable]):
+    for cls, attribute in targets:
+        if (cls, attribute) not in _originals:
+            _originals[cls, attribute] = original = cls.__dict__[attribute]
+            setattr(cls, attribute, wrap(original))
+
+
+def _restore(targets: Iterator[Tuple[type, str]]):
+    for cls, attribute in targets:
+        original = _originals.pop((cls, attribute), None)
+        if original is not None:
+            setattr(cls, attribute, original)
+
+
+def _traced_call(original: Callable) -> Callable:
+    def call(self, args, *options, **kw_options):
+        for hook in _hooks['call']:
+            hook(self, args)
+        result = None
+        try:
+            result = original(self, args, *options, **kw_options)
+            return result
+        finally:
+            for hook in _hooks['return']:
+                hook(self, result)
+
+    return call
+
+
+def _traced_init(original: Callable) -> Callable:
+    def __init__(self, *args, **kwargs):
+        original(self, *args, **kwargs)
+        # Subclasses calling the __init__ of their base would report the same value twice
+        if type(self).__init__ is __init__:
+            for hook in _hooks['alloc']:
+                hook(self)
+
+    return __init__
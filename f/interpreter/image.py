@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import pickle
+import sys
+import zlib
+from pathlib import Path
+from typing import Any, Dict, Union
+
+from f import ir
+from f.interpreter import Frame, Interpreter
+
+# Snapshots of the interpreter: a frame with everything reachable from it (the CodeBlocks defined there, the frames
+# they close over, values, the frame of stdlib.f above it), written to a file and restored by another process
+# without parsing or running any F code.
+#
+#   f_eval(open('preamble.f').read(), save_image='preamble.fimg')  # or `f.py -m i --save-image FILE`
+#   f_eval(source, image=image.load('preamble.fimg'))               # or `f.py -m i --image FILE`
+#
+# Builtins, `true`, `false` and `Null` aren't stored, they refer to the ones of the process loading the image. The
+# functions of stdlib.f the optimizer inlines are stored as well, so programs compiled afterwards get the same code.
+# Images only work with the version of the interpreter and Python that wrote them. Values that live outside of the
+# interpreter (open files, lines streamed from them) can't be saved.
+
+_MAGIC = b'FIMAGE\n'
+
+
+def save(path: Union[str, Path], frame: Frame = None):
+    # Writes `frame` (default: the current global frame) with all frames above it, up to the builtins
+    frame = frame if frame is not None else Interpreter.frames[-1]
+    data = io.BytesIO()
+    try:
+        _Pickler(data).dump((frame, dict(ir.prelude)))
+    except (TypeError, pickle.PicklingError, AttributeError) as e:
+        raise ValueError(f"Can't save the frame in an image: {e}") from None
+    with open(path, 'wb') as f:
+        f.write(_MAGIC + _version().encode() + b'\n')
+        f.write(zlib.compress(data.getvalue(), 1))  # level 1: most of the size, a fraction of the time
+
+
+def load(path: Union[str, Path]) -> Frame:
+    # The saved frame. Its parent is the saved frame of stdlib.f, then the builtins of this process
+    with open(path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError(f"{path} is not an F image")
+        if f.readline().rstrip(b'\n') != _version().encode():
+            raise ValueError(f"{path} was written by another version of the interpreter, save it again")
+        data = zlib.decompress(f.read())
+    frame, prelude = _Unpickler(io.BytesIO(data)).load()
+    ir.prelude.update(prelude)
+    return frame
+
+
+class _Pickler(pickle.Pickler):
+    def __init__(self, file):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.builtins: Dict[int, str] = {id(v): name for name, v in Interpreter.frames[0].variables.items()}
+
+    def persistent_id(self, obj: Any):
+        if obj is Interpreter.frames[0]:
+            return 'builtins'
+        name = self.builtins.get(id(obj))
+        return None if name is None else ('builtin', name)
+
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid: Any):
+        if pid == 'builtins':
+            return Interpreter.frames[0]
+        kind, name = pid
+        try:
+            return Interpreter.frames[0].variables[name]
+        except KeyError:
+            raise ValueError(f"The image uses the builtin {name!r}, which doesn't exist") from None
+
+
+def _version() -> str:
+    # Images contain the classes of the interpreter and the IR, and are only read by the same code
+    h = hashlib.sha256(sys.version.encode())
+    for directory in (Path(__file__).parent, Path(ir.__file__).parent):
+        for source in sorted(directory.rglob('*.py')):
+            h.update(source.read_bytes())
+    return h.hexdigest()
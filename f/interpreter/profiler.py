@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import sys
+import threading
+from collections import Counter
+from typing import List, TextIO, Tuple
+
+from f.interpreter import Value, CodeBlock, BuiltinFunction
+from f.interpreter.hooks import on_call, on_return, remove_hook
+
+
+class SamplingProfiler:
+    # Keeps a stack of the running F functions through the interpreter hooks and samples it from a background
+    # thread. The result are collapsed stacks (`outer;inner;innermost count` per line), the input of flame graph
+    # tools like flamegraph.pl, speedscope or inferno.
+    #
+    #   with SamplingProfiler() as profiler:
+    #       f_eval(source, argv, file_name=path)
+    #   profiler.write_collapsed(open('out.folded', 'w'))
+    #
+    # The sampler only gets to run when the interpreter releases the GIL, so samples are at least
+    # `sys.getswitchinterval()` apart, no matter how small `interval` is.
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Counter[Tuple[str, ...]] = Counter()
+        self._stack: List[Value] = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self) -> SamplingProfiler:
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        on_call(self._call)
+        on_return(self._return)
+        self._thread = threading.Thread(target=self._sample, name='f_sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        remove_hook(self._call)
+        remove_hook(self._return)
+        self._stack.clear()
+
+    def write_collapsed(self, out: TextIO = None):
+        out = out or sys.stderr
+        for stack, count in sorted(self.samples.items()):
+            out.write(f"{';'.join(stack)} {count}\n")
+
+    def _call(self, function: Value, args: Tuple[Value, ...]):
+        self._stack.append(function)
+
+    def _return(self, function: Value, result: Value):
+        self._stack.pop()
+
+    def _sample(self):
+        labels = {}
+        while not self._stop.wait(self.interval):
+            stack = tuple(self._stack)  # one step under the GIL, while the interpreter keeps changing the list
+            if stack:
+                self.samples[tuple(_label(f, labels) for f in stack)] += 1
+
+
+def _label(function: Value, labels: dict) -> str:
+    # `;` separates the frames in collapsed stacks, so the builtin of that name needs another one
+    if isinstance(function, CodeBlock):
+        key = function.name, function.location
+        if key not in labels:
+            name = (function.name or '[...]').replace(';', '(semicolon)')
+            labels[key] = name if function.location is None else f"{name} ({':'.join(map(str, function.location))})"
+        return labels[key]
+    elif isinstance(function, BuiltinFunction):
+        return function.name.replace(';', '(semicolon)')
+    return repr(function)
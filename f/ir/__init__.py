@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import AbstractSet, Optional, Tuple, Any, Dict
+
+import lark
+
+from f.grammar import BaseFTransformer, FLarkTransformer
+from f.util.timings import phase, count_nodes
+
+
+# A backend independent copy of the program, built with the same callbacks the backends implement. The optimizer
+# rewrites it and `emit` replays it into the transformer of a backend, which can't tell it from the parse tree:
+#
+#   module = optimized(f.parse(text))  # build(tree), then optimizer.optimize
+#   code = emit(module, FInterpreterTransformer(file_name))
+
+
+class Node:
+    # (line, column) the backend transformer sees as its `position` while the node is emitted
+    position: Optional[Tuple[int, int]] = None
+
+    def at(self, position: Optional[Tuple[int, int]]) -> Node:
+        self.position = position
+        return self
+
+
+@dataclass
+class String(Node):
+    data: str
+
+
+@dataclass
+class Number(Node):
+    text: str  # as written in the source, every backend converts it itself
+
+
+@dataclass
+class Name(Node):
+    name: str
+
+
+@dataclass
+class Call(Node):
+    func: Node
+    arguments: Tuple[Node, ...]
+
+
+@dataclass
+class CodeBlock(Node):
+    parameters: Tuple[str, ...]  # the variadic one keeps its `...`
+    statements: Tuple[Node, ...]
+    value: Node
+
+
+@dataclass
+class VariadicValue(Node):
+    value: Node
+
+
+@dataclass
+class List(Node):
+    values: Tuple[Node, ...]
+
+
+@dataclass
+class Assignment(Node):
+    name: str
+    value: Node
+
+
+@dataclass
+class File(Node):
+    statements: Tuple[Node, ...]
+
+
+class IRBuilder(BaseFTransformer):
+    def string(self, content: str):
+        return String(content).at(self.position)
+
+    def number(self, number: str):
+        return Number(number).at(self.position)
+
+    def name(self, name: str):
+        return Name(name).at(self.position)
+
+    def call(self, func, args: Tuple):
+        return Call(func, tuple(args)).at(self.position)
+
+    def code_block(self, parameters: Tuple, statements: Tuple, return_value):
+        return CodeBlock(tuple(parameters), tuple(statements), return_value).at(self.position)
+
+    def parameter(self, name: str):
+        return name
+
+    def variadic_parameter(self, name: str):
+        return name
+
+    def variadic_value(self, value):
+        return VariadicValue(value).at(self.position)
+
+    def list(self, content: Tuple):
+        return List(tuple(content)).at(self.position)
+
+    def file(self, statements: Tuple):
+        return File(tuple(statements)).at(self.position)
+
+    def assignment(self, name: str, value):
+        return Assignment(name, value).at(self.position)
+
+
+def build(tree: lark.Tree) -> File:
+    return FLarkTransformer(IRBuilder()).transform(tree)
+
+
+def emit(node: Node, transformer: BaseFTransformer) -> Any:
+    # Children first, like the parse tree is transformed
+    if isinstance(node, String):
+        return _at(node, transformer).string(node.data)
+    elif isinstance(node, Number):
+        return _at(node, transformer).number(node.text)
+    elif isinstance(node, Name):
+        return _at(node, transformer).name(node.name)
+    elif isinstance(node, Call):
+        func = emit(node.func, transformer)
+        arguments = tuple(emit(a, transformer) for a in node.arguments)
+        return _at(node, transformer).call(func, arguments)
+    elif isinstance(node, CodeBlock):
+        _at(node, transformer)
+        parameters = tuple(transformer.variadic_parameter(p) if p.startswith('...') else transformer.parameter(p)
+                           for p in node.parameters)
+        statements = tuple(emit(s, transformer) for s in node.statements)
+        value = emit(node.value, transformer)
+        return _at(node, transformer).code_block(parameters, statements, value)
+    elif isinstance(node, VariadicValue):
+        value = emit(node.value, transformer)
+        return _at(node, transformer).variadic_value(value)
+    elif isinstance(node, List):
+        values = tuple(emit(v, transformer) for v in node.values)
+        return _at(node, transformer).list(values)
+    elif isinstance(node, Assignment):
+        value = emit(node.value, transformer)
+        return _at(node, transformer).assignment(node.name, value)
+    elif isinstance(node, File):
+        statements = tuple(emit(s, transformer) for s in node.statements)
+        return _at(node, transformer).file(statements)
+    raise TypeError(f"Not an IR node: {node!r}")
+
+
+def _at(node: Node, transformer: BaseFTransformer) -> BaseFTransformer:
+    transformer.position = node.position
+    return transformer
+
+
+# The functions of stdlib.f, known once a backend compiled it. Programs compiled after that get them inlined
+prelude: Dict[str, CodeBlock] = {}
+PRELUDE_FILE = "stdlib.f"
+
+
+def optimized(tree: lark.Tree, file_name: str = None, shadowed: AbstractSet[str] = frozenset()) -> File:
+    # The IR of a parse tree, the way all backends compile it. Imports get absolute paths, see `f.ir.modules`.
+    # `shadowed` are globals defined outside of the tree (by earlier REPL inputs), builtins and stdlib.f functions
+    # with these names are left alone
+    file_name = file_name or "<unknown>"
+    return optimized_ir(modules.resolve(build(tree), file_name), file_name, shadowed)
+
+
+def optimized_ir(module: File, file_name: str, shadowed: AbstractSet[str] = frozenset()) -> File:
+    # `optimized` for IR that is already built and resolved, the imported modules can redefine names as well
+    shadowed = {*shadowed, *modules.exports(module)}
+    with phase('optimize') as p:
+        if p is not None:
+            p.counts['IR nodes before'] = count_nodes(module, Node)
+        module = optimizer.optimize(module, prelude, shadowed)
+        if p is not None:
+            p.counts['IR nodes after'] = count_nodes(module, Node)
+    if file_name == PRELUDE_FILE:
+        prelude.update(optimizer.functions(module))
+    return module
+
+
+from f.ir import optimizer, modules
@@ -0,0 +1,248 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+from functools import lru_cache
+from pathlib import Path
+from typing import AbstractSet, Dict, FrozenSet, Iterator, List as ListType, Optional, Sequence, Set, Tuple
+
+import lark
+
+from f.grammar import parse
+from f.ir import Node, Name, String, Call, CodeBlock, Assignment, File, build, optimized_ir, optimizer
+from f.util.timings import phase
+from general_c_compiler.cache import default_cache_directory
+
+# Programs are split into files with `import "path.f"`, the path being relative to the importing file. A module runs
+# the first time any file of the program imports it, after that its top level definitions are visible to all of them,
+# like the ones of stdlib.f. Imports have to be top level statements with a string literal, so every backend knows
+# all modules of a program before it runs, and cycles are errors.
+#
+#   graph = modules.load_imports(program)  # every module `program` imports, directly or not, dependencies first
+#   code = emit(graph[path], FInterpreterTransformer(path))
+#
+# The IR of a module is cached on disk (`$F_CACHE_DIR/modules`) before it is optimized, keyed by its source and
+# everything that builds it, and optimized once per process: the optimizer has to know the names every module
+# of the program defines (`exports`). Modules that aren't cached yet are parsed in parallel.
+
+IMPORT = 'import'
+use_cache = True  # the cache on disk, `--no-cache` turns it off
+jobs: Optional[int] = None  # processes parsing modules (default: one per core)
+
+_parsed: Dict[str, File] = {}  # absolute path -> IR with resolved imports, before it is optimized
+_loaded: Dict[Tuple[str, FrozenSet[str]], File] = {}  # (absolute path, shadowed names) -> optimized IR
+
+
+def resolve(file: File, file_name: str) -> File:
+    # Makes the paths of the imports of a file that was just built absolute. Called by `optimized`
+    if _defines_import(file):
+        return file  # the program has an `import` of its own
+    directory = os.path.dirname(file_name) if not file_name.startswith('<') else ''
+    resolved = []
+
+    def statement(node: Node) -> Node:
+        if _is_statement_list(node):
+            return Call(node.func, tuple(statement(a) for a in node.arguments)).at(node.position)
+        elif _is_import(node):
+            path, = node.arguments
+            resolved.append(node.func)
+            absolute = os.path.normpath(os.path.abspath(os.path.join(directory, path.data)))
+            return Call(node.func, (String(absolute).at(path.position),)).at(node.position)
+        return node
+
+    file = File(tuple(statement(s) for s in file.statements)).at(file.position)
+    for node in _walk(file):
+        if isinstance(node, Name) and node.name == IMPORT and not any(node is r for r in resolved):
+            line = f":{node.position[0]}" if node.position is not None else ""
+            raise ValueError(f"{file_name}{line}: `import` only works as a top level statement with a string, "
+                             f"like `import \"lib.f\"`")
+    return file
+
+
+def imports(file: File) -> Tuple[str, ...]:
+    # Absolute paths of the modules a resolved file imports, in the order of the imports
+    if _defines_import(file):
+        return ()
+    return tuple(s.arguments[0].data for s in statements(file) if _is_import(s))
+
+
+def statements(file: File) -> Iterator[Node]:
+    # The top level statements, `a; b; c` is one call of `;`
+    pending = list(reversed(file.statements))
+    while pending:
+        node = pending.pop()
+        if _is_statement_list(node):
+            pending.extend(reversed(node.arguments))
+        else:
+            yield node
+
+
+def load(path: str, shadowed: AbstractSet[str] = frozenset()) -> File:
+    # The optimized IR of the module at `path`, `shadowed` are names other modules of the program define
+    absolute = os.path.abspath(path)
+    key = (absolute, frozenset(shadowed))
+    if key not in _loaded:
+        _parse_all([path])
+        _loaded[key] = optimized_ir(_parsed[absolute], path, shadowed)
+    return _loaded[key]
+
+
+def load_imports(file: File) -> Dict[str, File]:
+    # Every module `file` imports, directly or through other modules, ordered so that each comes after its imports
+    with phase('load modules') as p:
+        found = _graph(file)
+        ordered: Dict[str, File] = {}
+        for path in imports(file):
+            _visit(path, found, ordered, [])
+        if p is not None:
+            p.counts['modules'] = len(ordered)
+        # They all share the globals, one module may redefine what another one uses
+        shadowed = {name for module in found.values() for name in optimizer.defined(module)}
+        return {path: load(path, shadowed) for path in ordered}
+
+
+def exports(file: File) -> Set[str]:
+    # The names the modules `file` imports (directly or not) define at their top level. They run in the same
+    # globals, so the optimizer must not assume these mean a builtin or a function of stdlib.f
+    return {name for module in _graph(file).values() for name in optimizer.defined(module)}
+
+
+def _graph(file: File) -> Dict[str, File]:
+    # The IR of every module `file` imports, directly or not, before it is optimized
+    found: Dict[str, File] = {}
+    pending = list(imports(file))
+    while pending:
+        missing = [path for path in dict.fromkeys(pending) if path not in found]
+        _parse_all(missing)
+        found.update((path, _parsed[path]) for path in missing)
+        pending = [i for path in missing for i in imports(found[path]) if i not in found]
+    return found
+
+
+def _visit(path: str, found: Dict[str, File], ordered: Dict[str, File], active: ListType[str]):
+    if path in active:
+        raise ValueError(f"Import cycle: {' -> '.join((*active[active.index(path):], path))}")
+    if path in ordered:
+        return
+    active.append(path)
+    for i in imports(found[path]):
+        _visit(i, found, ordered, active)
+    active.pop()
+    ordered[path] = found[path]
+
+
+def _parse_all(paths: Sequence[str]):
+    # Parses the modules into `_parsed`, in parallel if more than one of them isn't cached on disk
+    todo = []
+    for path in paths:
+        absolute = os.path.abspath(path)
+        if absolute in _parsed:
+            continue
+        with open(path) as f:
+            source = f.read()
+        key = _key(absolute, source)
+        module = _cached(key)
+        if module is None:
+            todo.append((path, source, key))
+        else:
+            _parsed[absolute] = module
+    if not todo:
+        return
+    with phase('parse modules') as p:
+        if p is not None:
+            p.counts['parsed'] = len(todo)
+        if len(todo) > 1 and (jobs or os.cpu_count() or 1) > 1:
+            with ProcessPoolExecutor(jobs) as pool:
+                parsed = list(pool.map(_resolved_in_worker, *zip(*((path, source) for path, source, _ in todo))))
+        else:
+            parsed = [_resolved(path, source) for path, source, _ in todo]
+    for (path, _, key), module in zip(todo, parsed):
+        _parsed[os.path.abspath(path)] = module
+        _store(key, module)
+
+
+def _resolved(path: str, source: str) -> File:
+    with phase('parse'):
+        tree = parse(source)
+    return resolve(build(tree), path)
+
+
+def _resolved_in_worker(path: str, source: str) -> File:
+    try:
+        return _resolved(path, source)
+    except Exception as e:
+        # lark's exceptions don't survive pickling
+        raise ValueError(f"{path}: {type(e).__name__}: {e}") from None
+
+
+# The cache on disk
+
+def _key(path: str, source: str) -> str:
+    h = hashlib.sha256()
+    for part in (sys.version, path, source, *_builder_sources()):
+        data = part.encode() if isinstance(part, str) else part
+        h.update(len(data).to_bytes(8, 'little'))
+        h.update(data)
+    return h.hexdigest()
+
+
+@lru_cache()
+def _builder_sources() -> Tuple[bytes, ...]:
+    # What builds the IR: the parser with its grammar and lark, then f/ir
+    grammar = Path(__file__).parent.parent / 'grammar'
+    sources = (grammar / '__init__.py', grammar / 'f.grammar', *sorted(Path(__file__).parent.glob('*.py')))
+    return (lark.__version__.encode(), *(p.read_bytes() for p in sources))
+
+
+def _cached(key: str) -> Optional[File]:
+    if not use_cache:
+        return None
+    try:
+        with (default_cache_directory() / 'modules' / key).open('rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None  # not cached yet, or written by an incompatible version and replaced now
+
+
+def _store(key: str, module: File):
+    if not use_cache:
+        return
+    directory = default_cache_directory() / 'modules'
+    directory.mkdir(parents=True, exist_ok=True)
+    temp = directory / f"{key}.{os.getpid()}.tmp"
+    with temp.open('wb') as f:
+        pickle.dump(module, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(str(temp), str(directory / key))  # atomic, like the build cache
+
+
+# Helpers
+
+def _defines_import(file: File) -> bool:
+    for node in _walk(file):
+        if isinstance(node, Assignment) and node.name == IMPORT:
+            return True
+        elif isinstance(node, CodeBlock) and any(p.lstrip('.') == IMPORT for p in node.parameters):
+            return True
+    return False
+
+
+def _is_statement_list(node: Node) -> bool:
+    return isinstance(node, Call) and node.func == Name(';')
+
+
+def _is_import(node: Node) -> bool:
+    return isinstance(node, Call) and node.func == Name(IMPORT) and len(node.arguments) == 1 \
+        and isinstance(node.arguments[0], String)
+
+
+def _walk(node: Node) -> Iterator[Node]:
+    yield node
+    for field in fields(node):
+        value = getattr(node, field.name)
+        for child in (value if isinstance(value, tuple) else (value,)):
+            if isinstance(child, Node):
+                yield from _walk(child)
@@ -0,0 +1,502 @@
+import decimal
+import operator
+from collections import Counter
+from dataclasses import dataclass, fields
+from decimal import Decimal
+from functools import reduce
+from typing import AbstractSet, Dict, List as ListType, Set, Optional, FrozenSet, Iterator, Tuple
+
+from f.ir import Node, String, Number, Name, Call, CodeBlock, VariadicValue, List, Assignment, File
+
+# Rewrites the IR without changing what the program does on any backend:
+#
+#   flattening     `a + b + c` is parsed as `+ (+ a b) c`, it becomes `+ a b c`. All variadic operators fold from
+#                  the left, so this works for `-` and `/` as well, and for `;`, which returns its last argument
+#   propagation    names that are assigned a literal once are replaced by it after the assignment
+#   folding        operators on number literals are computed, comparisons become `true` or `false`
+#   either         `either true a b` becomes `a`, if evaluating `b` couldn't have had any effect
+#   inlining       calls of small functions are replaced by their body: the functions of stdlib.f (`if`, `else`,
+#                  `until`, ...) and functions of the program that are assigned once and don't call themselves.
+#                  Code blocks that are called right away (`do [...]`) are inlined as well, as are variadic
+#                  parameters, when the number of arguments is known
+#   dead code      inside of code blocks, assignments to unused names and values that are thrown away by `;` are
+#                  dropped if they have no effect. Top level assignments stay, another input of the REPL could use them
+#
+# The backends disagree on what numbers are (Decimal, float and double), so folding only happens when all of them
+# get exactly the same result. `/` isn't folded (the interpreter has none), neither are strings.
+# Builtins that the program assigns to somewhere, or takes as parameter, are left alone completely, as are the ones
+# the modules it imports assign to.
+
+_flattened = {'+', '*', '-', '/', ';'}
+_arithmetic = {'+': operator.add, '*': operator.mul, '-': operator.sub, '**': operator.pow}
+_comparisons = {'=': operator.eq, '<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+
+# Raising on anything inexact keeps folding to the results the interpreter would compute as well
+_exact = decimal.Context(prec=28, traps=[decimal.Inexact, decimal.InvalidOperation, decimal.DivisionByZero,
+                                         decimal.Overflow, decimal.Underflow])
+
+
+# Functions with bodies of up to this many IR nodes are inlined, 0 turns inlining off
+inline_threshold = 16
+
+
+def optimize(file: File, prelude: Dict[str, CodeBlock] = None, shadowed: AbstractSet[str] = frozenset()) -> File:
+    # `prelude` are the functions defined before the program runs, see `functions`. `shadowed` are globals that are
+    # assigned outside of `file`, by the modules it imports or earlier inputs of the REPL
+    program = _Program(file, prelude or {}, shadowed)
+    file = _propagate(file, [program.prelude], program)
+    return _eliminate(file, program)
+
+
+def functions(file: File) -> Dict[str, CodeBlock]:
+    # The code blocks assigned to names at the top level of an optimized file
+    statements = file.statements
+    if len(statements) == 1 and isinstance(statements[0], Call) and statements[0].func == Name(';'):
+        statements = statements[0].arguments
+    counts = _definitions(file)
+    return {s.name: s.value for s in statements
+            if isinstance(s, Assignment) and isinstance(s.value, CodeBlock) and counts[s.name] == 1}
+
+
+def defined(file: File) -> Set[str]:
+    # The names assigned at the top level of a file
+    return set(_definitions(file))
+
+
+class _Program:
+    def __init__(self, file: File, prelude: Dict[str, CodeBlock], shadowed: AbstractSet[str]):
+        self.definitions = Counter(_names(file))  # in all scopes
+        self.definitions.update(shadowed)
+        self.shadowed = set(self.definitions)
+        self.expanding: ListType[str] = []  # functions that are being inlined, they don't get inlined into themselves
+        self.prelude = {}
+        for name, block in prelude.items():
+            function = _function(name, block, frozenset(), self)
+            if function is not None and name not in self.shadowed:
+                self.prelude[name] = function
+
+    def is_(self, node: Node, *names: str) -> bool:
+        return isinstance(node, Name) and node.name in names and node.name not in self.shadowed
+
+    def available(self, *names: str) -> bool:
+        return not self.shadowed.intersection(names)
+
+
+# Scopes
+
+def _names(node: Node):
+    # Every name that gets defined somewhere below `node`, parameters without their `...`
+    if isinstance(node, Assignment):
+        yield node.name
+    elif isinstance(node, CodeBlock):
+        yield from (_variable(p) for p in node.parameters)
+    for child in _children(node):
+        yield from _names(child)
+
+
+def _definitions(node: Node) -> Counter:
+    # How often each name is assigned in the scope of `node`, without the code blocks nested in it
+    counts = Counter()
+    pending = [node.value, *node.statements] if isinstance(node, CodeBlock) else list(_children(node))
+    while pending:
+        child = pending.pop()
+        if isinstance(child, Assignment):
+            counts[child.name] += 1
+        if not isinstance(child, CodeBlock):
+            pending.extend(_children(child))
+    return counts
+
+
+def _references(node: Node) -> Set[str]:
+    found = set()
+    pending = [node]
+    while pending:
+        child = pending.pop()
+        if isinstance(child, Name):
+            found.add(_variable(child.name))
+        pending.extend(_children(child))
+    return found
+
+
+def _variable(name: str) -> str:
+    return name if name == '...' else name[3:] if name.startswith('...') else name
+
+
+def _children(node: Node):
+    if isinstance(node, Call):
+        yield node.func
+        yield from node.arguments
+    elif isinstance(node, CodeBlock):
+        yield from node.statements
+        yield node.value
+    elif isinstance(node, (VariadicValue, Assignment)):
+        yield node.value
+    elif isinstance(node, List):
+        yield from node.values
+    elif isinstance(node, File):
+        yield from node.statements
+
+
+def _replace(node: Node, **changes) -> Node:
+    # A copy at the same position. Nodes are shared between the IR before and after optimizing, never changed
+    new = type(node)(**{**{f.name: getattr(node, f.name) for f in fields(node)}, **changes})
+    new.position = node.position
+    return new
+
+
+# Constant propagation and inlining, in the order the program runs. Every node is simplified after its children, so
+# folded values get propagated and inlined code gets optimized as well
+
+_unbound = object()  # assigned once in the scope, the assignment wasn't reached yet
+_variable_ = object()  # a parameter, or assigned more than once (the Python backend allows that)
+
+
+@dataclass
+class _Function:
+    name: str
+    block: CodeBlock
+    visible: FrozenSet[str]  # names of the scopes around the definition
+
+
+def _propagate(node: Node, scopes: ListType[Dict[str, object]], program: _Program) -> Node:
+    if isinstance(node, Name):
+        value = _lookup(node.name, scopes)
+        return _replace(value).at(node.position) if isinstance(value, Node) else node
+    elif isinstance(node, (CodeBlock, File)):
+        parameters = {_variable(p) for p in node.parameters} if isinstance(node, CodeBlock) else set()
+        scope = {name: _unbound if count == 1 and name not in parameters else _variable_
+                 for name, count in _definitions(node).items()}
+        scope.update((name, _variable_) for name in parameters)
+        return _map(node, lambda child: _propagate(child, [*scopes, scope], program))
+    elif isinstance(node, Assignment):
+        value = _propagate(node.value, scopes, program)
+        if scopes[-1].get(node.name) is _unbound:
+            if isinstance(value, (Number, String)):
+                scopes[-1][node.name] = value
+            elif isinstance(value, CodeBlock) and program.definitions[node.name] == 1:
+                function = _function(node.name, value, frozenset(n for s in scopes for n in s), program)
+                if function is not None:
+                    scopes[-1][node.name] = function
+        return _replace(node, value=value)
+    node = _simplify(_map(node, lambda child: _propagate(child, scopes, program)), program)
+    if isinstance(node, Call):
+        inlined = _inline(node, scopes, program)
+        if inlined is not None:
+            return inlined
+    return node
+
+
+def _lookup(name: str, scopes: ListType[Dict[str, object]]) -> object:
+    for scope in reversed(scopes):
+        if name in scope:
+            return scope[name]
+    return None
+
+
+def _map(node: Node, function) -> Node:
+    if isinstance(node, Call):
+        return _replace(node, func=function(node.func), arguments=tuple(function(a) for a in node.arguments))
+    elif isinstance(node, CodeBlock):
+        return _replace(node, statements=tuple(function(s) for s in node.statements), value=function(node.value))
+    elif isinstance(node, (VariadicValue, Assignment)):
+        return _replace(node, value=function(node.value))
+    elif isinstance(node, List):
+        return _replace(node, values=tuple(function(v) for v in node.values))
+    elif isinstance(node, File):
+        return _replace(node, statements=tuple(function(s) for s in node.statements))
+    return node
+
+
+# Flattening, folding and `either`
+
+def _simplify(node: Node, program: _Program) -> Node:
+    if isinstance(node, List):
+        return _replace(node, values=_spliced(node.values))
+    if not isinstance(node, Call):
+        return node
+    node = _replace(node, arguments=_spliced(node.arguments))
+    if program.is_(node.func, 'do') and node.arguments and not isinstance(node.arguments[0], VariadicValue):
+        node = _replace(node, func=node.arguments[0], arguments=node.arguments[1:])
+    if any(isinstance(a, VariadicValue) for a in node.arguments):
+        return node
+    if program.is_(node.func, *_flattened):
+        node = _flatten(node, program)
+    if program.is_(node.func, ';'):
+        # Only the last value is used, the others only matter for their effects
+        arguments = tuple(a for a in node.arguments[:-1] if not _pure(a)) + node.arguments[-1:]
+        return arguments[0] if len(arguments) == 1 else _replace(node, arguments=arguments)
+    elif program.is_(node.func, *_arithmetic) and all(isinstance(a, Number) for a in node.arguments):
+        return _fold_arithmetic(node)
+    elif program.is_(node.func, *_comparisons) and program.available('true', 'false'):
+        return _fold_comparison(node)
+    elif program.is_(node.func, 'either') and len(node.arguments) == 3 \
+            and program.is_(node.arguments[0], 'true', 'false'):
+        condition, a, b = node.arguments
+        chosen, dropped = (a, b) if condition.name == 'true' else (b, a)
+        if _pure(dropped):
+            return chosen
+    return node
+
+
+def _spliced(values: Tuple[Node, ...]) -> Tuple[Node, ...]:
+    # `...({a b})` is `a b`
+    spliced = []
+    for value in values:
+        if isinstance(value, VariadicValue) and isinstance(value.value, List):
+            spliced.extend(value.value.values)
+        else:
+            spliced.append(value)
+    return tuple(spliced)
+
+
+def _flatten(call: Call, program: _Program) -> Call:
+    # `+ (+ a b) c` to `+ a b c`. The values `;` throws away can be flattened out of any position
+    operator = call.func.name
+    arguments = []
+    for i, argument in enumerate(call.arguments):
+        if (i == 0 or operator == ';') and isinstance(argument, Call) and program.is_(argument.func, operator) \
+                and argument.arguments and not any(isinstance(a, VariadicValue) for a in argument.arguments):
+            arguments.extend(argument.arguments)
+        else:
+            arguments.append(argument)
+    return _replace(call, arguments=tuple(arguments))
+
+
+def _fold_arithmetic(call: Call) -> Node:
+    operator = call.func.name
+    if not call.arguments or (operator == '**' and len(call.arguments) != 2):
+        return call
+    try:
+        numbers = [_exact.create_decimal(a.text) for a in call.arguments]
+        if not all(_float_exact(n) for n in numbers):
+            return call
+        # The interpreter computes with Decimal
+        result = reduce(lambda a, b: _exact_operation(operator, a, b), numbers)
+        floats = [float(n) for n in numbers]
+        # The Python backend folds the floats from the left, C starts adding at 0
+        python = reduce(_arithmetic[operator], floats)
+        c = reduce(_arithmetic[operator], floats, 0.) if operator == '+' else python
+    except (decimal.DecimalException, ArithmeticError, ValueError):
+        return call
+    if result.is_zero() or not _float_exact(result) or not python == c == float(result):
+        return call
+    return Number(str(result)).at(call.position)
+
+
+def _fold_comparison(call: Call) -> Node:
+    if len(call.arguments) != 2 or not all(isinstance(a, Number) for a in call.arguments):
+        return call
+    try:
+        first, second = (_exact.create_decimal(a.text) for a in call.arguments)
+    except decimal.DecimalException:
+        return call
+    if not (_float_exact(first) and _float_exact(second)):
+        return call
+    return Name('true' if _comparisons[call.func.name](first, second) else 'false').at(call.position)
+
+
+def _exact_operation(operator: str, a: Decimal, b: Decimal) -> Decimal:
+    if operator == '+':
+        return _exact.add(a, b)
+    elif operator == '-':
+        return _exact.subtract(a, b)
+    elif operator == '*':
+        return _exact.multiply(a, b)
+    return _exact.power(a, b)
+
+
+def _float_exact(number: Decimal) -> bool:
+    return number.is_finite() and Decimal(float(number)) == number
+
+
+def _pure(node: Node) -> bool:
+    # Evaluating it can't fail or have effects
+    if isinstance(node, List):
+        return all(_pure(v) for v in node.values)
+    return isinstance(node, (Number, String, CodeBlock))
+
+
+# Inlining
+
+def _function(name: str, block: CodeBlock, visible: FrozenSet[str], program: _Program) -> Optional[_Function]:
+    # A function that can be inlined wherever its name is called
+    if _size(block.value) > inline_threshold or _definitions(block) or name in _free(block):
+        return None
+    # The names the body uses have to mean the same at every call. Either they are only defined around the
+    # definition, or they are globals the program doesn't define anywhere
+    for free in _free(block):
+        count = program.definitions[free]
+        if count > 1 or (count == 1 and free not in visible):
+            return None
+    return _Function(name, block, visible)
+
+
+def _inline(call: Call, scopes: ListType[Dict[str, object]], program: _Program) -> Optional[Node]:
+    if isinstance(call.func, CodeBlock):
+        body = _substitute(call.func, call.arguments, program, None)
+        return None if body is None else _propagate(body, scopes, program)
+    if not isinstance(call.func, Name):
+        return None
+    function = _lookup(call.func.name, scopes)
+    if not isinstance(function, _Function) or function.name in program.expanding:
+        return None
+    body = _substitute(function.block, call.arguments, program, call.position)
+    if body is None:
+        return None
+    program.expanding.append(function.name)
+    try:
+        return _propagate(body, scopes, program)
+    finally:
+        program.expanding.pop()
+
+
+def _substitute(block: CodeBlock, arguments: ListType[Node], program: _Program,
+                position: Optional[tuple]) -> Optional[Node]:
+    # The value of `block` with its parameters replaced by the arguments, None if that would change what happens.
+    # With a `position` (the one of the call) the body is moved there, the arguments always keep theirs
+    if _definitions(block) or any(isinstance(a, VariadicValue) for a in arguments):
+        return None
+    parameters = block.parameters
+    variadic = next((i for i, p in enumerate(parameters) if p.startswith('...')), None)
+    if variadic is None:
+        if len(arguments) != len(parameters):
+            return None
+        bound, rest = dict(zip(parameters, arguments)), None
+    else:
+        after = len(parameters) - variadic - 1
+        if len(arguments) < len(parameters) - 1:
+            return None
+        bound = dict(zip(parameters[:variadic], arguments))
+        bound.update(zip(parameters[variadic + 1:], arguments[len(arguments) - after:]))
+        rest = _variable(parameters[variadic]), tuple(arguments[variadic:len(arguments) - after])
+    # Names of the arguments must not end up inside of a code block of the body that defines them as well
+    used = set().union(*(_references(a) for a in arguments))
+    if used.intersection(_names(block.value)):
+        return None
+    if any(isinstance(a, Name) and program.definitions[_variable(a.name)] > 1 for a in arguments):
+        return None  # the value could change until the body uses it
+    try:
+        body = _replace_parameters(block.value, bound, rest, position)
+    except _NotInlinable:
+        return None
+    # Arguments are evaluated before the call. Copies of literals, names and small code blocks don't change that,
+    # everything else has to be evaluated exactly once, in the same order and before the body calls anything.
+    # Every copy of a code block is a closure of its own, so they are only copied where they get called right away
+    evaluated = [a for a in arguments if not _trivial(a)]
+    if any(_count(body, a) > 1 and (_size(a) > inline_threshold or _called(body, a, program) != _count(body, a))
+           for a in arguments if isinstance(a, CodeBlock)):
+        return None
+    if evaluated and [id(e) for e in _evaluated_before_calls(body, {id(e) for e in evaluated})] \
+            != [id(e) for e in evaluated]:
+        return None
+    return body
+
+
+class _NotInlinable(Exception):
+    pass
+
+
+def _replace_parameters(node: Node, bound: Dict[str, Node], rest, position) -> Node:
+    if isinstance(node, Name):
+        if node.name in bound:
+            return bound[node.name]
+        if rest is not None and _variable(node.name) == rest[0]:
+            raise _NotInlinable  # the variadic parameter as a list, the backends have different types for it
+        return _replace(node).at(position or node.position)
+    elif isinstance(node, CodeBlock):
+        inner = {_variable(p) for p in node.parameters} | set(_definitions(node))
+        bound = {p: a for p, a in bound.items() if _variable(p) not in inner}
+        if rest is not None and rest[0] in inner:
+            rest = None
+    elif isinstance(node, (Call, List)) and rest is not None:
+        values = []
+        for value in (node.arguments if isinstance(node, Call) else node.values):
+            if isinstance(value, VariadicValue) and isinstance(value.value, Name) and value.value.name == rest[0]:
+                values.extend(rest[1])
+            else:
+                values.append(_replace_parameters(value, bound, rest, position))
+        if isinstance(node, List):
+            return _replace(node, values=tuple(values)).at(position or node.position)
+        return _replace(node, func=_replace_parameters(node.func, bound, rest, position),
+                        arguments=tuple(values)).at(position or node.position)
+    new = _map(node, lambda child: _replace_parameters(child, bound, rest, position))
+    return (_replace(node) if new is node else new).at(position or node.position)
+
+
+def _evaluated_before_calls(node: Node, arguments: Set[int]) -> Iterator[Node]:
+    # The arguments in the order the body evaluates them, until the first call is done or a code block uses them
+    for event in _events(node, arguments):
+        if event is None:
+            return
+        yield event
+
+
+def _events(node: Node, arguments: Set[int]) -> Iterator[Optional[Node]]:
+    # Arguments as they get evaluated, None for calls and for arguments used later by a code block
+    if id(node) in arguments:
+        yield node
+    elif isinstance(node, CodeBlock):
+        if any(id(n) in arguments for n in _walk(node)):
+            yield None
+    elif isinstance(node, Call):
+        if not isinstance(node.func, (Name, CodeBlock)):
+            yield None  # the interpreter evaluates the function after the arguments, the others before
+        yield from _events(node.func, arguments)
+        for a in node.arguments:
+            yield from _events(a, arguments)
+        yield None
+    else:
+        for child in _children(node):
+            yield from _events(child, arguments)
+
+
+def _free(block: CodeBlock) -> Set[str]:
+    # Names the code block uses but doesn't define itself
+    def free(node: Node, bound: FrozenSet[str]) -> Iterator[str]:
+        if isinstance(node, Name) and _variable(node.name) not in bound:
+            yield _variable(node.name)
+        elif isinstance(node, CodeBlock):
+            bound = bound | {_variable(p) for p in node.parameters} | set(_definitions(node))
+        for child in _children(node):
+            yield from free(child, bound)
+
+    return set(free(block, frozenset()))
+
+
+def _walk(node: Node) -> Iterator[Node]:
+    yield node
+    for child in _children(node):
+        yield from _walk(child)
+
+
+def _size(node: Node) -> int:
+    return sum(1 for _ in _walk(node))
+
+
+def _count(node: Node, target: Node) -> int:
+    return sum(1 for n in _walk(node) if n is target)
+
+
+def _called(node: Node, target: Node, program: _Program) -> int:
+    # How often `target` is called where it is used, as the function of a call or with `do`
+    return sum(1 for n in _walk(node) if isinstance(n, Call)
+               and (n.func is target or program.is_(n.func, 'do') and n.arguments and n.arguments[0] is target))
+
+
+def _trivial(node: Node) -> bool:
+    # Evaluating it twice or later is the same as evaluating it once
+    return isinstance(node, (Number, String, Name, CodeBlock))
+
+
+# Dead code
+
+def _eliminate(node: Node, program: _Program) -> Node:
+    node = _map(node, lambda child: _eliminate(child, program))
+    if not (isinstance(node, CodeBlock) and isinstance(node.value, Call) and program.is_(node.value.func, ';')):
+        return node
+    # Assignments whose value `;` throws away, to names nothing in the code block refers to
+    used = _references(node)
+    *discarded, last = node.value.arguments
+    discarded = [d.value if isinstance(d, Assignment) and d.name not in used else d for d in discarded]
+    arguments = tuple(d for d in discarded if not _pure(d)) + (last,)
+    return _replace(node, value=arguments[0] if len(arguments) == 1 else _replace(node.value, arguments=arguments))
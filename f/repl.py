@@ -0,0 +1,206 @@
+import statistics
+import sys
+import time
+from collections import OrderedDict
+from typing import AbstractSet, Any, Callable, Sequence, TextIO
+
+from f.util.output import sink
+
+
+class Session:
+    # An interactive session on one backend. Definitions of earlier inputs stay visible to later ones, but not to
+    # other sessions or programs run with `f_eval`. Compiled inputs are cached by their text, so running the same
+    # snippet again (or timing it) only pays for executing it. Inputs are compiled knowing the names earlier ones
+    # defined, so a redefined builtin or stdlib.f function isn't inlined or folded.
+    #
+    #   session = Session.create('i')
+    #   session.execute("fib := [|n| if [n < 2] [n] else [(fib (n - 1)) + (fib (n - 2))]]")
+    #   session.execute(":timeit 100 fib 15")
+    #
+    # Besides F code an input can be a command:
+    #
+    #   :time CODE        runs CODE once and prints how long compiling and running took
+    #   :timeit N CODE    runs CODE N times after some warmup runs and prints mean, min and standard deviation
+
+    prompt = "> "
+    file_name = "<repl>"
+    cache_size = 256
+
+    def __init__(self, argv: Sequence[str] = ()):
+        self.argv = tuple(argv)
+        self._cache = OrderedDict()
+
+    @staticmethod
+    def create(mode: str, argv: Sequence[str] = (), **kwargs) -> 'Session':
+        # kwargs go to the backend: `tier` for -m a, `image` for -m i, `options` and `cache` for -m s
+        if mode.startswith('a'):
+            return ASTSession(argv, **kwargs)
+        elif mode.startswith('i'):
+            return InterpreterSession(argv, **kwargs)
+        elif mode.startswith('s'):
+            return SharedSession(argv, **kwargs)
+        raise ValueError(f"No REPL for mode {mode!r}")
+
+    def compile(self, text: str) -> Any:
+        raise NotImplementedError
+
+    def defined(self) -> AbstractSet[str]:
+        # The globals earlier inputs defined
+        return frozenset()
+
+    def run(self, code: Any):
+        raise NotImplementedError
+
+    def compiled(self, text: str) -> Any:
+        # Compiled again once earlier inputs defined more names
+        key = text, frozenset(self.defined())
+        try:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        except KeyError:
+            pass
+        code = self._cache[key] = self.compile(text)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return code
+
+    def execute(self, line: str, out: TextIO = None):
+        # Runs F code or a command. Timings are printed to `out` (default stderr), after the output of the code
+        out = out or sys.stderr
+        if not line.startswith(':'):
+            self._run_flushed(self.compiled(line))
+            return
+        command, _, rest = line[1:].partition(' ')
+        if command == 'time':
+            start = time.perf_counter()
+            code = self.compiled(rest)
+            compiled = time.perf_counter()
+            self._run_flushed(code)
+            end = time.perf_counter()
+            # Compiling takes no time if the code is cached
+            print(f"compile {_format(compiled - start)}, run {_format(end - compiled)}", file=out)
+        elif command == 'timeit':
+            count, _, rest = rest.partition(' ')
+            try:
+                count = int(count)
+            except ValueError:
+                raise ValueError(":timeit needs the number of runs, e.g. `:timeit 100 fib 10`") from None
+            if count < 1:
+                raise ValueError(":timeit needs at least one run")
+            code = self.compiled(rest)
+            warmup = max(1, count // 10)
+            for _ in range(warmup):
+                self._run_flushed(code)
+            runs = [_seconds(self._run_flushed, code) for _ in range(count)]
+            print(f"{count} runs ({warmup} warmup): mean {_format(statistics.mean(runs))}, "
+                  f"min {_format(min(runs))}, stddev {_format(statistics.stdev(runs) if count > 1 else 0.)}",
+                  file=out)
+        else:
+            raise ValueError(f"Unknown command :{command}, use :time or :timeit")
+
+    def interact(self):
+        # Reads inputs until EOF. Errors are printed and the session goes on
+        while True:
+            try:
+                line = input(self.prompt)
+            except EOFError:
+                print(file=sys.stderr)
+                return
+            except KeyboardInterrupt:
+                print(file=sys.stderr)
+                continue
+            if not line.strip():
+                continue
+            try:
+                self.execute(line)
+            except KeyboardInterrupt:
+                sink.flush()
+                print("interrupted", file=sys.stderr)
+            except Exception as e:
+                sink.flush()
+                print(f"{type(e).__name__}: {e}", file=sys.stderr)
+
+    def _run_flushed(self, code: Any):
+        try:
+            self.run(code)
+        finally:
+            sink.flush()
+
+
+class ASTSession(Session):
+    def __init__(self, argv: Sequence[str] = (), tier=None):
+        super().__init__(argv)
+        from f.ast_compiler import f_globals
+        self.tier = tier
+        # stdlib.f and the builtins are shared, everything defined in the session lands in the copy
+        self.globals = dict(f_globals)
+        self.globals['...'] = tuple(self.argv)  # like `f_eval`, just the arguments
+        if tier is not None:
+            self.globals[tier.name] = tier
+        self._initial = dict(self.globals)
+
+    def compile(self, text: str):
+        from f.ast_compiler import f_compile
+        return f_compile(text, self.file_name, tier=self.tier, shadowed=self.defined())
+
+    def defined(self) -> AbstractSet[str]:
+        missing = object()
+        return {name for name, value in self.globals.items() if self._initial.get(name, missing) is not value}
+
+    def run(self, code):
+        exec(code, self.globals)
+
+
+class InterpreterSession(Session):
+    def __init__(self, argv: Sequence[str] = (), image=None):
+        super().__init__(argv)
+        from f.interpreter import Frame, Interpreter, String, List
+        # Below the frame stdlib.f was loaded into (or the one of an image, see `f.interpreter.image`), so names of
+        # the session can't collide with other sessions
+        self.frame = Frame(image if image is not None else Interpreter.frames[-1])
+        self.frame.set('...', List(String(s) for s in self.argv))
+
+    def compile(self, text: str):
+        from f.interpreter import f_compile
+        return f_compile(text, file_name=self.file_name, shadowed=self.defined())
+
+    def defined(self) -> AbstractSet[str]:
+        return self.frame.variables.keys() - {'...'}
+
+    def run(self, code):
+        from f.interpreter import Interpreter
+        depth = len(Interpreter.frames)
+        Interpreter.add_frame(self.frame)
+        try:
+            code.call((), scoped=False)
+        finally:
+            # Code that raised leaves the frames of the calls it was in behind
+            del Interpreter.frames[depth:]
+
+
+class SharedSession(Session):
+    # Every input is a program of its own, C can't share definitions between them
+    def __init__(self, argv: Sequence[str] = (), options=None, cache: bool = True):
+        super().__init__(argv)
+        self.options = options
+        self.cache = cache
+
+    def compile(self, text: str):
+        from f.c_compiler.shared import f_load
+        return f_load(text, self.options, self.cache)
+
+    def run(self, code):
+        code(self.argv)
+
+
+def _seconds(function: Callable, *args) -> float:
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def _format(seconds: float) -> str:
+    for unit, scale in (('s', 1.), ('ms', 1e-3), ('µs', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
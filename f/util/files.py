@@ -0,0 +1,55 @@
+import mmap
+import os
+from typing import IO, Iterable, Iterator, Union
+
+READ_CHUNK = 1 << 20  # Size hint for the bulk reads of `read_lines`
+MAP_THRESHOLD = 1 << 20  # Smaller files are just read, mapping them costs more than it saves
+
+
+class MappedFile:
+    # Content of a file opened with `readFile`. Large files are memory mapped, so only the parts that are used
+    # get loaded, and slices only copy what they cover
+
+    def __init__(self, path: str, encoding: str = 'utf-8'):
+        self.path = path
+        self.encoding = encoding
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size >= MAP_THRESHOLD:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.data = f.read()
+
+    def __repr__(self):
+        return f"<File '{self.path}' ({len(self.data)} bytes)>"
+
+    def __len__(self):
+        return len(self.data)
+
+    def slice(self, start: int, end: int) -> str:
+        return self.data[start:end].decode(self.encoding, errors='replace')
+
+    def lines(self) -> Iterator[str]:
+        data, start, size = self.data, 0, len(self.data)
+        while start < size:
+            end = data.find(b'\n', start)
+            if end == -1:
+                end = size
+            yield data[start:end].rstrip(b'\r').decode(self.encoding, errors='replace')
+            start = end + 1
+
+
+def read_lines(source: Union[IO, MappedFile]) -> Iterator[str]:
+    # Lazily, without the line endings. Files are read in chunks of about READ_CHUNK bytes
+    if isinstance(source, MappedFile):
+        yield from source.lines()
+        return
+    while True:
+        chunk = source.readlines(READ_CHUNK)
+        if not chunk:
+            return
+        for line in chunk:
+            yield line[:-1] if line.endswith('\n') else line
+
+
+def write_lines(file: IO, lines: Iterable[str]):
+    file.writelines(line + '\n' for line in lines)
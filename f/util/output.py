@@ -0,0 +1,51 @@
+import atexit
+import sys
+from typing import List, Optional
+
+DEFAULT_BUFFER_SIZE = 1 << 16
+
+
+class OutputSink:
+    # Where `print` of the Python backends writes to. Block buffered when stdout isn't a terminal, so programs used
+    # in pipelines don't pay for a write per line. Text goes to whatever `sys.stdout` is when it gets flushed.
+
+    def __init__(self, buffer_size: Optional[int] = None):
+        self.parts: List[str] = []
+        self.size = 0
+        self.buffer_size = buffer_size
+        self._limit: Optional[int] = None
+
+    def configure(self, buffer_size: Optional[int]):
+        # None: line buffered on terminals, DEFAULT_BUFFER_SIZE otherwise. 0 writes every `print` right away
+        self.flush()
+        self.buffer_size = buffer_size
+        self._limit = None
+
+    @property
+    def limit(self) -> int:
+        if self._limit is None:
+            if self.buffer_size is not None:
+                self._limit = self.buffer_size
+            else:
+                try:
+                    self._limit = 0 if sys.stdout.isatty() else DEFAULT_BUFFER_SIZE
+                except (AttributeError, ValueError):
+                    self._limit = DEFAULT_BUFFER_SIZE
+        return self._limit
+
+    def write(self, text: str):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if self.parts:
+            sys.stdout.write(''.join(self.parts))
+            self.parts.clear()
+            self.size = 0
+        sys.stdout.flush()
+
+
+sink = OutputSink()
+atexit.register(sink.flush)
@@ -0,0 +1,112 @@
+import json
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field, asdict
+from typing import ContextManager, Dict, Iterator, List, Optional, TextIO
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+@dataclass
+class Phase:
+    name: str
+    depth: int  # phases can run inside of others, e.g. parsing while loading stdlib.f
+    seconds: float = 0.
+    peak_rss_kb: Optional[int] = None  # of the process, at the end of the phase
+    children_peak_rss_kb: Optional[int] = None  # of the largest child process so far, e.g. the C compiler
+    counts: Dict[str, int] = field(default_factory=dict)  # e.g. the number of tree nodes the phase produced
+
+
+class Timings:
+    # Collects how long the phases of a run take. Code that wants to be measured uses `phase`, which does nothing
+    # while `recorder` is None
+    #
+    #   with phase('parse') as p:
+    #       tree = f.parse(text)
+    #       if p is not None:
+    #           p.counts['nodes'] = count_nodes(tree)
+
+    def __init__(self):
+        self.phases: List[Phase] = []
+        self.start = time.perf_counter()
+        self._depth = 0
+
+    def add(self, name: str, seconds: float) -> Phase:
+        # For phases that ran before the recorder existed
+        record = Phase(name, self._depth, seconds, *_peak_rss())
+        self.phases.append(record)
+        return record
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[Phase]:
+        record = Phase(name, self._depth)
+        self.phases.append(record)
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record.seconds = time.perf_counter() - start
+            record.peak_rss_kb, record.children_peak_rss_kb = _peak_rss()
+            self._depth -= 1
+
+    def as_json(self) -> dict:
+        own, children = _peak_rss()
+        return {'total_seconds': time.perf_counter() - self.start, 'peak_rss_kb': own,
+                'children_peak_rss_kb': children, 'phases': [asdict(p) for p in self.phases]}
+
+    def report(self, out: TextIO = None, as_json: bool = False):
+        out = out or sys.stderr
+        if as_json:
+            json.dump(self.as_json(), out, indent=2)
+            out.write('\n')
+            return
+        width = max((2 * p.depth + len(p.name) for p in self.phases), default=0) + 2
+        print(f"{'phase':<{width}}{'time':>10} {'peak RSS':>11}  counts", file=out)
+        for p in self.phases:
+            counts = ', '.join(f"{v} {k}" for k, v in p.counts.items())
+            print(f"{'  ' * p.depth + p.name:<{width}}{p.seconds:9.3f}s {_mib(p.peak_rss_kb):>11}  {counts}".rstrip(),
+                  file=out)
+        summary = self.as_json()
+        line = f"{'total':<{width}}{summary['total_seconds']:9.3f}s {_mib(summary['peak_rss_kb']):>11}"
+        if summary['children_peak_rss_kb']:
+            line += f"  child processes: {_mib(summary['children_peak_rss_kb'])}"
+        print(line, file=out)
+
+
+recorder: Optional[Timings] = None
+
+
+def phase(name: str) -> ContextManager[Optional[Phase]]:
+    return recorder.phase(name) if recorder is not None else nullcontext()
+
+
+def count_nodes(root, node_type: type) -> int:
+    # Nodes of type `node_type` reachable from `root` through attributes, tuples and lists
+    seen = set()
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        if isinstance(node, (tuple, list)):
+            pending.extend(node)
+        elif isinstance(node, node_type) and id(node) not in seen:
+            seen.add(id(node))
+            pending.extend(getattr(node, '__dict__', {}).values())
+    return len(seen)
+
+
+def _peak_rss():
+    if resource is None:
+        return None, None
+    # bytes on macOS, KiB everywhere else
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale)
+
+
+def _mib(kb: Optional[int]) -> str:
+    return '?' if kb is None else f"{kb / 1024:.1f} MiB"
@@ -0,0 +1,125 @@
+import math
+import operator
+from array import array
+from itertools import repeat
+from typing import Callable, Iterable, Iterator, Union
+
+try:
+    import numpy
+except ImportError:  # `array('d')`, the elementwise operations loop in C through `map`
+    numpy = None
+
+ARITHMETIC = ('+', '-', '*', '**')  # the builtins `foreach` can apply to whole vectors at once
+
+
+class Vector:
+    # Numbers stored as contiguous doubles, a `numpy.ndarray` if numpy is installed and an `array('d')` otherwise.
+    # Arithmetic and comparisons work elementwise, a number on either side is used for every element:
+    #
+    #   v = Vector.of([1, 2, 3])
+    #   v * 2 + 1         # [3.0, 5.0, 7.0]
+    #   v < 2             # [1.0, 0.0, 0.0], 1 where the comparison is true
+    #   v.total(), v.dot(v)
+    #
+    # Vectors are never changed once they are built, slices may share the storage. The interpreter subclasses it
+    # to accept its own numbers (`_operand`).
+
+    __array_ufunc__ = None  # numpy scalars on the left leave the operation to the vector
+
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def of(cls, numbers: Iterable[float]) -> 'Vector':
+        if numpy is not None:
+            return cls(numpy.fromiter(numbers, numpy.float64))
+        return cls(array('d', numbers))
+
+    @classmethod
+    def full(cls, number: float, size: int) -> 'Vector':
+        if numpy is not None:
+            return cls(numpy.full(size, float(number)))
+        return cls(array('d', (float(number),)) * size)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self) -> Iterator[float]:
+        return iter(self.data.tolist())  # python floats, not numpy scalars
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            return type(self)(self.data[index])
+        return float(self.data[index])
+
+    def __repr__(self):
+        return repr(self.data.tolist())
+
+    def __bool__(self):
+        raise ValueError("A vector is neither true nor false, compare its `sum`, `min` or `max` instead")
+
+    def _operand(self, other):
+        # The storage of another vector of the same length, or a number as float
+        if isinstance(other, Vector):
+            if len(other) != len(self):
+                raise ValueError(f"Vectors of different lengths ({len(self)} and {len(other)})")
+            return other.data
+        elif isinstance(other, (int, float)):
+            return float(other)
+        return NotImplemented
+
+    # Reductions, as python floats
+
+    def total(self) -> float:
+        return float(self.data.sum()) if numpy is not None else sum(self.data, 0.)
+
+    def minimum(self) -> float:
+        if not len(self):
+            raise ValueError("`min` of an empty vector")
+        return float(self.data.min()) if numpy is not None else min(self.data)
+
+    def maximum(self) -> float:
+        if not len(self):
+            raise ValueError("`max` of an empty vector")
+        return float(self.data.max()) if numpy is not None else max(self.data)
+
+    def dot(self, other: 'Vector') -> float:
+        if not isinstance(other, Vector):
+            raise TypeError(f"`dot` needs two vectors, got {other!r}")
+        other = self._operand(other)
+        if numpy is not None:
+            return float(numpy.dot(self.data, other))
+        return sum(map(operator.mul, self.data, other), 0.)
+
+
+def _power(base: float, exponent: float) -> float:
+    # Like numpy: negative numbers to fractional powers are nan, not complex
+    result = base ** exponent
+    return math.nan if isinstance(result, complex) else result
+
+
+def _elementwise(op: Callable, ufunc: str, reflected=False, comparison=False):
+    def method(self: Vector, other):
+        other = self._operand(other)
+        if other is NotImplemented:
+            return NotImplemented
+        a, b = (other, self.data) if reflected else (self.data, other)
+        if numpy is not None:
+            result = getattr(numpy, ufunc)(a, b)
+            return type(self)(result.astype(numpy.float64) if comparison else result)
+        if isinstance(other, float):
+            a, b = (repeat(a), b) if reflected else (a, repeat(b))
+        return type(self)(array('d', map(op, a, b)))
+
+    return method
+
+
+for _name, _op, _ufunc in (('add', operator.add, 'add'), ('sub', operator.sub, 'subtract'),
+                           ('mul', operator.mul, 'multiply'), ('pow', _power, 'power')):
+    setattr(Vector, f'__{_name}__', _elementwise(_op, _ufunc))
+    setattr(Vector, f'__r{_name}__', _elementwise(_op, _ufunc, reflected=True))
+for _name, _op, _ufunc in (('eq', operator.eq, 'equal'), ('ne', operator.ne, 'not_equal'),
+                           ('lt', operator.lt, 'less'), ('le', operator.le, 'less_equal'),
+                           ('gt', operator.gt, 'greater'), ('ge', operator.ge, 'greater_equal')):
+    setattr(Vector, f'__{_name}__', _elementwise(_op, _ufunc, comparison=True))
+Vector.__hash__ = None  # `==` compares elementwise
@@ -1,7 +1,8 @@
 from typing import List, Type
 
 from . import gcc
-from .base import AbstractCCompiler
+from .base import AbstractCCompiler, CompilationOptions, CompilationError
+from .cache import BuildCache
 
 _available_compilers: List[Type[AbstractCCompiler]] = [sbcls for sbcls in AbstractCCompiler.__subclasses__()
                                                        if sbcls.is_available()]
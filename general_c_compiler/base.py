@@ -1,10 +1,12 @@
 from __future__ import annotations
 
 import platform
+import subprocess
 from abc import ABC, abstractmethod
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from pathlib import Path
-from typing import TYPE_CHECKING, List, Type
+from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING, List, Type, Iterable, Sequence
 
 
 @dataclass
@@ -23,16 +25,49 @@ class CompilationError(Exception):
 
 @dataclass
 class CompilationOptions:
-    pass
+    optimization: str = None  # One of '0', '1', '2', '3', 's', 'fast'
+    march: str = None
+    lto: bool = False
+    debug: bool = False
+    extra_flags: List[str] = field(default_factory=list)
+    include_dirs: List[Path] = field(default_factory=list)
+    position_independent: bool = False  # Required for everything linked into a shared library
+    profile_generate: Path = None  # Directory to write profile data to
+    profile_use: Path = None  # Directory to read profile data from
 
 
 class AbstractCCompiler(ABC):
     name: str
 
     @abstractmethod
-    def compile_to_executable(self, file: Path, out: Path = None, options: CompilationOptions = None):
+    def compile_to_executable(self, file: Path, out: Path = None, options: CompilationOptions = None,
+                              objects: Sequence[Path] = ()) -> Path:
         raise NotImplementedError
 
+    @abstractmethod
+    def compile_to_shared_library(self, file: Path, out: Path = None, options: CompilationOptions = None,
+                                  objects: Sequence[Path] = ()) -> Path:
+        raise NotImplementedError
+
+    @abstractmethod
+    def compile_to_object(self, file: Path, out: Path = None, options: CompilationOptions = None) -> Path:
+        raise NotImplementedError
+
+    @abstractmethod
+    def identity(self) -> str:
+        # Everything that changes the produced binaries (version, target), used as part of cache keys
+        raise NotImplementedError
+
+    def compile_with_profile(self, file: Path, out: Path = None, options: CompilationOptions = None,
+                             training_runs: Iterable[Sequence[str]] = ((),), objects: Sequence[Path] = ()) -> Path:
+        # Instrumented build, one run per argv in `training_runs`, then a rebuild using the collected profile
+        options = options or CompilationOptions()
+        with TemporaryDirectory() as profile_dir:
+            out = self.compile_to_executable(file, out, replace(options, profile_generate=Path(profile_dir)), objects)
+            for argv in training_runs:
+                subprocess.run([str(out), *argv], stdout=subprocess.DEVNULL, check=True)
+            return self.compile_to_executable(file, out, replace(options, profile_use=Path(profile_dir)), objects)
+
     @classmethod
     @abstractmethod
     def is_available(cls):
@@ -49,6 +84,15 @@ def make_executable_path(path: Path) -> Path:
     elif platform.system() == "Linux":
         if '.' not in path.name:
             return path
-        return path.with_name(path.name.rpartition('.')[-1])
+        return path.with_name(path.name.rpartition('.')[0])
+    else:
+        raise ValueError(f"Unknown platform '{platform.system()}'")
+
+
+def make_shared_library_path(path: Path) -> Path:
+    if platform.system() == "Windows":
+        return path.with_suffix(".dll")
+    elif platform.system() == "Linux":
+        return path.with_suffix(".so")
     else:
         raise ValueError(f"Unknown platform '{platform.system()}'")
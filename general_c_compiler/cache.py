@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import hashlib
+import os
+import shutil
+from pathlib import Path
+from typing import Sequence, Union, Optional
+
+from general_c_compiler.base import AbstractCCompiler, CompilationOptions, make_executable_path, \
+    make_shared_library_path
+
+
+def default_cache_directory() -> Path:
+    if 'F_CACHE_DIR' in os.environ:
+        return Path(os.environ['F_CACHE_DIR'])
+    return Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'), 'f')
+
+
+class BuildCache:
+    # Content addressed cache of objects and executables.
+    # Keys are hashes of the sources, the compiler identity and the options, so entries never have to be invalidated.
+
+    def __init__(self, compiler: AbstractCCompiler, directory: Path = None):
+        self.compiler = compiler
+        self.directory = default_cache_directory() if directory is None else directory
+
+    def key(self, options: CompilationOptions, *parts: Union[str, bytes]) -> str:
+        h = hashlib.sha256()
+        for part in (self.compiler.name, self.compiler.identity(), repr(options), *parts):
+            data = part.encode() if isinstance(part, str) else part
+            h.update(len(data).to_bytes(8, 'little'))
+            h.update(data)
+        return h.hexdigest()
+
+    @staticmethod
+    def cacheable(options: CompilationOptions) -> bool:
+        # The result of profile builds depends on the profile data, not only on the options
+        return options.profile_generate is None and options.profile_use is None
+
+    def _store(self, path: Path, build) -> Path:
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp = build(path.with_name(f"{path.name}.{os.getpid()}.tmp"))
+            os.replace(str(temp), str(path))  # atomic, concurrent builds of the same key never see half written files
+        return path
+
+    def compile_to_object(self, file: Path, options: CompilationOptions = None,
+                          dependencies: Sequence[Path] = ()) -> Path:
+        # `dependencies` are files (e.g. headers) that influence the result besides `file` itself
+        options = options or CompilationOptions()
+        key = self.key(options, file.read_bytes(), *(d.read_bytes() for d in dependencies))
+        return self._store(self.directory / 'objects' / f"{key}.o",
+                           lambda temp: self.compiler.compile_to_object(file, temp, options))
+
+    def compile_to_executable(self, file: Path, out: Path = None, options: CompilationOptions = None,
+                              objects: Sequence[Path] = (), alias: str = None) -> Path:
+        # `alias` is an additional key (e.g. of the sources `file` was generated from) for `from_alias`
+        out = make_executable_path(file if out is None else out)
+        return self._link(self.compiler.compile_to_executable, 'executables', file, out, options, objects, alias)
+
+    def compile_to_shared_library(self, file: Path, out: Path = None, options: CompilationOptions = None,
+                                  objects: Sequence[Path] = (), alias: str = None) -> Path:
+        out = make_shared_library_path(file if out is None else out)
+        return self._link(self.compiler.compile_to_shared_library, 'shared', file, out, options, objects, alias)
+
+    def _link(self, link, kind: str, file: Path, out: Path, options: CompilationOptions, objects: Sequence[Path],
+              alias: Optional[str]) -> Path:
+        options = options or CompilationOptions()
+        if not self.cacheable(options):
+            return link(file, out, options, objects)
+        key = self.key(options, kind, file.read_bytes(), *(o.read_bytes() for o in objects))
+        cached = self._store(self.directory / kind / key, lambda temp: link(file, temp, options, objects))
+        if alias is not None:
+            def write_alias(temp: Path) -> Path:
+                temp.write_text(f"{kind}/{key}")
+                return temp
+
+            self._store(self.directory / 'aliases' / alias, write_alias)
+        return self._copy(cached, out)
+
+    def from_alias(self, alias: str, out: Path) -> Optional[Path]:
+        # Copies the file stored under `alias` to `out`, returns None if there is none
+        link = self.directory / 'aliases' / alias
+        if not link.exists():
+            return None
+        cached = self.directory / link.read_text()
+        if not cached.exists():
+            return None
+        return self._copy(cached, out)
+
+    @staticmethod
+    def _copy(cached: Path, out: Path) -> Path:
+        shutil.copy2(str(cached), str(out))
+        return out.resolve()
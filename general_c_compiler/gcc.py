@@ -1,21 +1,70 @@
 import subprocess
+from functools import lru_cache
 from pathlib import Path
+from typing import List, Sequence
 
-from general_c_compiler.base import CompilationOptions, AbstractCCompiler, make_executable_path, CompilationError
+from general_c_compiler.base import CompilationOptions, AbstractCCompiler, make_executable_path, CompilationError, \
+    make_shared_library_path
 
 
 class GCCCompiler(AbstractCCompiler):
     name: str = 'gcc'
 
-    def compile_to_executable(self, file: Path, out: Path = None, options: CompilationOptions = None):
-        assert options is None
+    def compile_to_executable(self, file: Path, out: Path = None, options: CompilationOptions = None,
+                              objects: Sequence[Path] = ()) -> Path:
         file = file.resolve()
         out = make_executable_path(file if out is None else out).resolve()
-        cmd = ["gcc", "-o", str(out), str(file)]
+        cmd = ["gcc", *self.flags(options or CompilationOptions()), "-o", str(out), str(file),
+               *(str(o) for o in objects), "-lm"]
+        self._run(cmd, file)
+        return out
+
+    def compile_to_shared_library(self, file: Path, out: Path = None, options: CompilationOptions = None,
+                                  objects: Sequence[Path] = ()) -> Path:
+        file = file.resolve()
+        out = make_shared_library_path(file if out is None else out).resolve()
+        # -Bsymbolic: the library always uses its own runtime, even if another one is already loaded
+        cmd = ["gcc", *self.flags(options or CompilationOptions()), "-shared", "-Wl,-Bsymbolic", "-o", str(out),
+               str(file), *(str(o) for o in objects), "-lm"]
+        self._run(cmd, file)
+        return out
+
+    def compile_to_object(self, file: Path, out: Path = None, options: CompilationOptions = None) -> Path:
+        file = file.resolve()
+        out = (file.with_suffix('.o') if out is None else out).resolve()
+        cmd = ["gcc", *self.flags(options or CompilationOptions()), "-c", "-o", str(out), str(file)]
+        self._run(cmd, file)
+        return out
+
+    def _run(self, cmd: List[str], file: Path):
         result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         if result.returncode != 0:
             raise CompilationError(self.name, result.returncode, file, cmd, result.stderr)
 
+    @staticmethod
+    def flags(options: CompilationOptions) -> List[str]:
+        flags = []
+        if options.optimization is not None:
+            flags.append(f"-O{options.optimization}")
+        if options.march is not None:
+            flags.append(f"-march={options.march}")
+        if options.lto:
+            flags.append("-flto")
+        if options.debug:
+            flags.append("-g")
+        if options.position_independent:
+            flags.append("-fPIC")
+        if options.profile_generate is not None:
+            flags.append(f"-fprofile-generate={options.profile_generate}")
+        if options.profile_use is not None:
+            flags += [f"-fprofile-use={options.profile_use}", "-fprofile-correction", "-Wno-missing-profile"]
+        flags += (f"-I{d}" for d in options.include_dirs)
+        flags += options.extra_flags
+        return flags
+
+    def identity(self) -> str:
+        return _identity()
+
     @classmethod
     def is_available(cls):
         try:
@@ -23,3 +72,10 @@ class GCCCompiler(AbstractCCompiler):
             return result.returncode == 0
         except FileNotFoundError:
             return False
+
+
+@lru_cache()
+def _identity() -> str:
+    version = subprocess.run(["gcc", "--version"], stdout=subprocess.PIPE, universal_newlines=True)
+    machine = subprocess.run(["gcc", "-dumpmachine"], stdout=subprocess.PIPE, universal_newlines=True)
+    return f"{version.stdout.splitlines()[0]} {machine.stdout.strip()}"